@@ -0,0 +1,56 @@
+"""
+The BeautifulSoup clean_message_html that ZulipHTMLConverter replaced, kept verbatim as the
+baseline for the clean_message_html benchmarks and for regenerating the test corpus' expected
+output (tests/fixtures/message_html.json):
+
+    python benchmarks/bs4_reference.py    # Needs beautifulsoup4
+"""
+import json
+import os
+import re
+
+from bs4 import BeautifulSoup, NavigableString
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'fixtures', 'message_html.json')
+
+def clean_message_html(content):
+    """
+    Cleans up Zulip HTML message content for terminal display.
+    Strips tags, prettifies links, and tries to not break code blocks.
+    """
+    soup = BeautifulSoup(content, "html.parser")
+    for code_tag in soup.find_all(['code', 'pre']):
+        code_tag.insert_before('\n')
+        code_tag.insert_after('\n')
+    for a in soup.find_all('a'):
+        if a.name:
+            text = a.get_text()
+            href = a.get('href', '')
+            if href and href != text:
+                a.replace_with(NavigableString(f"{text} ({href})"))
+            else:
+                a.replace_with(NavigableString(text))
+        else:
+            a.replace_with(NavigableString(a.get_text()))
+    for tag in soup.find_all(['img', 'div', 'span']):
+        tag.decompose()
+    cleaned = soup.get_text(separator=" ", strip=True)
+    def url_repl(m):
+        url = m.group(0)
+        display = url if len(url) <= 60 else "link"
+        return f"\n\x1b]8;;{url}\x1b\\{display}\x1b]8;;\x1b\\\n"
+    cleaned = re.sub(r'(https?://[^\s)]+)', url_repl, cleaned)
+    return " ".join(cleaned.split())
+
+def regenerate_fixture(path=FIXTURE):
+    """Re-records the bs4 output for every corpus entry in path."""
+    with open(path) as f:
+        corpus = json.load(f)
+    for case in corpus:
+        case['bs4'] = clean_message_html(case['html'])
+    with open(path, 'w') as f:
+        json.dump(corpus, f, indent=1, ensure_ascii=False)
+        f.write('\n')
+
+if __name__ == '__main__':
+    regenerate_fixture()
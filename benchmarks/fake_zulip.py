@@ -0,0 +1,364 @@
+"""
+In-process stand-in for zulip.Client, backed by a synthetic organization, so zulip_term can be
+imported and exercised without a server.
+
+    import fake_zulip
+    org = fake_zulip.SyntheticOrg(users=20000, streams=1000, topics=50000, messages=200000)
+    fake_zulip.install(org)   # Throwaway HOME with a .zuliprc; zulip.Client now returns a FakeClient
+    import zulip_term
+
+Messages are kept as a few ints each and turned into API-shaped dicts (with realistic HTML) only
+when they're asked for, so a 200k message org costs a few tens of MB.
+"""
+import bisect
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+
+FIRST_NAMES = ["Ada", "Alan", "Barbara", "Claude", "Dennis", "Donald", "Edsger", "Frances", "Grace", "Guido",
+               "Hedy", "Ivan", "Jean", "John", "Ken", "Linus", "Margaret", "Niklaus", "Radia", "Tim"]
+LAST_NAMES = ["Hopper", "Lovelace", "Turing", "Liskov", "Ritchie", "Knuth", "Dijkstra", "Allen", "Lamarr",
+              "Sutherland", "Sammet", "McCarthy", "Thompson", "Torvalds", "Hamilton", "Wirth", "Perlman", "Berners-Lee"]
+WORDS = ("the deploy build release test flaky bug fix patch review merge branch cache index query latency "
+         "memory thread lock queue event server client stream topic message render terminal widget config "
+         "token session retry timeout backoff socket proxy schema migration rollback metric alert dashboard "
+         "sprint standup roadmap design spec docs typo refactor cleanup benchmark profile regression crash "
+         "error warning log trace debug python rust sqlite postgres redis docker kubernetes linux macos "
+         "tomorrow today later maybe agreed thanks great works broken weird interesting").split()
+STREAM_WORDS = ["backend", "frontend", "design", "ops", "infra", "mobile", "data", "support", "sales",
+                "general", "random", "announce", "release", "security", "docs", "community", "hiring", "qa"]
+EMOJI = [("1f44d", "thumbs up", "+1"), ("1f389", "tada", "tada"), ("1f604", "smile", "smile"),
+         ("1f440", "eyes", "eyes"), ("2705", "check", "check")]
+
+class SyntheticOrg:
+    """
+    A made-up Zulip organization. Stream and topic activity is skewed (a few streams and topics
+    get most of the traffic, as in real orgs), a tenth of the messages are DMs with "me"
+    (users[0]), and the newest messages are unread.
+    """
+    def __init__(self, users=20000, streams=1000, topics=50000, messages=200000, seed=1, subscribed=100):
+        rng = random.Random(seed)
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.users = []
+        for i in range(users):
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            if i % 50:  # Mostly unique names, with some shared ones like a real org
+                name += f" {i}"
+            self.users.append({'email': f"user{i}@example.com", 'full_name': name, 'user_id': i + 1,
+                               'is_active': True, 'is_bot': False, 'timezone': 'UTC'})
+        self.users[0].update(email="me@example.com", full_name="Me Myself")
+        self.me = self.users[0]
+        self.streams = [f"{STREAM_WORDS[i % len(STREAM_WORDS)]}-{i}" for i in range(streams)]
+        per_stream = max(1, topics // max(1, streams))
+        self.topics = [[f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i * per_stream + j}" for j in range(per_stream)]
+                       for i in range(streams)]
+        self.subscribed = self.streams[:subscribed]
+        # Per message: sender index, stream index (or -1 - partner index for DMs), topic index
+        self.senders, self.places, self.topic_of = [], [], []
+        self.by_topic = {}   # (stream index, topic index) -> message ids, ascending
+        self.by_stream = {}  # stream index -> message ids
+        self.by_dm = {}      # partner user index -> message ids
+        self.all_ids = []
+        self.first_id = 1000
+        stream_weights = list(itertools.accumulate(1 / (r + 1) for r in range(streams)))
+        topic_weights = list(itertools.accumulate(1 / (r + 1) for r in range(per_stream)))
+        partner_weights = list(itertools.accumulate(1 / (r + 1) for r in range(min(300, users - 1))))
+        for _ in range(messages):
+            if rng.random() < 0.1 and users > 1:
+                partner = 1 + bisect.bisect_left(partner_weights, rng.random() * partner_weights[-1])
+                self._append(rng.choice((0, partner)), -1 - partner, 0)
+            else:
+                s = bisect.bisect_left(stream_weights, rng.random() * stream_weights[-1])
+                t = bisect.bisect_left(topic_weights, rng.random() * topic_weights[-1])
+                self._append(rng.randrange(1, users) if users > 1 else 0, s, t)
+        self.events = []  # Queued events, for get_events
+        self.sent_at = {}  # Message id -> send time, for messages added after construction
+
+    def _append(self, sender, place, topic):
+        msg_id = self.first_id + len(self.senders)
+        self.senders.append(sender)
+        self.places.append(place)
+        self.topic_of.append(topic)
+        self.all_ids.append(msg_id)
+        if place >= 0:
+            self.by_topic.setdefault((place, topic), []).append(msg_id)
+            self.by_stream.setdefault(place, []).append(msg_id)
+        else:
+            self.by_dm.setdefault(-1 - place, []).append(msg_id)
+        return msg_id
+
+    @property
+    def max_id(self):
+        return self.first_id + len(self.senders) - 1
+
+    def busiest_topic(self, rank=0):
+        """(stream, topic) names of the rank-th busiest topic."""
+        (s, t), _ = sorted(self.by_topic.items(), key=lambda kv: -len(kv[1]))[rank]
+        return self.streams[s], self.topics[s][t]
+
+    # Message materialization
+    def content(self, msg_id, markdown=False):
+        """
+        Message HTML as the server renders it: paragraphs, mentions, code, quotes, lists, emoji, links.
+        With markdown, the Markdown it was rendered from instead (what apply_markdown=False gets).
+        """
+        rng = random.Random(msg_id)
+
+        def words(n):
+            return " ".join(rng.choice(WORDS) for _ in range(n))
+        blocks, sources = [], []
+        for _ in range(rng.choice((1, 1, 1, 2, 2, 3))):
+            kind = rng.randrange(10)
+            if kind < 4:
+                text = f"{words(rng.randint(3, 30)).capitalize()}."
+                blocks.append(f"<p>{text}</p>")
+                sources.append(text)
+            elif kind == 4:
+                user = self.users[rng.randrange(len(self.users))]
+                before, after = words(4), words(6)
+                blocks.append(f'<p>{before} <span class="user-mention" data-user-id="{user["user_id"]}">'
+                              f'@{user["full_name"]}</span> {after}?</p>')
+                sources.append(f"{before} @**{user['full_name']}** {after}?")
+            elif kind == 5:
+                url, text, fn = f"https://example.com/{rng.choice(WORDS)}/{msg_id}", words(3), f"{rng.choice(WORDS)}_{rng.choice(WORDS)}()"
+                blocks.append(f'<p>See <a href="{url}">{text}</a> and <code>{fn}</code>.</p>')
+                sources.append(f"See [{text}]({url}) and `{fn}`.")
+            elif kind == 6:
+                fn = rng.choice(WORDS)
+                blocks.append('<div class="codehilite" data-code-language="Python"><pre><span></span><code>'
+                              f'<span class="k">def</span> <span class="nf">{fn}</span><span class="p">(</span>'
+                              f'<span class="n">x</span><span class="p">):</span>\n'
+                              f'    <span class="k">return</span> <span class="n">x</span> <span class="o">+</span> '
+                              f'<span class="mi">{msg_id % 97}</span>\n</code></pre></div>')
+                sources.append(f"```python\ndef {fn}(x):\n    return x + {msg_id % 97}\n```")
+            elif kind == 7:
+                text = words(12)
+                blocks.append(f"<blockquote>\n<p>{text}</p>\n</blockquote>")
+                sources.append(f"> {text}")
+            elif kind == 8:
+                items = [words(rng.randint(2, 8)) for _ in range(rng.randint(2, 4))]
+                blocks.append("<ul>\n" + "".join(f"<li>{item}</li>\n" for item in items) + "</ul>")
+                sources.append("\n".join(f"* {item}" for item in items))
+            else:
+                code, label, name = rng.choice(EMOJI)
+                text = words(5)
+                blocks.append(f'<p>{text} <span aria-label="{label}" class="emoji emoji-{code}" role="img" '
+                              f'title="{label}">:{name}:</span></p>')
+                sources.append(f"{text} :{name}:")
+                if rng.random() < 0.3:
+                    blocks.append(f'<div class="message_inline_image"><a href="https://example.com/img/{msg_id}.png" '
+                                  f'title="screenshot.png"><img src="https://example.com/thumb/{msg_id}.webp"></a></div>')
+                    sources.append(f"[screenshot.png](https://example.com/img/{msg_id}.png)")
+        return "\n\n".join(sources) if markdown else "\n".join(blocks)
+
+    def message(self, msg_id, apply_markdown=True, client_gravatar=False):
+        """The API dict for msg_id, shaped by the apply_markdown and client_gravatar a client asked for."""
+        i = msg_id - self.first_id
+        sender = self.users[self.senders[i]]
+        place = self.places[i]
+        msg = {
+            'id': msg_id, 'sender_id': sender['user_id'], 'sender_full_name': sender['full_name'],
+            'sender_email': sender['email'], 'sender_realm_str': 'example',
+            'timestamp': self.sent_at.get(msg_id, 1700000000 + msg_id * 7),
+            'client': 'website', 'content': self.content(msg_id, markdown=not apply_markdown),
+            'content_type': 'text/html' if apply_markdown else 'text/x-markdown',
+            'is_me_message': False, 'reactions': [], 'submessages': [], 'topic_links': [],
+            'flags': [] if msg_id > self.max_id - len(self.all_ids) // 20 else ['read'],
+            'avatar_url': None if client_gravatar else f"https://secure.gravatar.com/avatar/{sender['user_id']:032x}?d=identicon&version=1",
+        }
+        if place >= 0:
+            msg.update(type='stream', display_recipient=self.streams[place], stream_id=place + 1,
+                       subject=self.topics[place][self.topic_of[i]], recipient_id=place + 1)
+        else:
+            partner = self.users[-1 - place]
+            msg.update(type='private', subject='', recipient_id=100000 + partner['user_id'], display_recipient=[
+                {'email': u['email'], 'full_name': u['full_name'], 'id': u['user_id'], 'is_mirror_dummy': False}
+                for u in sorted((self.me, partner), key=lambda u: u['user_id'])])
+        return msg
+
+    # Narrows
+    def _ids_for(self, narrow):
+        ops = {n['operator']: n['operand'] for n in narrow}
+        if 'pm-with' in ops or 'dm' in ops:
+            emails = set((ops.get('pm-with') or ops.get('dm')).split(',')) - {self.me['email']}
+            partner = self._user_index(next(iter(emails))) if len(emails) == 1 else None
+            ids = self.by_dm.get(partner, [])
+        elif 'stream' in ops:
+            try:
+                s = self.streams.index(ops['stream'])
+            except ValueError:
+                return []
+            if 'topic' in ops:
+                topic = ops['topic'].lower()
+                t = next((j for j, name in enumerate(self.topics[s]) if name.lower() == topic), None)
+                ids = self.by_topic.get((s, t), [])
+            else:
+                ids = self.by_stream.get(s, [])
+        else:
+            ids = self.all_ids
+        if 'sender' in ops:
+            sender = self._user_index(ops['sender'])
+            ids = [m for m in ids if self.senders[m - self.first_id] == sender]
+        if 'search' in ops:
+            words = ops['search'].lower().split()
+            ids = [m for m in ids if all(w in self.content(m).lower() for w in words)]
+        return ids
+
+    def _user_index(self, email):
+        if email == self.me['email']:
+            return 0
+        try:
+            return int(email[len("user"):email.index('@')])
+        except ValueError:
+            return None
+
+    def get_messages(self, request):
+        with self.lock:
+            ids = self._ids_for(request.get('narrow', []))
+        anchor = request.get('anchor', 'newest')
+        num_before, num_after = request.get('num_before', 0), request.get('num_after', 0)
+        if anchor == 'newest':
+            i = len(ids) - 1
+        elif anchor in ('oldest', 'first_unread'):
+            i = 0
+        else:
+            i = bisect.bisect_left(ids, int(anchor))
+        has_anchor = 0 <= i < len(ids) and (anchor in ('newest', 'oldest', 'first_unread') or ids[i] == int(anchor))
+        lo = max(0, i - num_before)
+        hi = min(len(ids), i + (1 if has_anchor else 0) + num_after)
+        return {'result': 'success', 'messages': [self.message(m) for m in ids[lo:hi]],
+                'found_oldest': lo == 0, 'found_newest': hi == len(ids), 'found_anchor': has_anchor,
+                'anchor': ids[i] if has_anchor else anchor}
+
+    # Live traffic
+    def new_message(self, stream=None, topic=None, partner=None, sender=None):
+        """Adds a message (to stream/topic, or a DM with partner's user index) and returns its API dict."""
+        with self.lock:
+            if stream is not None:
+                s = self.streams.index(stream)
+                t = self.topics[s].index(topic)
+                msg_id = self._append(sender if sender is not None else self.rng.randrange(1, len(self.users)), s, t)
+            else:
+                msg_id = self._append(sender if sender is not None else partner, -1 - partner, 0)
+            self.sent_at[msg_id] = int(time.time())
+        return self.message(msg_id)
+
+    def message_event(self, msg):
+        return {'type': 'message', 'id': len(self.events), 'message': msg, 'flags': []}
+
+    def post_message_event(self, msg):
+        """Queues the message event for msg, for get_events to deliver."""
+        with self.lock:
+            self.events.append(self.message_event(msg))
+
+    def register_state(self):
+        """What POST /register returns for the event and state types zulip_term asks for."""
+        unread_from = self.max_id - len(self.all_ids) // 20
+        streams, pms = {}, {}
+        for m in range(max(self.first_id, unread_from + 1), self.max_id + 1):
+            i = m - self.first_id
+            if self.senders[i] == 0:
+                continue
+            if self.places[i] >= 0:
+                s = self.places[i]
+                streams.setdefault((s, self.topics[s][self.topic_of[i]]), []).append(m)
+            else:
+                pms.setdefault(self.users[self.senders[i]]['user_id'], []).append(m)
+        return {
+            'result': 'success', 'queue_id': 'fake-queue', 'last_event_id': -1,
+            'email': self.me['email'], 'user_id': self.me['user_id'], 'max_message_id': self.max_id,
+            'realm_users': [dict(u) for u in self.users],
+            'streams': [{'name': n, 'stream_id': i + 1, 'description': '', 'invite_only': False}
+                        for i, n in enumerate(self.streams)],
+            'subscriptions': [{'name': n, 'stream_id': self.streams.index(n) + 1, 'color': '#76ce90'}
+                              for n in self.subscribed],
+            'unread_msgs': {
+                'streams': [{'stream_id': s + 1, 'topic': t, 'unread_message_ids': ids} for (s, t), ids in streams.items()],
+                'pms': [{'other_user_id': uid, 'sender_id': uid, 'unread_message_ids': ids} for uid, ids in pms.items()],
+                'huddles': [], 'mentions': [], 'count': sum(map(len, streams.values())) + sum(map(len, pms.values())),
+            },
+            'presences': self.presences(), 'server_timestamp': time.time(),
+        }
+
+    def presences(self):
+        now = int(time.time())
+        return {u['email']: {'aggregated': {'status': 'active' if i % 3 else 'idle', 'timestamp': now - i % 120}}
+                for i, u in enumerate(self.users[1:len(self.users) // 10 + 1])}
+
+class FakeClient:
+    """The subset of zulip.Client that zulip_term uses, answered from a SyntheticOrg."""
+    def __init__(self, org, *args, **kwargs):
+        self.org = org
+        self.email = org.me['email']
+        self.base_url = "https://zulip.example.com/api/"
+        self.calls = {}  # Method name -> number of calls
+        self.queue_options = {}  # What register() asked message events to look like (the server's defaults otherwise)
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def register(self, event_types=None, fetch_event_types=None, apply_markdown=False, client_gravatar=False, **kwargs):
+        self._count('register')
+        self.queue_options = {'apply_markdown': apply_markdown, 'client_gravatar': client_gravatar}
+        return self.org.register_state()
+
+    def get_events(self, queue_id=None, last_event_id=-1, **kwargs):
+        self._count('get_events')
+        time.sleep(0.05)
+        with self.org.lock:
+            events = [e for e in self.org.events if e['id'] > last_event_id]
+        options = {'apply_markdown': False, 'client_gravatar': False, **self.queue_options}
+        events = [dict(e, message=self.org.message(e['message']['id'], **options)) if e['type'] == 'message' else e
+                  for e in events]
+        return {'result': 'success', 'events': events}
+
+    def get_messages(self, request):
+        self._count('get_messages')
+        return self.org.get_messages(request)
+
+    def get_stream_topics(self, stream_id):
+        self._count('get_stream_topics')
+        s = stream_id - 1 if isinstance(stream_id, int) else self.org.streams.index(stream_id)
+        ids = self.org.by_stream.get(s, [])
+        return {'result': 'success', 'topics': [{'name': name, 'max_id': ids[-1] if ids else 0}
+                                                for name in self.org.topics[s]]}
+
+    def send_message(self, request):
+        self._count('send_message')
+        if request['type'] == 'stream':
+            msg = self.org.new_message(request['to'], request['topic'], sender=0)
+        else:
+            msg = self.org.new_message(partner=self.org._user_index(request['to'][0]), sender=0)
+        return {'result': 'success', 'id': msg['id']}
+
+    def update_message_flags(self, request):
+        self._count('update_message_flags')
+        return {'result': 'success', 'messages': list(request['messages'])}
+
+    def call_endpoint(self, url=None, method='POST', request=None, **kwargs):
+        self._count('call_endpoint')
+        if url == 'realm/presence':
+            return {'result': 'success', 'presences': self.org.presences(), 'server_timestamp': time.time()}
+        return {'result': 'success'}
+
+    def get_server_settings(self):
+        return {'result': 'success', 'zulip_version': '9.0', 'zulip_feature_level': 300}
+
+def install(org, home=None):
+    """
+    Points HOME at home (a fresh temporary directory by default) with a .zuliprc in it and makes
+    zulip.Client build FakeClients for org. Call before importing zulip_term. Returns home.
+    """
+    import zulip
+    home = home or tempfile.mkdtemp(prefix="zulip_term_bench_")
+    os.environ['HOME'] = home
+    rc = os.path.join(home, '.zuliprc')
+    if not os.path.exists(rc):
+        with open(rc, 'w') as f:
+            f.write("[api]\nemail=me@example.com\nkey=benchmark\nsite=https://zulip.example.com\n")
+    zulip.Client = lambda *args, **kwargs: FakeClient(org, *args, **kwargs)
+    return home
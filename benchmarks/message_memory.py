@@ -0,0 +1,83 @@
+"""
+Memory benchmark: what 100k loaded messages cost as raw API dicts versus Message records.
+
+Run from the repository root:  python benchmarks/message_memory.py [count]
+Needs the client's own dependencies (zulip, prompt_toolkit); the server is faked (see fake_zulip.py).
+"""
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')]
+import fake_zulip  # noqa: E402
+fake_zulip.install(fake_zulip.SyntheticOrg(users=10, streams=1, topics=1, messages=0))
+import zulip_term  # noqa: E402
+
+USERS = [(f"user{i}@example.com", f"User Number {i}", i) for i in range(200)]
+STREAMS = [f"stream-{i}" for i in range(30)]
+TOPICS = [f"topic {i}" for i in range(300)]
+CONTENT = [
+    "<p>Short reply.</p>",
+    "<p>Looks good to me, <span class=\"user-mention\" data-user-id=\"3\">@User Number 3</span> can you merge?</p>",
+    "<p>See <a href=\"https://example.com/some/long/path?with=query\">the doc</a> for details.</p>",
+    "<div class=\"codehilite\"><pre><span></span><code>print(\"hello\")\n</code></pre></div>",
+]
+
+def api_message(i, rng):
+    """A message dict shaped like what GET /messages returns."""
+    email, name, uid = rng.choice(USERS)
+    msg = {
+        'id': 1000 + i, 'sender_id': uid, 'sender_full_name': name, 'sender_email': email,
+        'sender_realm_str': 'example', 'timestamp': 1700000000 + i, 'client': 'website',
+        'content': rng.choice(CONTENT), 'content_type': 'text/html', 'is_me_message': False,
+        'avatar_url': f"https://secure.gravatar.com/avatar/{uid:032x}?d=identicon&version=1",
+        'reactions': [], 'submessages': [], 'flags': ['read'], 'topic_links': [],
+    }
+    if rng.random() < 0.8:
+        msg.update(type='stream', display_recipient=rng.choice(STREAMS), stream_id=7, subject=rng.choice(TOPICS), recipient_id=20)
+    else:
+        other = rng.choice(USERS)
+        msg.update(type='private', subject='', recipient_id=30, display_recipient=[
+            {'email': email, 'full_name': name, 'id': uid, 'is_mirror_dummy': False},
+            {'email': other[0], 'full_name': other[1], 'id': other[2], 'is_mirror_dummy': False},
+        ])
+    return msg
+
+def measure(build, count):
+    """Bytes retained by build(count), per tracemalloc."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(count)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(kept) == count
+    return after - before
+
+def raw_pages(count, page=1000):
+    """API responses as the client decodes them, one page at a time (so strings aren't shared)."""
+    rng = random.Random(1)
+    for start in range(0, count, page):
+        yield json.loads(json.dumps([api_message(i, rng) for i in range(start, min(count, start + page))]))
+
+def keep_dicts(count):
+    return [m for page in raw_pages(count) for m in page]
+
+def keep_records(count):
+    return [zulip_term.Message.from_api(m) for page in raw_pages(count) for m in page]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    dicts = measure(keep_dicts, count)
+    records = measure(keep_records, count)
+    print(f"{count} messages")
+    print(f"  API dicts:        {dicts / 2**20:8.1f} MiB  {dicts / count:7.0f} B/message")
+    print(f"  Message records:  {records / 2**20:8.1f} MiB  {records / count:7.0f} B/message")
+    print(f"  saved:            {(dicts - records) / dicts:8.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+"""
+Offline microbenchmarks for zulip_term's hot paths, against an in-process fake server.
+
+    python benchmarks/run_benchmarks.py                      # Full-size org, results in benchmark_results.json
+    python benchmarks/run_benchmarks.py --quick              # A 1/20 scale org, for a fast check
+    python benchmarks/run_benchmarks.py --compare old.json   # Also flags benchmarks that got slower
+
+Every benchmark reports time per operation (median and best of several rounds). Results go to
+a JSON file along with the org size and the git revision, so two runs can be compared; --compare
+exits with status 1 if anything regressed past --threshold.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [HERE, ROOT]
+import fake_zulip  # noqa: E402
+
+SIZES = {'users': 20000, 'streams': 1000, 'topics': 50000, 'messages': 200000}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name, default in SIZES.items():
+        parser.add_argument(f"--{name}", type=int, default=default, help=f"synthetic org size (default {default})")
+    parser.add_argument("--quick", action="store_true", help="shrink the org 20x and time fewer rounds")
+    parser.add_argument("--rounds", type=int, default=5, help="timed rounds per benchmark (default 5)")
+    parser.add_argument("--only", action="append", default=[], help="run only benchmarks whose name starts with this")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio that counts as a regression")
+    parser.add_argument("--startup-child", choices=("first", "snapshot"), help=argparse.SUPPRESS)
+    parser.add_argument("--home", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.quick:
+        for name in SIZES:
+            setattr(args, name, max(1, getattr(args, name) // 20))
+        args.rounds = min(args.rounds, 3)
+    return args
+
+def make_org(args):
+    return fake_zulip.SyntheticOrg(users=args.users, streams=args.streams, topics=args.topics, messages=args.messages)
+
+def ui_session(z):
+    """
+    Makes zulip_term's Application the current one, drawing to a dummy 80x40 terminal. Outside of
+    it, every get_app() builds a throwaway application, which would swamp the timings.
+    """
+    from prompt_toolkit.application import Application
+    from prompt_toolkit.application.current import set_app
+    from prompt_toolkit.input import DummyInput
+    from prompt_toolkit.output import DummyOutput
+    app = Application(layout=z.layout, key_bindings=z.kb, style=z.style, full_screen=True,
+                      input=DummyInput(), output=DummyOutput())
+    return set_app(app)
+
+# Timing
+class Suite:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+
+    def wanted(self, name):
+        return not self.args.only or any(name.startswith(p) for p in self.args.only)
+
+    def record(self, name, times, per, unit_note=None):
+        """times: seconds per round, each round doing per operations."""
+        ops = sorted(t / per for t in times)
+        self.results[name] = {
+            'median_us': statistics.median(ops) * 1e6,
+            'best_us': ops[0] * 1e6,
+            'ops_per_sec': 1 / statistics.median(ops) if statistics.median(ops) else None,
+            'rounds': len(times),
+            'ops_per_round': per,
+        }
+        if unit_note:
+            self.results[name]['note'] = unit_note
+        print(f"  {name:<44} {self.results[name]['median_us']:>12.2f} us/op   (best {ops[0] * 1e6:.2f})")
+
+    def bench(self, name, fn, per=1, min_time=0.1, setup=None):
+        """Times fn() (which does per operations) over several rounds of about min_time each."""
+        if not self.wanted(name):
+            return
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        once = max(time.perf_counter() - start, 1e-7)
+        number = max(1, int(min_time / once))
+        times = []
+        for _ in range(self.args.rounds):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            times.append((time.perf_counter() - start) / number)
+        self.record(name, times, per)
+
+# The benchmarks
+def bench_html(suite, z, org):
+    sample = [org.message(m)['content'] for m in org.all_ids[::max(1, len(org.all_ids) // 500)][:500]]
+    with open(os.path.join(ROOT, 'tests', 'fixtures', 'message_html.json')) as f:
+        corpus = [case['html'] for case in json.load(f)]
+    try:
+        import bs4_reference
+    except ImportError:  # beautifulsoup4 isn't installed; time the converter alone
+        bs4_reference = None
+    for name, html in (("clean_message_html", sample), ("clean_message_html.corpus", corpus)):
+        suite.bench(name, lambda html=html: [z.clean_message_html(c) for c in html], per=len(html))
+        if bs4_reference:
+            suite.bench(f"{name}.bs4", lambda html=html: [bs4_reference.clean_message_html(c) for c in html], per=len(html))
+
+def open_narrow(z, stream, topic, history):
+    """Opens stream > topic and pages in older messages until about history of them are loaded."""
+    z.process_command(f"/stream {stream} {topic}")
+    while len(z.msg_history) < history and z.earliest_msg_id is not None:
+        before = len(z.msg_history)
+        z.lazy_load_older_messages(500)
+        if len(z.msg_history) == before:
+            break
+
+def bench_narrow(suite, z, org):
+    (s1, t1), (s2, t2) = org.busiest_topic(0), org.busiest_topic(1)
+    open_narrow(z, s2, t2, 0)  # So both are in the local store
+    open_narrow(z, s1, t1, 2000)
+    lines = z.line_model.line_count
+    window = z.get_dynamic_visible_window()
+    print(f"  (open narrow: {len(z.msg_history)} messages, {lines} lines, window {window})")
+    z.chat_scroll_pos_lines = 0
+    suite.bench("render_visible_messages.bottom", z.render_visible_messages)
+    positions = list(range(0, max(1, lines - window), max(1, lines // 50)))
+
+    def scrolled():
+        for pos in positions:
+            z.chat_scroll_pos_lines = pos
+            z.render_visible_messages()
+    suite.bench("render_visible_messages.scrolled", scrolled, per=len(positions))
+    z.chat_scroll_pos_lines = 0
+
+    control = z.ChatControl()
+
+    def frame(width=78, height=36, dirty=True):
+        # What the chat pane costs prompt_toolkit per frame, at the bottom of the narrow
+        if dirty:
+            z.region_generations['chat'] += 1
+        content = control.create_content(width, height)
+        for i in range(min(height, content.line_count)):
+            content.get_line(i)
+    suite.bench("chat_control.frame", frame)
+    suite.bench("chat_control.frame_clean", lambda: frame(dirty=False))
+    widths = itertools.cycle((78, 120))
+    suite.bench("chat_control.resize", lambda: frame(next(widths)), per=max(1, len(z.msg_history)))
+    z.chat_view.update(width=None, height=None)
+    z.line_model.set_width(None)
+
+    def rebuild():
+        z.line_model.rebuild(z.msg_history, z.current_context_key())
+    suite.bench("line_model.rebuild_cached_renders", rebuild, per=max(1, len(z.msg_history)))
+    suite.bench("line_model.rebuild_cold_renders", rebuild, per=max(1, len(z.msg_history)), setup=z.clear_render_cache)
+
+    def bulk_render():
+        # What opening a narrow does with a big batch: the window right away, the rest via the process pool
+        z.line_model.reset(z.current_context_key())
+        z.render_in_background(z.msg_history, z.history_inserter(), z.chat_context_tag, first=window)
+    suite.bench("bulk_render.process_pool_cold", bulk_render, per=max(1, len(z.msg_history)), setup=z.clear_render_cache)
+
+    def switch():
+        z.process_command(f"/stream {s2} {t2}")
+        z.process_command(f"/stream {s1} {t1}")
+    suite.bench("narrow_switch.from_store", switch, per=2)
+
+def bench_sidebar(suite, z, org):
+    suite.bench("render_stream_sidebar.cached", z.render_stream_sidebar)
+
+    def rebuild():
+        z.region_generations['sidebar'] += 1
+        z.render_stream_sidebar()
+    suite.bench("render_stream_sidebar.rebuild", rebuild)
+
+def bench_completion(suite, z, org):
+    from prompt_toolkit.completion import CompleteEvent
+    from prompt_toolkit.document import Document
+    completer = z.ZulipCompleter()
+    stream = org.subscribed[0]
+    z.topic_loader.ensure(stream)
+    user = org.users[len(org.users) // 2]['full_name']
+    cases = {
+        'command': "/st",
+        'stream_prefix': f"/stream {stream[:4]}",
+        'stream_fuzzy': "/stream bkd",
+        'topic': f"/stream {stream} {org.topics[0][0][:3]}",
+        'dm_prefix': f"/dm {user[:5]}",
+        'dm_word_start': f"/dm {user.split()[-1][:4]}",
+        'mention': f"hey @{user[:3]}",
+        'no_match': "/dm zzzzqqq",
+    }
+    for case, text in cases.items():
+        doc = Document(text, len(text))
+        suite.bench(f"get_completions.{case}", lambda doc=doc: list(completer.get_completions(doc, CompleteEvent())))
+
+def bench_dm_key(suite, z, org):
+    emails = [[u['email']] for u in org.users[1:1001]] + [[a['email'], b['email']] for a, b in zip(org.users[1:500], org.users[500:999])]
+    suite.bench("_get_dm_key", lambda: [z._get_dm_key(e) for e in emails], per=len(emails))
+
+def bench_events(suite, z, org):
+    """Events through global_event_handler, as the event thread hands them over."""
+    stream, topic = org.busiest_topic(0)
+    z.process_command(f"/stream {stream} {topic}")
+    others = [(org.streams[s], org.topics[s][t]) for (s, t) in list(org.by_topic)[:200]]
+    n = 500
+
+    def message_events():
+        # A fifth land in the open narrow, the rest elsewhere (like a busy org)
+        events = []
+        for i in range(n):
+            if i % 10 == 0:
+                msg = org.new_message(partner=1 + i % 50)
+            elif i % 5 == 0:
+                msg = org.new_message(stream, topic)
+            else:
+                msg = org.new_message(*others[i % len(others)])
+            events.append(org.message_event(msg))
+        return events
+    if suite.wanted("global_event_handler.message"):
+        times = []
+        for _ in range(suite.args.rounds):
+            events = message_events()
+            start = time.perf_counter()
+            for event in events:
+                z.global_event_handler(event)
+            times.append(time.perf_counter() - start)
+        suite.record("global_event_handler.message", times, n)
+    users = org.users[1:n + 1]
+    suite.bench("global_event_handler.realm_user_update",
+                lambda: [z.global_event_handler({'type': 'realm_user', 'op': 'update', 'id': 0,
+                                                 'person': {'user_id': u['user_id'], 'full_name': u['full_name']}})
+                         for u in users], per=len(users))
+    # Changes to loaded messages: each re-renders one block in place
+    loaded = [m.id for m in z.msg_history if isinstance(m, z.Message) and m.id is not None][-100:]
+    edits = itertools.count()
+    suite.bench("global_event_handler.update_message",
+                lambda: [z.global_event_handler({'type': 'update_message', 'id': 0, 'message_id': i, 'message_ids': [i],
+                                                 'rendered_content': f"<p>edit {next(edits)}</p>",
+                                                 'edit_timestamp': 1700000000})
+                         for i in loaded], per=len(loaded))
+    suite.bench("global_event_handler.reaction",
+                lambda: [z.global_event_handler({'type': 'reaction', 'id': 0, 'op': op, 'message_id': i, 'user_id': 2,
+                                                 'emoji_name': 'tada', 'emoji_code': '1f389',
+                                                 'reaction_type': 'unicode_emoji'})
+                         for i in loaded for op in ('add', 'remove')], per=2 * len(loaded))
+
+def bench_search(suite, z, org):
+    word = fake_zulip.WORDS[len(fake_zulip.WORDS) // 2]
+    suite.bench("search_index.query", lambda: z.message_store.search([(None, word[:3])], None, z.SEARCH_PAGE))
+
+# Cold startup, timed in a fresh interpreter
+def startup_child(args):
+    """Runs in the child: import, bootstrap and first frame, printed as JSON."""
+    org = make_org(args)
+    fake_zulip.install(org, args.home)
+    start = time.perf_counter()
+    import zulip_term as z
+    imported = time.perf_counter()
+    with ui_session(z):
+        if args.startup_child == 'snapshot':
+            ok = z.load_realm_snapshot()
+            assert ok, "no snapshot to start from"
+        else:
+            z.register_queue()
+        bootstrapped = time.perf_counter()
+        z.render_stream_sidebar()
+        z.render_notification_bar()
+        z.get_help_screen_lines()
+        drawn = time.perf_counter()
+    z.stop_event.set()
+    print(json.dumps({'import': imported - start, 'bootstrap': bootstrapped - imported,
+                      'first_frame': drawn - bootstrapped, 'total': drawn - start}))
+
+def bench_startup(suite, args):
+    if not suite.wanted("startup"):
+        return
+    home = fake_zulip.tempfile.mkdtemp(prefix="zulip_term_bench_")
+    sizes = [f"--{name}={getattr(args, name)}" for name in SIZES]
+    for kind in ('first', 'snapshot'):
+        times = []
+        for _ in range(max(1, min(args.rounds, 3))):
+            out = subprocess.run([sys.executable, __file__, f"--startup-child={kind}", f"--home={home}"] + sizes,
+                                 capture_output=True, text=True, check=True).stdout
+            times.append(json.loads(out.strip().splitlines()[-1])['total'])
+        suite.record(f"startup.{kind}_launch", times, 1, "import + bootstrap + first frame, fresh process")
+
+# Results
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, path, threshold):
+    """Prints how results moved against an earlier run. Returns the names that regressed."""
+    with open(path) as f:
+        old = json.load(f)['results']
+    regressed = []
+    print(f"\nCompared with {path}:")
+    for name, res in results.items():
+        if name not in old:
+            continue
+        ratio = res['median_us'] / old[name]['median_us'] if old[name]['median_us'] else 1
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"  {name:<44} {ratio:>6.2f}x{flag}")
+        if flag:
+            regressed.append(name)
+    return regressed
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup_child:
+        startup_child(args)
+        return 0
+    print(f"Building org: {args.users} users, {args.streams} streams, {args.topics} topics, {args.messages} messages")
+    org = make_org(args)
+    fake_zulip.install(org)
+    import zulip_term as z
+    z.start_prerender_pool()  # As main() does, before anything starts a thread
+    suite = Suite(args)
+    with ui_session(z):
+        z.register_queue()
+        for stream in org.subscribed:
+            z.topic_loader.ensure(stream)  # Let background topic discovery finish before timing anything
+        bench_html(suite, z, org)
+        bench_narrow(suite, z, org)
+        bench_sidebar(suite, z, org)
+        bench_completion(suite, z, org)
+        bench_dm_key(suite, z, org)
+        bench_search(suite, z, org)
+        bench_events(suite, z, org)
+    z.stop_event.set()
+    bench_startup(suite, args)
+    report = {
+        'meta': {
+            'revision': git_revision(), 'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'org': {name: getattr(args, name) for name in SIZES}, 'rounds': args.rounds,
+        },
+        'results': suite.results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"\nWrote {args.output}")
+    if args.compare and compare(suite.results, args.compare, args.threshold):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,19 @@
+"""
+Every test runs zulip_term against one in-process fake server (benchmarks/fake_zulip.py), installed
+before the module is first imported.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'benchmarks'), ROOT]
+import fake_zulip  # noqa: E402
+
+ORG = fake_zulip.SyntheticOrg(users=20, streams=3, topics=10, messages=200)
+fake_zulip.install(ORG)
+
+@pytest.fixture
+def org():
+    return ORG
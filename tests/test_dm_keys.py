@@ -0,0 +1,32 @@
+"""DMs are keyed by their people's emails, so users who share a display name stay apart."""
+import zulip_term as z
+
+def rename(user, full_name):
+    z.global_event_handler({'type': 'realm_user', 'id': 1, 'op': 'update',
+                            'person': {'user_id': user['user_id'], 'full_name': full_name}})
+
+def test_same_name_users_have_separate_dms(org):
+    z.apply_realm_state(z.client.register())
+    a, b = org.users[-1], org.users[-2]
+    old_name = b['full_name']
+    rename(b, a['full_name'])
+    try:
+        for partner in (len(org.users) - 1, len(org.users) - 2, len(org.users) - 2):
+            z.global_event_handler({'type': 'message', 'id': 2, 'message': org.new_message(partner=partner), 'flags': []})
+        key_a, key_b = z._get_dm_key([a['email']]), z._get_dm_key([b['email']])
+        assert key_a != key_b
+        assert z.unread_model.dm_count(key_a) >= 1 and z.unread_model.dm_count(key_b) >= 2
+        assert z.recent_dm_keys[:2] == [key_b, key_a]
+        assert z.dm_key_label(key_b) == f"{a['full_name']} <{b['email']}>"
+    finally:
+        rename(b, old_name)
+    assert z.dm_key_label(key_b) == old_name
+
+def test_local_echo_recipients_carry_names(org):
+    z.apply_realm_state(z.client.register())
+    partner = org.users[-1]
+    echo = z.make_local_echo({'type': 'private', 'to': [partner['email']], 'content': 'hi'})
+    assert {u['email']: u['full_name'] for u in echo.display_recipient}[partner['email']] == partner['full_name']
+    live = z.Message.from_api(org.new_message(partner=len(org.users) - 1))
+    them = next(u for u in live.display_recipient if u['email'] == partner['email'])
+    assert them['full_name'] == partner['full_name'] and them['id'] == partner['user_id']
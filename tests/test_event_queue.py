@@ -0,0 +1,21 @@
+"""The event queue zulip_term registers, as the fake server sees it."""
+import zulip_term
+
+def test_message_events_carry_rendered_html(org):
+    queue_id, last_event_id = zulip_term.register_queue()
+    stream, topic = org.busiest_topic()
+    msg = org.new_message(stream, topic)
+    org.post_message_event(msg)
+    res = zulip_term.client.get_events(queue_id=queue_id, last_event_id=last_event_id)
+    event = next(e for e in res['events'] if e['type'] == 'message' and e['message']['id'] == msg['id'])
+    assert event['message']['content'] == org.content(msg['id'])
+    assert event['message']['avatar_url'] is None
+
+def test_fake_server_defaults_to_markdown(org):
+    client = zulip_term.client.__class__(org)
+    client.register(event_types=['message'])
+    stream, topic = org.busiest_topic()
+    msg = org.new_message(stream, topic)
+    org.post_message_event(msg)
+    event = client.get_events(last_event_id=-1)['events'][-1]
+    assert event['message']['content'] == org.content(msg['id'], markdown=True)
@@ -0,0 +1,54 @@
+"""
+ZulipHTMLConverter against the BeautifulSoup cleanup it replaced, on a corpus of typical Zulip
+message HTML (tests/fixtures/message_html.json, regenerated by benchmarks/bs4_reference.py).
+
+The old output collapsed everything onto one line and dropped code blocks, mentions and emoji
+along with their div/span tags, so the two can't match character for character. What must hold
+is that every word the old cleanup showed is still shown, in the same order; links are compared
+by their text, since the converter makes them OSC 8 hyperlinks instead of printing escapes.
+"""
+import json
+import os
+import re
+
+import pytest
+
+import zulip_term
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(HERE, 'fixtures', 'message_html.json')) as f:
+    CORPUS = json.load(f)
+
+OSC8_RE = re.compile(r'\x1b\]8;;[^\x1b]*\x1b\\.*?\x1b\]8;;\x1b\\')
+LINK_TARGET_RE = re.compile(r'\(\s*(?:(?:https?:|mailto:|/)[^)\s]*)?\s*\)|(?:https?|mailto):\S+')
+WORD_RE = re.compile(r'\w+')
+
+def words(text):
+    """The words of text, leaving out hyperlink escapes and printed link targets."""
+    return WORD_RE.findall(LINK_TARGET_RE.sub(' ', OSC8_RE.sub(' ', text)))
+
+def is_subsequence(needle, haystack):
+    it = iter(haystack)
+    return all(word in it for word in needle)
+
+@pytest.mark.parametrize('case', CORPUS, ids=[case['name'] for case in CORPUS])
+def test_keeps_everything_bs4_showed(case):
+    new = zulip_term.clean_message_html(case['html'])
+    assert is_subsequence(words(case['bs4']), words(new)), new
+
+@pytest.mark.parametrize('case', CORPUS, ids=[case['name'] for case in CORPUS])
+def test_plain_text_has_no_escapes(case):
+    assert '\x1b' not in zulip_term.clean_message_html(case['html'])
+
+def test_keeps_line_structure():
+    by_name = {case['name']: case['html'] for case in CORPUS}
+    assert zulip_term.clean_message_html(by_name['code_block']) == "def f():\n    return 1"
+    assert zulip_term.clean_message_html(by_name['lists']).splitlines() == ['• one', '• two', '  • nested', '1. a', '2. b']
+
+def test_tokenizer_edge_cases():
+    clean = zulip_term.clean_message_html
+    assert clean("<p>a < b and 1 &lt; 2 &amp;&amp; c</p>") == "a < b and 1 < 2 && c"
+    assert clean("<p>x <!-- hidden --> y<br/>z</p>") == "x y\nz"
+    assert clean('<P CLASS="x">Upper <img class=emoji alt=":x:" src=/a.png/></P>') == "Upper :x:"
+    assert clean('<p><a href="https://e.com/?a=1&amp;b=2" title=\'a>b\'>l</a></p>') == "l (https://e.com/?a=1&b=2)"
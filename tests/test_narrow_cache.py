@@ -0,0 +1,37 @@
+"""Parked narrows (the narrow cache) following live traffic while another narrow is open."""
+import zulip_term as z
+
+def open_context(stream=None, topic=None, dm=None, messages=()):
+    """Makes a narrow the open one, as load_all_messages would once its history was in, and keeps it fresh."""
+    z.chat_state.update(current_stream=stream, current_topic=topic, current_dm=dm)
+    z.park_open_view()
+    if not z.restore_view(z.current_context_key()):
+        z._show_history(z.to_messages(messages))
+    z.fresh_narrows.add(z.narrow_key(z.current_narrow()))
+
+def block_text(model, msg_id):
+    idx = model.block_index(msg_id)
+    end = model.starts[idx + 1] if idx + 1 < len(model.starts) else model.line_count
+    return "".join(text for line in model.lines[model.starts[idx]:end] for style, text in line)
+
+def test_parked_dm_renders_new_messages_as_a_dm(org):
+    z.apply_realm_state(z.client.register())
+    z.event_queue_alive.set()
+    partner = len(org.users) - 1
+    dm = org.users[partner]['email']
+    history = [org.new_message(partner=partner) for _ in range(3)]
+    stream, topic = org.busiest_topic()
+    open_context(dm=dm, messages=history)
+    open_context(stream, topic, messages=org.get_messages({'anchor': 'newest', 'num_before': 20, 'num_after': 0,
+                                                           'narrow': [{'operator': 'stream', 'operand': stream},
+                                                                      {'operator': 'topic', 'operand': topic}]})['messages'])
+    assert (None, None, dm) in z.parked_views
+    live = org.new_message(partner=partner)
+    z.global_event_handler({'type': 'message', 'id': 1, 'message': live, 'flags': []})
+    assert block_text(z.parked_views[(None, None, dm)].lines, live['id']).startswith("[DM] [")
+    open_context(dm=dm)
+    assert z.line_model.context == (None, None, dm)
+    assert live['id'] in z.msg_id_set
+    assert block_text(z.line_model, live['id']).startswith("[DM] [")
+    z.line_model.set_width(40)  # Re-wrapping renders again, now as the open narrow
+    assert block_text(z.line_model, live['id']).startswith("[DM] [")
@@ -0,0 +1,25 @@
+"""Messages in the open narrow are marked read when they're on screen, and only then."""
+import zulip_term as z
+
+from test_narrow_cache import open_context
+
+def topic_history(org, stream, topic, num=50):
+    return org.get_messages({'anchor': 'newest', 'num_before': num, 'num_after': 0,
+                             'narrow': [{'operator': 'stream', 'operand': stream},
+                                        {'operator': 'topic', 'operand': topic}]})['messages']
+
+def test_live_message_is_read_only_if_shown(org):
+    z.apply_realm_state(z.client.register())
+    z.event_queue_alive.set()
+    z.chat_view.update(width=80, height=20)
+    stream, topic = org.busiest_topic()
+    open_context(stream, topic, messages=topic_history(org, stream, topic))
+    z.force_scroll_to_bottom()
+    shown = org.new_message(stream, topic, sender=1)
+    z.global_event_handler({'type': 'message', 'id': 1, 'message': shown, 'flags': []})
+    assert shown['id'] not in z.unread_model.unread_in(z.current_context_key())
+    z.chat_scroll_pos_lines = z.line_model.line_count  # Scrolled up, past the top
+    z.read_shown_messages()
+    offscreen = org.new_message(stream, topic, sender=1)
+    z.global_event_handler({'type': 'message', 'id': 2, 'message': offscreen, 'flags': []})
+    assert offscreen['id'] in z.unread_model.unread_in(z.current_context_key())
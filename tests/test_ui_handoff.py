@@ -0,0 +1,57 @@
+"""Background threads hand UI state changes to the app's event loop (run_on_ui)."""
+import asyncio
+import threading
+
+import zulip_term as z
+
+class App:
+    """Just what run_on_ui and request_redraw use of a running prompt_toolkit Application."""
+    def __init__(self, loop):
+        self.loop = loop
+
+    def invalidate(self):
+        pass
+
+class ThreadRecordingDict(dict):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.writers = set()
+
+    def __setitem__(self, key, value):
+        self.writers.add(threading.current_thread())
+        super().__setitem__(key, value)
+
+def test_calls_before_the_loop_wait_for_it(monkeypatch):
+    calls = []
+    z.hold_ui_calls()
+    worker = threading.Thread(target=z.run_on_ui, args=(calls.append, 'worker'))
+    worker.start()
+    worker.join()
+    z.run_on_ui(calls.append, 'main')
+    assert calls == []
+
+    async def app_starts():
+        monkeypatch.setattr(z, 'ui_app', App(asyncio.get_running_loop()))
+        z.release_ui_calls()
+        z.run_on_ui(calls.append, 'running')
+        assert calls == ['running']
+        await asyncio.sleep(0)
+    asyncio.run(app_starts())
+    assert calls == ['running', 'worker', 'main']
+
+def test_topic_loader_files_topics_on_the_ui_thread(org, monkeypatch):
+    z.apply_realm_state(z.client.register())
+    for s in z.streams:
+        z.topic_loader.ensure(s)  # Background discovery is done with everything
+    stream, _ = org.busiest_topic()
+    cache = ThreadRecordingDict(z.topic_cache)
+    monkeypatch.setattr(z, 'topic_cache', cache)
+
+    async def refetch():
+        loop = asyncio.get_running_loop()
+        monkeypatch.setattr(z, 'ui_app', App(loop))
+        z.topic_loader.request(stream, refresh=True)
+        await loop.run_in_executor(None, z.topic_loader.done[stream].wait, 5)
+    asyncio.run(refetch())
+    assert cache[stream]
+    assert cache.writers == {threading.main_thread()}
@@ -4,10 +4,16 @@ import sys
 import threading
 import time
 import re
-from bs4 import BeautifulSoup, NavigableString
+import html
+import itertools
+import math
+import json
+import sqlite3
+import heapq
+import configparser
 from prompt_toolkit.application import Application
 from prompt_toolkit.layout import HSplit, VSplit, Window, Layout, Dimension, ConditionalContainer
-from prompt_toolkit.layout.controls import FormattedTextControl, BufferControl
+from prompt_toolkit.layout.controls import FormattedTextControl, BufferControl, UIControl, UIContent
 from prompt_toolkit.buffer import Buffer
 from prompt_toolkit.styles import Style
 from prompt_toolkit.widgets import Frame
@@ -16,10 +22,79 @@ from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.application.current import get_app
 from prompt_toolkit.filters import Condition
+from prompt_toolkit.utils import get_cwidth
 from datetime import datetime
 from textwrap import indent
 import functools
+import asyncio
+import bisect
+import atexit
 import concurrent.futures
+import multiprocessing
+from collections import OrderedDict, deque
+
+# -- Section: Instrumentation --
+# Always on, so it has to be cheap: a timed call costs two perf_counter() reads and a bucket
+# increment. Histograms are fed from several threads without a lock; a count lost to a race
+# now and then doesn't matter here.
+class Histogram:
+    """Latency histogram with power-of-two buckets from 1µs up (the last one catches everything slower)."""
+    __slots__ = ('counts', 'count', 'total', 'max')
+    BUCKETS = 32  # 2**31µs is about 36 minutes
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, in seconds (never above the max seen)."""
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """Count and mean/p50/p90/p99/max in milliseconds."""
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {'count': self.count, 'mean_ms': ms(self.total / self.count) if self.count else 0,
+                'p50_ms': ms(self.percentile(50)), 'p90_ms': ms(self.percentile(90)),
+                'p99_ms': ms(self.percentile(99)), 'max_ms': ms(self.max)}
+
+timings = {}  # Name -> Histogram, e.g. 'render.chat' or 'api.get_messages'
+
+def timing(name):
+    """The histogram called name, created on first use."""
+    hist = timings.get(name)
+    if hist is None:
+        hist = timings.setdefault(name, Histogram())
+    return hist
+
+def timed(name):
+    """Decorator: records every call's duration in the histogram called name."""
+    def wrap(fn):
+        hist = timing(name)
+
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.add(time.perf_counter() - start)
+        return timed_fn
+    return wrap
 
 # -- Section: Context bar rendering --
 
@@ -27,16 +102,16 @@ def get_context_bar_lines():
     """
     Renders the context bar at the top of the chat window, showing which stream/topic/DM is active.
     """
+    loading = [('class:pending', "  (loading…)")] if narrow_tasks else []
     if chat_state['current_dm']:
-        target = [u['full_name'] for u in users if u['email'] == chat_state['current_dm']]
-        name = target[0] if target else chat_state['current_dm']
-        return [('', f"Direct Message: {name}")]
+        name = dm_key_label(chat_state['current_dm'])
+        return [('', f"Direct Message: {name}")] + loading
     elif chat_state['current_stream'] and chat_state['current_topic']:
-        return [('', f"{chat_state['current_stream']} > {chat_state['current_topic']}")]
+        return [('', f"{chat_state['current_stream']} > {chat_state['current_topic']}")] + loading
     elif chat_state['current_stream']:
-        return [('', f"{chat_state['current_stream']} (all topics)")]
+        return [('', f"{chat_state['current_stream']} (all topics)")] + loading
     else:
-        return [('', 'No stream or DM selected')]
+        return [('', 'No stream or DM selected')] + loading
 
 def zulip_time(ts):
     """Convert Zulip timestamps to a human-readable string. Returns '' if parsing fails."""
@@ -46,71 +121,584 @@ def zulip_time(ts):
     except Exception:
         return ""
 
-def render_msg_line(msg):
+# -- Section: Message records --
+# Loaded messages are slotted records holding just the fields the client reads, not the API's
+# dicts (avatar URLs, flags, ...). Sender, stream and topic strings are interned and a DM's
+# recipient list is shared between its messages, so a long history costs little beyond its text.
+DM_RECIPIENTS_MAX = 2000  # Distinct DM recipient lists shared at once; older ones are just no longer shared
+_dm_recipients = OrderedDict()  # Recipients as (email, name, id) triples -> the one shared tuple of dicts, in LRU order
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _shared_recipients(value):
+    """A stream name (interned), or a DM's recipients as a shared tuple of {'email', 'full_name', 'id'} dicts."""
+    if value is None or isinstance(value, str):
+        return _intern(value)
+    key = tuple((u['email'], u.get('full_name', ''), u.get('id')) for u in value)
+    shared = _dm_recipients.get(key)
+    if shared is None:
+        shared = _dm_recipients[key] = tuple(
+            {'email': sys.intern(email), 'full_name': _intern(name), 'id': user_id} for email, name, user_id in key)
+        if len(_dm_recipients) > DM_RECIPIENTS_MAX:
+            _dm_recipients.popitem(last=False)
+    else:
+        _dm_recipients.move_to_end(key)
+    return shared
+
+def _reaction_pairs(reactions):
+    """(emoji name, user id) for each of the API's reaction dicts; the empty tuple when there are none."""
+    if not reactions:
+        return ()
+    return tuple((sys.intern(r['emoji_name']), r['user_id'] if 'user_id' in r else r.get('user', {}).get('id'))
+                 for r in reactions)
+
+class Message:
+    """A loaded message. id is None while a local echo waits for the server (local_id is set on echoes)."""
+    __slots__ = ('id', 'sender_full_name', 'sender_email', 'timestamp', 'content', 'subject',
+                 'display_recipient', 'type', 'last_edit_timestamp', 'local_id', 'local_status', 'reactions')
+
+    def __init__(self, id, sender_full_name, sender_email, timestamp, content, subject, display_recipient,
+                 type, last_edit_timestamp=None, local_id=None, local_status=None, reactions=()):
+        self.id = id
+        self.sender_full_name = _intern(sender_full_name)
+        self.sender_email = _intern(sender_email)
+        self.timestamp = timestamp
+        self.content = content
+        self.subject = _intern(subject)
+        self.display_recipient = _shared_recipients(display_recipient)
+        self.type = _intern(type)
+        self.last_edit_timestamp = last_edit_timestamp
+        self.local_id = local_id
+        self.local_status = local_status
+        self.reactions = reactions  # (emoji name, user id) pairs, in the order they were added
+
+    @classmethod
+    def from_api(cls, d):
+        """Builds a record from a message dict as the API (or the local store) returns it."""
+        return cls(d['id'], d.get('sender_full_name', ''), d.get('sender_email', ''), d.get('timestamp', 0),
+                   d.get('content', ''), d.get('subject', ''), d.get('display_recipient'), d.get('type', 'stream'),
+                   d.get('last_edit_timestamp'), reactions=_reaction_pairs(d.get('reactions')))
+
+    def to_api(self):
+        """The record as an API-style dict (for the local store)."""
+        d = {name: getattr(self, name) for name in self.__slots__ if name not in ('local_id', 'local_status')}
+        if isinstance(self.display_recipient, tuple):
+            d['display_recipient'] = list(self.display_recipient)
+        d['reactions'] = [{'emoji_name': name, 'user_id': user_id} for name, user_id in self.reactions]
+        return d
+
+    def replace(self, **changes):
+        """A copy of the record with some fields changed."""
+        new = Message.__new__(Message)
+        for name in self.__slots__:
+            setattr(new, name, changes[name] if name in changes else getattr(self, name))
+        return new
+
+class SystemNotice:
+    """A client-side notice shown in the chat (errors, status). Sorts before every message."""
+    __slots__ = ('content',)
+    id = -1
+    local_status = None
+
+    def __init__(self, content):
+        self.content = content
+
+def to_messages(dicts):
+    """Message records for API message dicts."""
+    return [Message.from_api(d) for d in dicts]
+
+# -- Section: Render cache --
+RENDER_CACHE_MAX = 5000  # Max number of rendered messages kept in memory
+render_cache = OrderedDict()  # (msg id, context tag, fingerprint) -> rendered (style, text) list, in LRU order
+render_cache_stats = {'hits': 0, 'misses': 0}
+
+def _render_fingerprint(msg):
+    """Fingerprint of everything in a message that shows up in its rendered form (edits change it)."""
+    return hash((msg.content, msg.last_edit_timestamp, msg.sender_full_name, msg.timestamp, msg.subject, msg.local_status,
+                 msg.reactions))
+
+def clear_render_cache():
+    """Drops every cached render and resets the hit/miss counters."""
+    render_cache.clear()
+    render_cache_stats['hits'] = 0
+    render_cache_stats['misses'] = 0
+
+def render_msg_line(msg, context=None):
     """
     Render a single Zulip message as a list of (style, text) tuples for the chat window.
-    Handles system messages, DMs, and stream messages.
+    Handles system messages, DMs, and stream messages. context is the chat context (see
+    current_context_key) it's shown in, the open one by default.
+    Real messages are served from the render cache; the returned list is shared, so don't mutate it.
     """
-    if msg.get('id', None) == -1:
-        return [('', f"[System]: {msg.get('content', '')}\n"), ('', '\n')]
-    if chat_state['current_dm']:
-        context_tag = "[DM]"
-    else:
-        topic = msg.get('subject') or chat_state.get('current_topic') or "unknown"
-        context_tag = f"[{msg.get('display_recipient', chat_state.get('current_stream', ''))}-{topic}]"
-    sender = msg['sender_full_name']
-    tstamp = zulip_time(msg['timestamp'])
+    if isinstance(msg, SystemNotice):
+        return [('', f"[System]: {msg.content}\n"), ('', '\n')]
+    return render_cached(msg, context_tag(msg, context or current_context_key()))
+
+def context_tag(msg, context):
+    """Where a message was sent, as its header shows it in context: [stream-topic], or [DM]."""
+    stream, topic, dm = context
+    if dm:
+        return "[DM]"
+    return f"[{msg.display_recipient or stream or ''}-{msg.subject or topic or 'unknown'}]"
+
+def chat_context_tag(msg):
+    """context_tag in the open chat context."""
+    return context_tag(msg, current_context_key())
+
+def is_render_cached(msg, context_tag):
+    return (msg.id, context_tag, _render_fingerprint(msg)) in render_cache
+
+def render_cached(msg, context_tag):
+    """msg rendered with context_tag in its header, from the render cache when it's there."""
+    key = (msg.id, context_tag, _render_fingerprint(msg))
+    lines = render_cache.get(key)
+    if lines is not None:
+        render_cache.move_to_end(key)
+        render_cache_stats['hits'] += 1
+        return lines
+    render_cache_stats['misses'] += 1
+    lines = _render_msg_uncached(msg, context_tag)
+    render_cache[key] = lines
+    if len(render_cache) > RENDER_CACHE_MAX:
+        render_cache.popitem(last=False)
+    return lines
+
+@timed('render.message')
+def _render_msg_uncached(msg, context_tag):
+    """Does the actual HTML cleanup and formatting for render_msg_line."""
+    sender = msg.sender_full_name
+    tstamp = zulip_time(msg.timestamp)
     color_class = username_color_class(sender)
     head = f"{context_tag} [{sender}] ".ljust(38)
     head += "--------------------- "
-    head += f"[{tstamp}]"
-    lines = [(f"class:{color_class}", head + "\n")]
-    body = clean_message_html(msg['content'])
-    for line in body.splitlines() or ['']:
-        lines.append(('', f"    {line}\n"))
+    local_status = msg.local_status
+    if local_status:
+        # Local echo: not confirmed by the server (yet)
+        head += "[sending…]" if local_status == 'sending' else "[failed to send]"
+        lines = [(f"class:{color_class} class:pending", head + "\n")]
+    else:
+        head += f"[{tstamp}]"
+        lines = [(f"class:{color_class}", head + "\n")]
+    content_lines = prerendered_html.pop(msg.content, None)
+    if content_lines is None:
+        content_lines = html_to_lines(msg.content)
+    for line in content_lines or [[]]:
+        lines.append(('', "    "))
+        lines.extend(line)
+        lines.append(('', "\n"))
+    if msg.reactions:
+        lines.append(('', "    "))
+        lines.extend(reaction_fragments(msg.reactions))
+        lines.append(('', "\n"))
     lines.append(('', '\n'))
     return lines
 
+def reaction_fragments(reactions):
+    """The reaction line under a message: each emoji once with its count, ours highlighted."""
+    me = user_directory.get(client.email) or {}
+    counts = {}
+    for name, user_id in reactions:
+        count, mine = counts.get(name, (0, False))
+        counts[name] = (count + 1, mine or user_id == me.get('user_id'))
+    out = []
+    for name, (count, mine) in counts.items():
+        out.append(('class:reaction-mine' if mine else 'class:reaction', f":{name}: {count}"))
+        out.append(('', "  "))
+    return out[:-1]
+
+# -- Section: Chat line model --
+NO_MESSAGES_LINES = [[('', '[No messages to display]\n')], [('', '\n')]]
+
+def split_lines(fragments):
+    """Groups (style, text) fragments into physical lines, each a list of fragments."""
+    lines = []
+    cur = []
+    for style, text in fragments:
+        for part in text.splitlines(True):
+            cur.append((style, part))
+            if part.endswith('\n'):
+                lines.append(cur)
+                cur = []
+    if cur:
+        lines.append(cur)
+    return lines
+
+def join_lines(lines):
+    """Inverse of split_lines: flattens physical lines back into one fragment list."""
+    return [frag for line in lines for frag in line]
+
+def fragment_cells(style, text):
+    """Terminal cells a fragment takes up (a trailing newline takes none)."""
+    if ZERO_WIDTH in style:
+        return 0
+    if text.isascii():
+        return len(text) - text.endswith('\n')
+    return get_cwidth(text)
+
+def _fit_cells(text, room):
+    """How many leading characters of text fit in room cells, and the cells they take."""
+    if text.isascii():
+        n = min(len(text), room)
+        return n, n
+    cells = 0
+    for n, ch in enumerate(text):
+        w = get_cwidth(ch)
+        if cells + w > room:
+            return n, cells
+        cells += w
+    return len(text), cells
+
+def wrap_line(line, width):
+    """
+    Splits one physical line into rows of at most width cells, each ending in a newline like
+    split_lines' output. Breaks anywhere, the way Window(wrap_lines=True) does.
+    """
+    if sum(fragment_cells(style, text) for style, text in line) <= width:
+        return [line]
+    rows, row, used = [], [], 0
+    for style, text in line:
+        if ZERO_WIDTH in style:
+            row.append((style, text))
+            continue
+        text = text.rstrip('\n')
+        while text:
+            n, cells = _fit_cells(text, width - used)
+            if not n:
+                if used:
+                    rows.append(row + [('', '\n')])
+                    row, used = [], 0
+                    continue
+                n, cells = 1, get_cwidth(text[0])  # A character wider than the whole row
+            row.append((style, text[:n]))
+            used += cells
+            text = text[n:]
+    rows.append(row + [('', '\n')])
+    return rows
+
+def wrap_lines(lines, width):
+    """wrap_line over a list of physical lines; a width of None leaves them as they are."""
+    if not width:
+        return lines
+    return [row for line in lines for row in wrap_line(line, width)]
+
+model_generations = itertools.count(1)
+
+class ChatLineModel:
+    """
+    Persistent, flattened physical lines for everything in msg_history, kept in message id order.
+    Each message is one block of lines. New messages append, older history prepends and
+    system notices (id -1) slot in after the notices before them, so nothing is re-rendered
+    wholesale and line counts / block offsets are always at hand. Once the chat pane has a
+    width (see set_width) lines are wrapped to it, so one line is one row on screen.
+    """
+    def __init__(self, render=render_msg_line):
+        self.lock = threading.RLock()
+        self.render = render  # Message -> (style, text) fragments
+        self.width = None     # Cells to wrap lines at, None to leave them unwrapped
+        self.version = 0      # Bumped on every change to the lines, so the chat pane can reuse its last frame
+        self.reset()
+
+    def reset(self, context=None):
+        """Empties the model. context is the chat context the lines were rendered for."""
+        with self.lock:
+            self.lines = []    # Physical lines, each a list of (style, text) fragments
+            self.keys = []     # Sort key (message id) of each block
+            self.tokens = []   # Identity of each block (see message_token)
+            self.starts = []   # Offset into self.lines where each block starts
+            self.messages = [] # The message each block was rendered from, for re-wrapping
+            self.context = context
+            self.generation = next(model_generations)  # Lets late arrivals (see render_in_background) spot a reset
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+
+    @property
+    def line_count(self):
+        return len(self.lines)
+
+    @property
+    def block_count(self):
+        return len(self.keys)
+
+    def last_message_id(self):
+        """Highest real message id in the model, or -1 if there are none."""
+        for key in reversed(self.keys):
+            if key != PENDING_SORT_KEY:
+                return key
+        return -1
+
+    def last_block_start(self):
+        """Offset of the first line of the last block, or None if there are no blocks."""
+        return self.starts[-1] if self.starts else None
+
+    @timed('render.rebuild')
+    def rebuild(self, messages, context=None):
+        """Throws everything away and renders messages from scratch (narrow switch, search, etc)."""
+        with self.lock:
+            self.reset(context)
+            self.add_messages(messages)
+
+    def add_messages(self, messages):
+        """
+        Inserts messages at their sorted position. Runs of messages that all land at the same
+        spot (the usual append-at-bottom or prepend-older-history cases) go in as one splice.
+        Returns the number of physical lines added.
+        """
+        with self.lock:
+            before = len(self.lines)
+            batch = sorted(messages, key=message_sort_key)
+            i = 0
+            while i < len(batch):
+                idx = bisect.bisect_right(self.keys, message_sort_key(batch[i]))
+                limit = self.keys[idx] if idx < len(self.keys) else None
+                j = i + 1
+                while j < len(batch) and (limit is None or message_sort_key(batch[j]) < limit):
+                    j += 1
+                self._insert_blocks(idx, batch[i:j])
+                i = j
+            return len(self.lines) - before
+
+    def insert_messages(self, messages, scroll):
+        """
+        add_messages for a view scrolled scroll lines up from the bottom. Returns scroll adjusted
+        for whatever went in below the view, so the lines on screen stay put.
+        """
+        with self.lock:
+            if not scroll or not self.keys:
+                self.add_messages(messages)
+                return scroll
+            idx = max(0, bisect.bisect_right(self.starts, len(self.lines) - scroll) - 1)
+            edge = self.keys[idx]  # The block at the bottom edge of the view
+            self.add_messages([m for m in messages if message_sort_key(m) <= edge])
+            return scroll + self.add_messages([m for m in messages if message_sort_key(m) > edge])
+
+    def set_width(self, width, scroll=0):
+        """
+        Re-wraps every block to width cells, if that's not what they're wrapped to already. scroll
+        is the view's position in lines from the bottom; returns it adjusted so that the same part
+        of the same message stays at the bottom of the view.
+        """
+        with self.lock:
+            if width == self.width:
+                return scroll
+            anchor = None
+            if scroll and self.keys:
+                pos = len(self.lines) - scroll
+                idx = max(0, bisect.bisect_right(self.starts, pos) - 1)
+                end = self.starts[idx + 1] if idx + 1 < len(self.starts) else len(self.lines)
+                anchor = (idx, (pos - self.starts[idx]) / max(1, end - self.starts[idx]))
+            self.width = width
+            self._changed()
+            self.lines, self.starts = [], []
+            for msg in self.messages:
+                self.starts.append(len(self.lines))
+                self.lines.extend(self._render_lines(msg))
+            if anchor is None:
+                return scroll
+            idx, frac = anchor
+            end = self.starts[idx + 1] if idx + 1 < len(self.starts) else len(self.lines)
+            return max(0, len(self.lines) - self.starts[idx] - round(frac * (end - self.starts[idx])))
+
+    def _render_lines(self, msg):
+        return wrap_lines(split_lines(self.render(msg)), self.width)
+
+    def _insert_blocks(self, idx, messages):
+        self._changed()
+        start = self.starts[idx] if idx < len(self.starts) else len(self.lines)
+        new_lines, new_keys, new_tokens, new_starts = [], [], [], []
+        for msg in messages:
+            new_keys.append(message_sort_key(msg))
+            new_tokens.append(message_token(msg))
+            new_starts.append(start + len(new_lines))
+            new_lines.extend(self._render_lines(msg))
+        self.lines[start:start] = new_lines
+        self.keys[idx:idx] = new_keys
+        self.tokens[idx:idx] = new_tokens
+        self.messages[idx:idx] = messages
+        shift = len(new_lines)
+        if shift:
+            for k in range(idx, len(self.starts)):
+                self.starts[k] += shift
+        self.starts[idx:idx] = new_starts
+
+    def block_index(self, token):
+        """Index of the block for the message identified by token (see message_token), or None."""
+        if isinstance(token, int):
+            idx = bisect.bisect_left(self.keys, token)
+            return idx if idx < len(self.keys) and self.tokens[idx] == token else None
+        for idx in range(len(self.tokens) - 1, -1, -1):
+            if self.tokens[idx] == token:
+                return idx
+        return None
+
+    def remove_message(self, token):
+        """
+        Removes the block for the message identified by token (see message_token).
+        Returns the number of physical lines removed (0 if it wasn't there).
+        """
+        with self.lock:
+            idx = self.block_index(token)
+            if idx is None:
+                return 0
+            self._changed()
+            start = self.starts[idx]
+            end = self.starts[idx + 1] if idx + 1 < len(self.starts) else len(self.lines)
+            del self.lines[start:end]
+            del self.keys[idx], self.tokens[idx], self.starts[idx], self.messages[idx]
+            for k in range(idx, len(self.starts)):
+                self.starts[k] -= end - start
+            return end - start
+
+    def replace_messages(self, changes, scroll=0):
+        """
+        Re-renders the blocks of changed messages in place (changes maps message id to the new
+        record, or to None to remove it); everything else is left alone. scroll is the view's
+        position in lines from the bottom. Returns it adjusted for blocks below the view changing
+        size, so the lines on screen stay put.
+        """
+        with self.lock:
+            for msg_id, msg in sorted(changes.items(), key=lambda kv: kv[0], reverse=True):
+                idx = self.block_index(msg_id)
+                if idx is None:
+                    continue
+                self._changed()
+                start = self.starts[idx]
+                end = self.starts[idx + 1] if idx + 1 < len(self.starts) else len(self.lines)
+                below_view = start >= len(self.lines) - scroll
+                new_lines = self._render_lines(msg) if msg is not None else []
+                self.lines[start:end] = new_lines
+                if msg is None:
+                    del self.keys[idx], self.tokens[idx], self.starts[idx], self.messages[idx]
+                else:
+                    self.messages[idx] = msg
+                    idx += 1
+                shift = len(new_lines) - (end - start)
+                if shift:
+                    for k in range(idx, len(self.starts)):
+                        self.starts[k] += shift
+                    if below_view:
+                        scroll = max(0, scroll + shift)
+            return scroll
+
+    def remove_blocks(self, lo, hi):
+        """Removes blocks lo..hi-1 in one splice. Returns the number of physical lines removed."""
+        with self.lock:
+            if lo >= hi:
+                return 0
+            self._changed()
+            start = self.starts[lo]
+            end = self.starts[hi] if hi < len(self.starts) else len(self.lines)
+            del self.lines[start:end]
+            del self.keys[lo:hi], self.tokens[lo:hi], self.starts[lo:hi], self.messages[lo:hi]
+            for k in range(lo, len(self.starts)):
+                self.starts[k] -= end - start
+            return end - start
+
+    def slice(self, start, end):
+        """Returns lines[start:end], falling back to the placeholder when there's no history."""
+        with self.lock:
+            lines = self.lines if self.lines else NO_MESSAGES_LINES
+            return lines[start:end]
+
+line_model = ChatLineModel()
+
+PENDING_SORT_KEY = math.inf  # Locally echoed messages sort after everything the server has confirmed
+
+def message_sort_key(msg):
+    """Position of a message in the chat: by id, with system notices (-1) first and pending echoes last."""
+    return PENDING_SORT_KEY if msg.id is None else msg.id
+
+def message_token(msg):
+    """Identity of a message's block in the line model: its id, or its local_id while it's pending."""
+    if msg.id is None:
+        return ('local', msg.local_id)
+    return None if msg.id == -1 else msg.id
+
+def current_context_key():
+    """Identifies the active chat context; the line model is rebuilt whenever it changes."""
+    return (chat_state['current_stream'], chat_state['current_topic'], chat_state['current_dm'])
+
+def sync_line_model():
+    """Rebuilds the line model if the chat context changed without a reload (e.g. /help)."""
+    if line_model.context != current_context_key():
+        line_model.rebuild(msg_history, current_context_key())
+
 def threaded_message_lines():
     """
     Returns all messages for the currently selected thread/DM as a list of (style, text) tuples.
     """
-    real_msgs = [m for m in msg_history if isinstance(m, dict) and 'id' in m]
-    real_msgs.sort(key=lambda m: m['id'])
-    lines = []
-    for msg in real_msgs:
-        lines += render_msg_line(msg)
-    return lines if lines else [('', '[No messages to display]\n'), ('', '\n')]
+    sync_line_model()
+    return join_lines(line_model.slice(0, None))
 
-def render_visible_messages():
+def context_bar_lines():
+    """The context bar as physical lines, wrapped like the line model's."""
+    return wrap_lines(split_lines(get_context_bar_lines()), line_model.width)
+
+def chat_line_count():
+    """Total physical lines in the chat pane (context bar + messages), without building them."""
+    sync_line_model()
+    head = len(context_bar_lines())
+    return head + (line_model.line_count or len(NO_MESSAGES_LINES))
+
+@timed('render.chat')
+def render_visible_lines(width=None):
     """
-    Returns the lines currently visible in the chat window, factoring in scrolling and context bar.
+    Returns the lines currently visible in the chat window, factoring in scrolling and context bar,
+    wrapped to width cells (by default the chat pane's width as of the last frame). Only the
+    visible slice of the line model is copied, so this costs O(window), not O(history).
     """
+    global chat_scroll_pos_lines
+    width = width or chat_view['width']
+    if stats_panel['open']:
+        return wrap_lines(split_lines(render_stats_panel()), width)
+    if search_view.active:
+        return search_view.visible(width)
     if show_help_screen and not (chat_state.get('current_dm') or chat_state.get('current_stream')):
-        return get_help_screen_lines()
-    lines = get_context_bar_lines() + threaded_message_lines()
-    flat_lines = []
-    for style, text in lines:
-        for part in text.splitlines(True):
-            flat_lines.append((style, part))
+        return wrap_lines(split_lines(get_help_screen_lines()), width)
+    sync_line_model()
+    chat_scroll_pos_lines = line_model.set_width(width, chat_scroll_pos_lines)
+    return visible_lines(line_model, chat_scroll_pos_lines, context_bar_lines())
+
+def render_visible_messages():
+    """render_visible_lines as one list of (style, text) fragments."""
+    return join_lines(render_visible_lines())
+
+def visible_span(model, scroll, head):
+    """
+    (start, end) of the lines visible_lines shows, counting head context bar lines before the
+    model's; end is None for "through the last line".
+    """
+    with model.lock:
+        total_lines = head + (model.line_count or len(NO_MESSAGES_LINES))
+        last_start = model.last_block_start()
+        if last_start is None and not model.lines:
+            last_start = 0  # The placeholder line is the only block
     window_size = get_dynamic_visible_window()
-    total_lines = len(flat_lines)
-    if chat_scroll_pos_lines == 0:
+    if scroll == 0:
         # Start from the last full message block, ensuring the latest is visible
-        msg_starts = [i for i, (style, text) in enumerate(flat_lines) if text.startswith('[System]:') or text.startswith('[')]
-        if msg_starts:
-            start_idx = msg_starts[-1] if msg_starts[-1] < total_lines else max(0, total_lines - window_size)
+        if last_start is not None:
+            start_idx = head + last_start
         else:
             start_idx = max(0, total_lines - window_size)
-        visible = flat_lines[start_idx:] if start_idx < total_lines else flat_lines[max(0, total_lines - window_size):]
-    else:
-        start = max(0, total_lines - window_size - chat_scroll_pos_lines)
-        end = total_lines - chat_scroll_pos_lines
-        visible = flat_lines[start:end] if start < end else flat_lines[max(0, total_lines - window_size):]
-    if not visible or visible[-1][1].strip() != "":
-        visible.append(("", "\n"))
-    #print(f"Rendered lines: {len(visible)}, Window size: {window_size}, Total lines: {total_lines}, Start idx: {start_idx if 'start_idx' in locals() else 'N/A'}")  # Enhanced debug
-    return visible if visible else [('', '[No messages to display]\n'), ('', '\n')]
+        return (start_idx, None) if start_idx < total_lines else (max(0, total_lines - window_size), None)
+    start = max(0, total_lines - window_size - scroll)
+    end = total_lines - scroll
+    return (start, end) if start < end else (max(0, total_lines - window_size), None)
+
+def visible_lines(model, scroll, head_lines):
+    """
+    The physical lines of head_lines followed by model that fit in the chat window, scrolled
+    scroll lines up from the bottom.
+    """
+    head = len(head_lines)
+    start, end = visible_span(model, scroll, head)
+    visible = head_lines[start:end] if start < head else []
+    visible += model.slice(max(0, start - head), None if end is None else max(0, end - head))
+    if not visible or "".join(text for _, text in visible[-1]).strip() != "":
+        visible.append([("", "\n")])
+    return visible
 
 # -- Section: Global state and configuration --
 chat_scroll_pos_lines = 0  # 0 means bottom, N means scrolled up N lines
@@ -127,7 +715,7 @@ def update_recent_dms(dm_key):
     del recent_dm_keys[5:]
 
 # -- Section: Dependency check and config --
-REQUIRED_PACKAGES = ['zulip', 'prompt_toolkit', 'bs4']
+REQUIRED_PACKAGES = ['zulip', 'prompt_toolkit']
 def check_and_install_packages():
     """
     Checks for required Python packages and prompts to install them if missing.
@@ -136,7 +724,7 @@ def check_and_install_packages():
     missing = []
     for pkg in REQUIRED_PACKAGES:
         try:
-            __import__(pkg if pkg != 'bs4' else 'bs4')
+            __import__(pkg)
         except ImportError:
             missing.append(pkg)
     if missing:
@@ -169,13 +757,160 @@ if not os.path.exists(CONFIG):
     print("Config file created. Please restart the script.")
     sys.exit(0)
 
+def read_setting(name, default):
+    """
+    Reads an optional client setting from the [zulip_term] section of ~/.zuliprc,
+    converted to the type of default. Falls back to default if it's missing or malformed.
+    """
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(CONFIG)
+        value = parser.get('zulip_term', name)
+    except (configparser.Error, OSError):
+        return default
+    try:
+        return type(default)(value)
+    except ValueError:
+        return default
+
 # -- Section: Zulip client setup --
-client = zulip.Client(config_file=CONFIG)
-try:
-    profile = client.get_profile()
-    client.email = profile.get('email', '') if profile and 'email' in profile else ''
-except Exception:
-    client.email = ''
+client = zulip.Client(config_file=CONFIG)  # Only asks for the server's settings; the realm bootstrap does the rest
+
+# -- Section: Async data layer --
+# Nothing talks to the server from the UI's event loop. AsyncZulip turns the blocking
+# zulip.Client calls (which share its pooled keep-alive requests session) into awaitables run on
+# a small thread pool. Coroutines started with spawn() await them and then change chat state on
+# the event loop, the one place chat state changes; background threads hand over with run_on_ui().
+API_WORKERS = read_setting('api_workers', 4)  # Concurrent API requests
+api_errors = {}  # Endpoint -> failed calls
+
+def api_call(name, *args, **kwargs):
+    """
+    Calls client.<name>(*args, **kwargs), blocking, and records its latency as 'api.<endpoint>'
+    (call_endpoint calls are named after their URL). Failures are counted in api_errors.
+    """
+    endpoint = args[0] if name == 'call_endpoint' and args else kwargs.get('url', name)
+    start = time.perf_counter()
+    ok = False
+    try:
+        res = getattr(client, name)(*args, **kwargs)
+        ok = not isinstance(res, dict) or res.get('result') != 'error'
+        return res
+    finally:
+        timing(f"api.{endpoint}").add(time.perf_counter() - start)
+        if not ok:
+            api_errors[endpoint] = api_errors.get(endpoint, 0) + 1
+
+class AsyncZulip:
+    """
+    Awaitable facade over zulip.Client. Failures come back as Zulip-style error results rather
+    than exceptions. Sends go through their own single worker, so they reach the server in order.
+    """
+    def __init__(self, workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zulip-api')
+        self.send_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='zulip-send')
+
+    async def call(self, name, *args, executor=None, **kwargs):
+        """Runs client.<name>(*args, **kwargs) on the pool and returns its result dict."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor or self.executor, functools.partial(api_call, name, *args, **kwargs))
+        except Exception as e:
+            return {'result': 'error', 'msg': str(e)}
+
+    async def get_messages(self, request):
+        return await self.call('get_messages', request)
+
+    async def send_message(self, request):
+        return await self.call('send_message', request, executor=self.send_executor)
+
+async_client = AsyncZulip(API_WORKERS)
+narrow_tasks = set()  # Requests for the open narrow: shown as loading, cancelled when the narrow changes
+
+def ui_loop():
+    """The running UI event loop, or None when the app isn't up."""
+    loop = getattr(ui_app, 'loop', None)
+    return loop if loop is not None and not loop.is_closed() else None
+
+def _on_loop(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+ui_backlog = {'held': False, 'calls': []}  # run_on_ui calls made while the app is starting up
+ui_backlog_lock = threading.Lock()
+
+def hold_ui_calls():
+    """
+    From now until the app's loop runs (see release_ui_calls), run_on_ui queues its calls
+    instead of running them on whichever thread made them.
+    """
+    with ui_backlog_lock:
+        ui_backlog['held'] = True
+
+def release_ui_calls():
+    """Application pre_run hook: hands the calls queued meanwhile to the now running loop, in order."""
+    loop = asyncio.get_running_loop()
+    with ui_backlog_lock:
+        for fn, args in ui_backlog['calls']:
+            loop.call_soon(fn, *args)
+        ui_backlog.update(held=False, calls=[])
+
+def run_on_ui(fn, *args):
+    """
+    Runs fn(*args) on the UI event loop: directly if we're already on it, queued if the app is
+    still starting (see hold_ui_calls), and directly when there's no app at all (scripted use).
+    """
+    with ui_backlog_lock:
+        if ui_backlog['held']:
+            ui_backlog['calls'].append((fn, args))
+            return
+    loop = ui_loop()
+    if loop is None or _on_loop(loop):
+        fn(*args)
+    else:
+        loop.call_soon_threadsafe(fn, *args)
+
+async def _guarded(coro):
+    try:
+        await coro
+    except Exception as e:
+        print_system(f"(Request failed: {e})")
+
+def _narrow_task_done(task):
+    narrow_tasks.discard(task)
+    request_redraw('chat')
+
+def spawn(coro, narrow_bound=True):
+    """
+    Starts coro as a task on the UI event loop; safe from any thread. narrow_bound tasks drive the
+    loading indicator and are cancelled by cancel_narrow_tasks(). With no event loop at all
+    (scripted use), coro simply runs to completion before spawn returns.
+    """
+    loop = ui_loop()
+    if loop is None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(_guarded(coro))
+            return None
+    if not _on_loop(loop):
+        loop.call_soon_threadsafe(spawn, coro, narrow_bound)
+        return None
+    task = loop.create_task(_guarded(coro))
+    task.add_done_callback(lambda _: coro.close())  # A task cancelled before it ran never started coro
+    if narrow_bound:
+        narrow_tasks.add(task)
+        task.add_done_callback(_narrow_task_done)
+        request_redraw('chat')
+    return task
+
+def cancel_narrow_tasks():
+    """Cancels everything still loading for the narrow we're leaving."""
+    for task in list(narrow_tasks):
+        task.cancel()
+    narrow_tasks.clear()
 
 # -- Section: More global state --
 stop_event = threading.Event()  # Used to signal threads to stop
@@ -183,142 +918,1235 @@ chat_state = {'current_stream': None, 'current_topic': None, 'current_dm': None}
 msg_history = []        # All loaded messages for current context
 msg_id_set = set()      # Set of message IDs in msg_history (for deduplication)
 earliest_msg_id = None  # The earliest message loaded (for lazy loading)
-unread_tracker = {}     # Maps convo key to unread count (for notifications)
 
-# -- Section: Utility functions for conversation keys, users, and topics --
-def _get_stream_topic_key(stream, topic):
-    """Returns a unique key for a stream+topic combo for unread tracking."""
-    return f"stream:{stream}:{topic}"
+# -- Section: Local message store --
+STORE_DIR = os.path.expanduser("~/.zulip_term")
+GAP_FETCH_LIMIT = 200  # Max messages fetched to close the gap after a cached range; beyond that, reload
+
+def narrow_key(narrow):
+    """Stable string key for a narrow (list of operator/operand dicts)."""
+    return json.dumps([[n['operator'], n['operand']] for n in narrow])
+
+def covering_narrow_keys(narrow):
+    """
+    Keys of the narrows whose complete ranges are complete for narrow too: its own, and for a
+    topic its stream's, which hold every message of each of its topics.
+    """
+    keys = [narrow_key(narrow)]
+    if any(n['operator'] == 'topic' for n in narrow):
+        keys.append(narrow_key([n for n in narrow if n['operator'] != 'topic']))
+    return keys
+
+def _message_dm_key(msg):
+    """The DM key (see _get_dm_key) of the DM msg belongs to."""
+    return _get_dm_key(_message_dm_emails(msg))
+
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+def search_row(msg):
+    """(id, body, sender, place, topic) of msg for the full-text index; place is the stream or the DM's people."""
+    body = html.unescape(HTML_TAG_RE.sub(' ', msg.content or ''))  # Plain enough to tokenize, without a full render
+    if isinstance(msg.display_recipient, tuple):
+        place = " ".join(u['full_name'] or u['email'] for u in msg.display_recipient)
+    else:
+        place = msg.display_recipient or ''
+    return (msg.id, body, f"{msg.sender_full_name} {msg.sender_email}", place, msg.subject or '')
+
+class MessageStore:
+    """
+    On-disk cache (sqlite3 in WAL mode) of messages, users, streams and topics.
+    Also records, per narrow, which message id ranges are known to be complete, so history
+    can be painted from disk and only the gaps fetched from the server. Every stored message
+    is also in an FTS5 full-text index, for local search.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY, type TEXT, stream TEXT, topic TEXT COLLATE NOCASE, dm_key TEXT, data TEXT);
+        CREATE INDEX IF NOT EXISTS messages_by_topic ON messages (stream, topic, id);
+        CREATE INDEX IF NOT EXISTS messages_by_dm ON messages (dm_key, id);
+        CREATE TABLE IF NOT EXISTS ranges (narrow TEXT, lo INTEGER, hi INTEGER);
+        CREATE INDEX IF NOT EXISTS ranges_by_narrow ON ranges (narrow, hi);
+        CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, data TEXT);
+        CREATE TABLE IF NOT EXISTS streams (name TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS topics (stream TEXT, name TEXT, PRIMARY KEY (stream, name));
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+    SEARCH_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+            body, sender, place, topic, tokenize='unicode61 remove_diacritics 2', prefix='1 2 3');
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        try:
+            if path != ':memory:':
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Message store unavailable ({e}), caching in memory only.")
+            self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self.conn.executescript(self.SCHEMA)
+        try:
+            self.conn.executescript(self.SEARCH_SCHEMA)
+            self.fts = True
+        except sqlite3.Error:
+            self.fts = False  # SQLite built without FTS5; search falls back to scanning
+
+    # Messages
+    def save_messages(self, messages):
+        rows = []
+        # System notices and local echoes aren't worth keeping
+        kept = [m for m in messages if isinstance(m, Message) and m.id is not None and m.local_id is None]
+        for m in kept:
+            if m.type == 'stream':
+                rows.append((m.id, 'stream', m.display_recipient, m.subject, None, json.dumps(m.to_api())))
+            else:
+                rows.append((m.id, 'private', None, None, _message_dm_key(m), json.dumps(m.to_api())))
+        if rows:
+            with self.lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows)
+                if self.fts:
+                    self.conn.executemany("INSERT OR REPLACE INTO search (rowid, body, sender, place, topic) VALUES (?, ?, ?, ?, ?)",
+                                          [search_row(m) for m in kept])
+
+    def delete_messages(self, ids):
+        ids = list(ids)
+        marks = ','.join('?' * len(ids))
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM messages WHERE id IN ({marks})", ids)
+            if self.fts:
+                self.conn.execute(f"DELETE FROM search WHERE rowid IN ({marks})", ids)
+
+    def message_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def messages_by_id(self, ids):
+        """The stored messages among ids, oldest first."""
+        ids = list(ids)
+        if not ids:
+            return []
+        with self.lock:
+            rows = self.conn.execute(f"SELECT data FROM messages WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id",
+                                     ids).fetchall()
+        return [Message.from_api(json.loads(r[0])) for r in rows]
+
+    # Full-text search
+    def search(self, terms, before=None, limit=50):
+        """
+        Ids of stored messages matching every (column, word) in terms by word prefix (column None
+        matches any column), newest first, all below before.
+        """
+        if not terms:
+            return []
+        bound = before if before is not None else sys.maxsize
+        with self.lock:
+            if self.fts:
+                match = " ".join(f'{col} : "{word}"*' if col else f'"{word}"*' for col, word in terms)
+                rows = self.conn.execute("SELECT rowid FROM search WHERE search MATCH ? AND rowid < ? ORDER BY rowid DESC LIMIT ?",
+                                         (match, bound, limit)).fetchall()
+            else:
+                where = " AND ".join("data LIKE ?" for _ in terms)
+                rows = self.conn.execute(f"SELECT id FROM messages WHERE {where} AND id < ? ORDER BY id DESC LIMIT ?",
+                                         [f"%{word}%" for _, word in terms] + [bound, limit]).fetchall()
+        return [r[0] for r in rows]
+
+    def index_backlog(self, limit):
+        """Indexes up to limit stored messages from before the search index existed. Returns how many it did."""
+        if not self.fts:
+            return 0
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'search_indexed'").fetchone():
+                return 0
+            rows = self.conn.execute("SELECT data FROM messages WHERE id NOT IN (SELECT rowid FROM search) LIMIT ?",
+                                     (limit,)).fetchall()
+        messages = [Message.from_api(json.loads(r[0])) for r in rows]
+        with self.lock, self.conn:
+            if messages:
+                self.conn.executemany("INSERT OR REPLACE INTO search (rowid, body, sender, place, topic) VALUES (?, ?, ?, ?, ?)",
+                                      [search_row(m) for m in messages])
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('search_indexed', '1')")
+        return len(messages)
+
+    def _narrow_where(self, narrow):
+        ops = {n['operator']: n['operand'] for n in narrow}
+        if 'pm-with' in ops:
+            return "dm_key = ?", [ops['pm-with']]
+        if 'topic' in ops:
+            return "stream = ? AND topic = ?", [ops['stream'], ops['topic']]
+        return "stream = ?", [ops['stream']]
+
+    def load_messages(self, narrow, lo, hi, limit, newest=True):
+        """
+        Returns up to limit stored messages in narrow with lo <= id <= hi, oldest first:
+        the newest ones in the range, or with newest=False the oldest ones.
+        """
+        where, args = self._narrow_where(narrow)
+        order = "DESC" if newest else "ASC"
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT data FROM messages WHERE {where} AND id BETWEEN ? AND ? ORDER BY id {order} LIMIT ?",
+                args + [lo, hi, limit]).fetchall()
+        if newest:
+            rows.reverse()
+        return [Message.from_api(json.loads(r[0])) for r in rows]
+
+    # Loaded ranges
+    def _ranges(self, narrow):
+        """Known-complete (lo, hi) ranges for narrow (see covering_narrow_keys), merged where they overlap."""
+        keys = covering_narrow_keys(narrow)
+        with self.lock:
+            rows = self.conn.execute(f"SELECT lo, hi FROM ranges WHERE narrow IN ({','.join('?' * len(keys))}) ORDER BY lo",
+                                     keys).fetchall()
+        merged = []
+        for lo, hi in rows:
+            if merged and lo <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+            else:
+                merged.append((lo, hi))
+        return merged
+
+    def latest_range(self, narrow):
+        """The known-complete (lo, hi) range reaching furthest up for narrow, or None."""
+        return max(self._ranges(narrow), key=lambda r: r[1], default=None)
+
+    def range_containing(self, narrow, msg_id):
+        for lo, hi in self._ranges(narrow):
+            if lo <= msg_id <= hi:
+                return (lo, hi)
+        return None
+
+    def add_range(self, narrow, lo, hi):
+        """Records that every message in narrow with lo <= id <= hi is stored, merging overlaps."""
+        key = narrow_key(narrow)
+        with self.lock, self.conn:
+            rows = self.conn.execute("SELECT lo, hi FROM ranges WHERE narrow = ? AND lo <= ? AND hi >= ?",
+                                     (key, hi, lo)).fetchall()
+            for r_lo, r_hi in rows:
+                lo, hi = min(lo, r_lo), max(hi, r_hi)
+            self.conn.execute("DELETE FROM ranges WHERE narrow = ? AND lo <= ? AND hi >= ?", (key, hi, lo))
+            self.conn.execute("INSERT INTO ranges VALUES (?, ?, ?)", (key, lo, hi))
+
+    def forget_ranges(self, narrow):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM ranges WHERE narrow = ?", (narrow_key(narrow),))
+
+    # Realm metadata
+    def save_users(self, users):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM users")
+            self.conn.executemany("INSERT INTO users VALUES (?, ?)", [(u['email'], json.dumps(u)) for u in users])
+
+    def load_users(self):
+        with self.lock:
+            return [json.loads(r[0]) for r in self.conn.execute("SELECT data FROM users")]
+
+    def save_streams(self, names):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM streams")
+            self.conn.executemany("INSERT INTO streams VALUES (?)", [(n,) for n in names])
+
+    def load_streams(self):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT name FROM streams ORDER BY rowid")]
+
+    def save_topics(self, stream, topics):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM topics WHERE stream = ?", (stream,))
+            self.conn.executemany("INSERT OR IGNORE INTO topics VALUES (?, ?)", [(stream, t) for t in topics])
+
+    def save_snapshot(self, snapshot):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('snapshot', ?)", (json.dumps(snapshot),))
+
+    def load_snapshot(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'snapshot'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def stream_activity(self):
+        """Latest stored message id per stream, as a rough measure of recent activity."""
+        with self.lock:
+            return dict(self.conn.execute("SELECT stream, MAX(id) FROM messages WHERE stream IS NOT NULL GROUP BY stream"))
+
+    def load_topics(self, stream):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT name FROM topics WHERE stream = ? ORDER BY rowid", (stream,))]
 
+def store_path():
+    """One database per account, so switching zuliprc files doesn't mix realms."""
+    account = re.sub(r'[^A-Za-z0-9_.@-]', '_', f"{client.email}_{client.base_url}")
+    return os.path.join(STORE_DIR, f"{account}.sqlite3")
+
+message_store = MessageStore(store_path())
+fresh_narrows = set()  # Narrow keys whose latest range the event queue is keeping up to date
+
+def is_fresh(narrow):
+    """Whether the event queue is keeping narrow's latest range (or one covering it) up to date."""
+    return any(key in fresh_narrows for key in covering_narrow_keys(narrow))
+
+def narrows_for_message(msg):
+    """Every narrow a message shows up in: its stream and stream+topic, or its DM."""
+    if msg.type == 'stream':
+        stream = [{"operator": "stream", "operand": msg.display_recipient}]
+        return [stream, stream + [{"operator": "topic", "operand": msg.subject}]]
+    return [[{"operator": "pm-with", "operand": _message_dm_key(msg)}]]
+
+def store_live_message(msg):
+    """Saves a message from the event queue, extending the ranges of narrows known to be current."""
+    message_store.save_messages([msg])
+    for narrow in narrows_for_message(msg):
+        if narrow_key(narrow) in fresh_narrows:
+            rng = message_store.latest_range(narrow)
+            if rng:
+                message_store.add_range(narrow, rng[0], max(rng[1], msg.id))
+
+# -- Section: Utility functions for conversation keys, users, and topics --
 def _get_dm_key(user_emails):
-    """Returns a unique key for DMs, based on sorted user names. (Order matters!)"""
-    names = []
-    for email in sorted(user_emails):
-        for u in users:
-            if u['email'] == email:
-                names.append(u['full_name'])
-    return "dm:" + ",".join(names)
-
-def mark_convo_as_read(key):
-    """Marks a conversation as read in the unread tracker."""
-    if key in unread_tracker:
-        unread_tracker[key] = 0
-
-def get_users():
-    """Returns all Zulip users for the realm."""
-    resp = client.get_users()
-    return resp['members'] if resp['result'] == 'success' else []
-
-def get_streams():
-    """Returns all stream names."""
-    resp = client.get_streams()
-    return [s['name'] for s in resp['streams']] if resp['result'] == 'success' else []
-
-def get_topics(stream):
+    """
+    Returns a unique key for DMs: the emails of everyone in it except us, sorted and
+    comma-joined (our own email for self-DMs). Names can be shared, so they're only for display.
+    """
+    others = sorted(set(user_emails) - {client.email})
+    return ",".join(others) if others else client.email
+
+def dm_key_label(dm_key):
+    """Display names of a DM key's people; a name several users share gets its email too."""
+    labels = []
+    for email in dm_key.split(","):
+        name = user_directory.display_name(email)
+        labels.append(f"{name} <{email}>" if len(user_directory.find_by_name(name)) > 1 else name)
+    return ", ".join(labels)
+
+def _message_dm_emails(msg):
+    """The other participants of a DM, as emails."""
+    if isinstance(msg.display_recipient, tuple):
+        return [u['email'] for u in msg.display_recipient if u['email'] != client.email]
+    return [msg.display_recipient] if msg.display_recipient != client.email else []
+
+# -- Section: Unread model --
+class UnreadModel:
+    """
+    Unread messages, by id, per topic, per stream, per DM, and in total: seeded from the server's
+    unread summary (see seed_unread) and kept up to date as messages arrive, move, go away and are
+    read, here or on another device, so nothing has to be summed at render time. version goes
+    up on every change; renderers compare it to skip rebuilding when nothing moved.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset([])
+
+    def reset(self, entries):
+        """Replaces everything with entries, (message id, place) pairs; see _add."""
+        with self.lock:
+            self.where = {}      # Unread message id -> (stream, topic) or DM key
+            self.by_topic = {}   # (stream, topic) -> set of unread message ids
+            self.by_stream = {}  # stream -> count
+            self.by_dm = {}      # DM key -> set of unread message ids, in order of first unread message
+            self.total = 0
+            for msg_id, place in sorted(entries, key=lambda e: e[0]):
+                self._add(msg_id, place)
+            self.version = getattr(self, 'version', 0) + 1
+
+    def _add(self, msg_id, place):
+        if msg_id in self.where:
+            return False
+        self.where[msg_id] = place
+        if isinstance(place, tuple):
+            self.by_topic.setdefault(place, set()).add(msg_id)
+            self.by_stream[place[0]] = self.by_stream.get(place[0], 0) + 1
+        else:
+            self.by_dm.setdefault(place, set()).add(msg_id)
+        self.total += 1
+        return True
+
+    def _remove(self, msg_id):
+        place = self.where.pop(msg_id, None)
+        if place is None:
+            return None
+        group = self.by_topic if isinstance(place, tuple) else self.by_dm
+        group[place].discard(msg_id)
+        if not group[place]:
+            del group[place]
+        if isinstance(place, tuple):
+            left = self.by_stream[place[0]] - 1
+            if left:
+                self.by_stream[place[0]] = left
+            else:
+                del self.by_stream[place[0]]
+        self.total -= 1
+        return place
+
+    def add(self, msg_id, place):
+        """Counts msg_id as unread in place: (stream, topic), or a DM key."""
+        with self.lock:
+            if self._add(msg_id, place):
+                self.version += 1
+
+    def read(self, ids):
+        """Marks ids read. Returns the ones that were unread."""
+        with self.lock:
+            done = [i for i in ids if self._remove(i) is not None]
+            if done:
+                self.version += 1
+            return done
+
+    def move(self, ids, new_stream=None, new_topic=None):
+        """Follows stream messages among ids to another stream and/or topic."""
+        with self.lock:
+            moved = False
+            for msg_id in ids:
+                place = self.where.get(msg_id)
+                if isinstance(place, tuple):
+                    self._remove(msg_id)
+                    self._add(msg_id, (new_stream or place[0], new_topic if new_topic is not None else place[1]))
+                    moved = True
+            if moved:
+                self.version += 1
+
+    def drop_stream(self, stream):
+        """Forgets a stream's counts (e.g. when it is no longer visible)."""
+        with self.lock:
+            ids = [i for key, topic_ids in self.by_topic.items() if key[0] == stream for i in topic_ids]
+        self.read(ids)
+
+    def topic_count(self, stream, topic):
+        return len(self.by_topic.get((stream, topic), ()))
+
+    def stream_count(self, stream):
+        return self.by_stream.get(stream, 0)
+
+    def dm_count(self, dm_key):
+        return len(self.by_dm.get(dm_key, ()))
+
+    def dm_counts(self):
+        """(DM key, count) for every DM with unread messages."""
+        with self.lock:
+            return [(key, len(ids)) for key, ids in self.by_dm.items()]
+
+    def unread_in(self, context):
+        """Ids of the unread messages in the narrow of a chat context (see current_context_key)."""
+        stream, topic, dm = context
+        with self.lock:
+            if dm:
+                return list(self.by_dm.get(_get_dm_key([dm]), ()))
+            if topic is not None:
+                return list(self.by_topic.get((stream, topic), ()))
+            return [i for key, ids in self.by_topic.items() if key[0] == stream for i in ids]
+
+    def add_message(self, msg, flags=()):
+        """
+        Counts msg as unread unless we sent it or it's already flagged read (by another device).
+        Returns the DM key for DMs (None otherwise), so the caller can bump it in the recent DM list.
+        """
+        if not msg.sender_email or msg.sender_email == client.email:
+            return None
+        if msg.type == 'stream':
+            if 'read' not in flags:
+                self.add(msg.id, (msg.display_recipient, msg.subject))
+        elif msg.type == 'private':
+            key = _get_dm_key(_message_dm_emails(msg))
+            if 'read' not in flags:
+                self.add(msg.id, key)
+            return key
+        return None
+
+unread_model = UnreadModel()
+
+def _unread_dm_key(user_ids):
+    """The DM key (see _get_dm_key) of a DM with user_ids, as the server's unread data names them."""
+    users = [user_directory.get_by_id(int(i)) for i in user_ids]
+    return _get_dm_key([u['email'] for u in users if u and u['email'] != client.email])
+
+def unread_place(details):
+    """Where an unread message counts, from its stream_id and topic or its DM's user_ids; None if unknown."""
+    if details.get('type') == 'stream':
+        stream = stream_name(details.get('stream_id'))
+        return (stream, details.get('topic')) if stream else None
+    return _unread_dm_key(details.get('user_ids', ()))
+
+def seed_unread(unread_msgs):
+    """
+    Replaces the unread counts with the server's unread summary (register's unread_msgs), less
+    the reads made here that haven't reached the server yet.
+    """
+    entries = []
+    for s in unread_msgs.get('streams', []):
+        place = unread_place({'type': 'stream', 'stream_id': s['stream_id'], 'topic': s['topic']})
+        if place:
+            entries += [(msg_id, place) for msg_id in s['unread_message_ids']]
+    for dm in unread_msgs.get('dms', unread_msgs.get('pms', [])):
+        key = _unread_dm_key([dm.get('other_user_id', dm.get('sender_id'))])
+        entries += [(msg_id, key) for msg_id in dm['unread_message_ids']]
+    for group in unread_msgs.get('huddles', []):
+        key = _unread_dm_key(group['user_ids_string'].split(','))
+        entries += [(msg_id, key) for msg_id in group['unread_message_ids']]
+    unread_model.reset(entries)
+    unread_model.read(read_sync['pending'])
+    request_redraw('sidebar', 'notify')
+
+# -- Section: Read sync --
+# Messages read here are flagged read on the server too, so other clients stop showing them as
+# unread. Reads pile up in read_sync['pending'] and go out together once they stop coming for
+# READ_SYNC_DELAY seconds (or have waited READ_SYNC_MAX_DELAY), in update_message_flags
+# requests of at most READ_SYNC_BATCH ids: scrolling through a busy topic costs a request or
+# two, not one per message. Requests that fail keep their ids pending for the next batch.
+READ_SYNC_DELAY = read_setting('read_sync_delay', 2.0)  # Quiet seconds before pending reads are sent
+READ_SYNC_MAX_DELAY = 10.0  # Longest a read waits while more keep coming
+READ_SYNC_BATCH = 1000      # Most message ids per update_message_flags request
+read_sync = {'pending': set(), 'first': 0.0, 'last': 0.0, 'task': None, 'requests': 0, 'synced': 0}
+
+def sync_read(ids):
+    """Queues message ids just read here to be flagged read on the server."""
+    if not ids:
+        return
+    now = time.monotonic()
+    read_sync['pending'].update(ids)
+    read_sync['last'] = now
+    if ui_loop() is None:
+        flush_reads()  # Scripted use: nothing would be around to send them later
+    elif read_sync['task'] is None or read_sync['task'].done():
+        read_sync['first'] = now
+        read_sync['task'] = spawn(_flush_reads_later(), narrow_bound=False)
+
+def _read_batches():
+    ids = sorted(read_sync['pending'])
+    read_sync['pending'].clear()
+    return [ids[i:i + READ_SYNC_BATCH] for i in range(0, len(ids), READ_SYNC_BATCH)]
+
+def _read_synced(batch, res):
+    if res.get('result') == 'success':
+        read_sync['requests'] += 1
+        read_sync['synced'] += len(batch)
+    else:
+        read_sync['pending'].update(batch)
+
+async def _flush_reads_later():
+    while True:
+        wait = min(read_sync['last'] + READ_SYNC_DELAY, read_sync['first'] + READ_SYNC_MAX_DELAY) - time.monotonic()
+        if wait <= 0:
+            break
+        await asyncio.sleep(wait)
+    for batch in _read_batches():
+        _read_synced(batch, await async_client.call('update_message_flags', {'messages': batch, 'op': 'add', 'flag': 'read'}))
+
+def flush_reads():
+    """Sends the pending reads now, blocking (scripted use, and on the way out)."""
+    for batch in _read_batches():
+        try:
+            res = api_call('update_message_flags', {'messages': batch, 'op': 'add', 'flag': 'read'})
+        except Exception as e:
+            res = {'result': 'error', 'msg': str(e)}
+        _read_synced(batch, res)
+
+def read_shown_messages():
+    """
+    Marks the open narrow's unread messages read if they're on screen: those whose block
+    overlaps the lines in view. Called when the view moves (scrolling, opening a narrow), never
+    from rendering, so a repaint doesn't write read flags.
+    """
+    unread = unread_model.unread_in(current_context_key())
+    if not unread:
+        return
+    head = len(context_bar_lines())
+    start, end = visible_span(line_model, chat_scroll_pos_lines, head)
+    end = start + get_dynamic_visible_window() if end is None else end  # Only a window's worth fits
+    lo, hi = start - head, end - head
+    with line_model.lock:
+        seen = []
+        for msg_id in unread:
+            idx = line_model.block_index(msg_id)
+            if idx is None:
+                continue
+            block_end = line_model.starts[idx + 1] if idx + 1 < len(line_model.starts) else line_model.line_count
+            if line_model.starts[idx] < hi and block_end > lo:
+                seen.append(msg_id)
+    sync_read(unread_model.read(seen))
+
+SCRAPE_BATCH = 200   # Messages per request when scraping topics
+SCRAPE_LIMIT = 1000  # Give up scraping after this many messages
+
+def get_topics(stream, cancel=None):
     """
     Returns all topics for a given stream.
     If the API doesn't cooperate, scrapes messages as a fallback (here be dragons).
+    The scrape goes in batches and stops early once cancel (a threading.Event) is set.
     """
-    response = client.get_stream_topics(stream)
+    response = api_call('get_stream_topics', stream_ids.get(stream, stream))
     if response['result'] == 'success' and len(response['topics']) > 0:
         return [t['name'] for t in response['topics']]
     found_topics = set()
-    anchor = 1000000000
+    anchor = "newest"
+    scraped = 0
     try:
-        res = client.get_messages({
-            "anchor": anchor,
-            "num_before": 1000,
-            "num_after": 0,
-            "narrow": [{"operator": "stream", "operand": stream}]
-        })
-        if res['result'] == 'success':
-            for msg in res['messages']:
+        while scraped < SCRAPE_LIMIT and not stop_event.is_set() and not (cancel and cancel.is_set()):
+            res = api_call('get_messages', {
+                "anchor": anchor,
+                "num_before": SCRAPE_BATCH,
+                "num_after": 0,
+                "narrow": [{"operator": "stream", "operand": stream}]
+            })
+            if res['result'] != 'success':
+                break
+            msgs = [m for m in res['messages'] if anchor == "newest" or m['id'] < anchor]
+            for msg in msgs:
                 found_topics.add(msg['subject'])
+            scraped += len(msgs)
+            if not msgs or res.get('found_oldest', False):
+                break
+            anchor = min(m['id'] for m in msgs)
     except Exception as e:
-        print(f"Error scraping messages: {e}")
+        run_on_ui(print_system, f"(Error scraping topics of {stream}: {e})")
     return list(found_topics)
 
+# -- Section: Completion index --
+COMPLETION_LIMIT = read_setting('completion_limit', 30)  # Max completions offered at once
+FUZZY_SCAN_LIMIT = 250   # Max entries a fuzzy (subsequence) match looks at, to stay under a millisecond
+RECENT_LIMIT = 100       # Recently used entries remembered per index, for ranking
+WORD_START_RE = re.compile(r'(?<=[\s\-_/.])\w')
+
+class CompletionIndex:
+    """
+    Case-folded sorted index for tab completion. Every word start of an entry's label is a key,
+    so prefix and word-start lookups are a bisect plus a short scan; fuzzy (subsequence) matching
+    kicks in when those come up short. Recently used entries rank first. Entries are added and
+    removed incrementally.
+    """
+    def __init__(self):
+        self.keys = []      # Sorted (folded word-start suffix, entry id)
+        self.labels = {}    # entry id -> label
+        self.recent = OrderedDict()  # entry id -> None, most recently used last
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def _keys_for(entry_id, label):
+        folded = label.casefold()
+        keys = [(folded, entry_id)]
+        for m in WORD_START_RE.finditer(folded):
+            keys.append((folded[m.start():], entry_id))
+        return keys
+
+    def add(self, entry_id, label):
+        if entry_id in self.labels:
+            if self.labels[entry_id] == label:
+                return
+            self.remove(entry_id)
+        self.labels[entry_id] = label
+        for key in self._keys_for(entry_id, label):
+            bisect.insort(self.keys, key)
+
+    def remove(self, entry_id):
+        label = self.labels.pop(entry_id, None)
+        if label is None:
+            return
+        for key in self._keys_for(entry_id, label):
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+        self.recent.pop(entry_id, None)
+
+    def replace_all(self, entries):
+        """Rebuilds from scratch; entries is an iterable of (entry id, label)."""
+        self.labels = dict(entries)
+        self.keys = sorted(k for entry_id, label in self.labels.items() for k in self._keys_for(entry_id, label))
+        self.recent = OrderedDict((e, None) for e in self.recent if e in self.labels)
+
+    def touch(self, entry_id):
+        """Marks an entry as just used, so it ranks first next time."""
+        if entry_id in self.labels:
+            self.recent.pop(entry_id, None)
+            self.recent[entry_id] = None
+            while len(self.recent) > RECENT_LIMIT:
+                self.recent.popitem(last=False)
+
+    def search(self, query, limit=None):
+        """Returns up to limit entry ids matching query: recent ones, then prefix/word-start, then fuzzy."""
+        limit = limit or COMPLETION_LIMIT
+        q = query.casefold()
+        out = []
+        seen = set()
+        for entry_id in reversed(self.recent):
+            if len(out) >= limit:
+                return out
+            folded = self.labels[entry_id].casefold()
+            if folded.startswith(q) or f" {q}" in folded:
+                out.append(entry_id)
+                seen.add(entry_id)
+        i = bisect.bisect_left(self.keys, (q,))
+        while i < len(self.keys) and len(out) < limit:
+            key, entry_id = self.keys[i]
+            if not key.startswith(q):
+                break
+            if entry_id not in seen:
+                out.append(entry_id)
+                seen.add(entry_id)
+            i += 1
+        if len(out) < limit and len(q) > 1:
+            # Fuzzy: q as a subsequence, among entries whose label starts with q's first letter
+            i = bisect.bisect_left(self.keys, (q[0],))
+            scanned = 0
+            while i < len(self.keys) and len(out) < limit and scanned < FUZZY_SCAN_LIMIT:
+                key, entry_id = self.keys[i]
+                if not key.startswith(q[0]):
+                    break
+                if entry_id not in seen:
+                    chars = iter(key)
+                    if all(c in chars for c in q):
+                        out.append(entry_id)
+                        seen.add(entry_id)
+                i += 1
+                scanned += 1
+        return out
+
+COMMANDS = ['/stream', '/dm', '/users', '/online', '/search', '/exit', '/window', '/stats', '/help']
+command_completions = CompletionIndex()
+command_completions.replace_all((c, c) for c in COMMANDS)
+stream_completions = CompletionIndex()
+user_completions = CompletionIndex()     # Keyed by email, labelled with the full name
+topic_completions = {}                   # stream -> CompletionIndex over its topics
+
+def topic_completion_index(stream):
+    """The topic index for stream, (re)built from topic_cache if the cached list was replaced."""
+    topics = topic_cache.get(stream, [])
+    index = topic_completions.get(stream)
+    if index is None or index.source is not topics:
+        recent = index.recent if index else OrderedDict()
+        index = topic_completions[stream] = CompletionIndex()
+        index.replace_all((t, t) for t in topics)
+        index.recent = OrderedDict((t, None) for t in recent if t in index.labels)
+        index.source = topics
+    return index
+
 # -- Section: User, stream, and topic cache setup --
-users = get_users()
-user_map = {u['email']: u for u in users}  # email -> user dict
-user_names = [u['full_name'] for u in users]
-streams = get_streams()
-topic_cache = {}  # stream name -> list of topics
-def prefill_topic_cache():
-    """
-    Prefills the topic cache for all streams in parallel.
-    Can be slow on large orgs, but makes topic switching instant.
-    """
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = list(executor.map(get_topics, streams))
-    for s, topics in zip(streams, results):
-        topic_cache[s] = topics
-prefill_topic_cache()
+class UserDirectory:
+    """
+    All realm users, indexed by email, by user id and by case-folded full name.
+    Several users can share a display name, so name lookups return lists.
+    Kept current by the realm bootstrap and by realm_user events.
+    """
+    def __init__(self):
+        self.by_email = {}   # email -> user dict
+        self.by_id = {}      # user_id -> user dict
+        self.by_name = {}    # casefolded full name -> [user dicts]
+        self.version = 0     # Bumped on every change, so derived caches know when to rebuild
+        self._names = None
+
+    def __len__(self):
+        return len(self.by_email)
+
+    def _index(self, user):
+        self.by_email[user['email']] = user
+        if 'user_id' in user:
+            self.by_id[user['user_id']] = user
+        self.by_name.setdefault(user['full_name'].casefold(), []).append(user)
+
+    def _unindex(self, user):
+        self.by_email.pop(user['email'], None)
+        self.by_id.pop(user.get('user_id'), None)
+        same_name = self.by_name.get(user['full_name'].casefold(), [])
+        if user in same_name:
+            same_name.remove(user)
+            if not same_name:
+                del self.by_name[user['full_name'].casefold()]
+
+    def _changed(self):
+        self.version += 1
+        self._names = None
+
+    def set_all(self, new_users):
+        """
+        Replaces the directory with new_users as a diff: existing dicts are updated in place,
+        so anything holding on to them stays valid. Returns (added, removed, changed) counts.
+        """
+        new_map = {u['email']: u for u in new_users}
+        added = [e for e in new_map if e not in self.by_email]
+        removed = [e for e in self.by_email if e not in new_map]
+        changed = [e for e in new_map if e in self.by_email and self.by_email[e] != new_map[e]]
+        for email in removed:
+            self._unindex(self.by_email[email])
+        for email in changed:
+            self.update(self.by_email[email], new_map[email])
+        for email in added:
+            self._index(new_map[email])
+        user_completions.replace_all((e, u['full_name']) for e, u in self.by_email.items())
+        self._changed()
+        return len(added), len(removed), len(changed)
+
+    def add(self, user):
+        existing = self.by_email.get(user['email'])
+        if existing is not None:
+            self.update(existing, user)
+            return
+        self._index(user)
+        user_completions.add(user['email'], user['full_name'])
+        self._changed()
+
+    def remove(self, user):
+        self._unindex(user)
+        user_completions.remove(user['email'])
+        self._changed()
+
+    def update(self, user, changes):
+        """Applies changes (e.g. a realm_user update event's person dict) to user and reindexes it."""
+        self._unindex(user)
+        user_completions.remove(user['email'])
+        if changes is not user:
+            if {'email', 'full_name'} <= changes.keys():
+                user.clear()  # A complete record replaces the old one outright
+            user.update(changes)
+        self._index(user)
+        user_completions.add(user['email'], user['full_name'])
+        self._changed()
+
+    def get(self, email):
+        return self.by_email.get(email)
+
+    def get_by_id(self, user_id):
+        return self.by_id.get(user_id)
+
+    def find_by_name(self, name):
+        """All users whose full name matches name, ignoring case."""
+        return list(self.by_name.get(name.casefold(), []))
+
+    def display_name(self, email):
+        user = self.by_email.get(email)
+        return user['full_name'] if user else email
+
+    def all(self):
+        return list(self.by_email.values())
+
+    def names(self):
+        """Full names of every user (duplicates included), cached until the directory changes."""
+        if self._names is None:
+            self._names = [u['full_name'] for u in self.by_email.values()]
+        return self._names
+
+user_directory = UserDirectory()
+streams = []            # All stream names we can see
+stream_list_version = [0]  # Bumped whenever streams changes
+stream_ids = {}         # stream name -> stream id (the topics endpoint wants ids)
+subscribed_streams = set()
+topic_cache = {}        # stream name -> list of topics
+
+def stream_name(stream_id):
+    """Name of the stream with stream_id, or None if we don't know it."""
+    for name, sid in stream_ids.items():
+        if sid == stream_id:
+            return name
+    return None
+
+# -- Section: Realm bootstrap --
+# Everything the client needs at startup comes from one register() call, which also creates
+# the event queue. The result is kept as a snapshot in the local store, so the next launch can
+# render straight from disk and just apply the difference once register() answers.
+REALM_STATE_TYPES = ["realm_user", "subscription", "stream", "message", "update_message_flags", "presence"]
+realm_snapshot = {}     # Last known realm state: email, stream_ids, subscriptions, unread_msgs, presences
+
+def _set_streams(new_streams, new_ids):
+    """Applies a new stream list as a diff; topics of streams that disappeared are dropped."""
+    added = set(new_streams) - set(streams)
+    gone = set(streams) - set(new_streams)
+    for s in gone:
+        topic_cache.pop(s, None)
+        topic_completions.pop(s, None)
+        stream_completions.remove(s)
+        unread_model.drop_stream(s)
+        topic_loader.cancel(s)
+    for s in added:
+        stream_completions.add(s, s)
+    streams[:] = new_streams
+    stream_list_version[0] += 1
+    stream_ids.clear()
+    stream_ids.update(new_ids)
+    return len(added), len(gone)
+
+def load_realm_snapshot():
+    """
+    Renders-from-disk half of the bootstrap: fills users, streams and topics from the snapshot
+    left by the last run. Returns False if there isn't one (first launch).
+    """
+    snapshot = message_store.load_snapshot()
+    if not snapshot:
+        return False
+    realm_snapshot.update(snapshot)
+    client.email = snapshot.get('email') or client.email
+    user_directory.set_all(message_store.load_users())
+    _set_streams(message_store.load_streams(), snapshot.get('stream_ids', {}))
+    subscribed_streams.update(snapshot.get('subscriptions', []))
+    presence_cache.set_all(snapshot.get('presences', {}))  # Stale by now, but it decays to the truth on lookup
+    seed_unread(snapshot.get('unread_msgs', {}))  # Likewise; register replaces it
+    for s in streams:
+        # Whatever we learned last session, so completion works before discovery catches up
+        cached_topics = message_store.load_topics(s)
+        if cached_topics:
+            topic_cache[s] = cached_topics
+    return True
+
+def apply_realm_state(state):
+    """
+    Applies a register() response on top of whatever we're showing (snapshot or older state),
+    then saves it as the new snapshot.
+    """
+    client.email = state.get('email') or client.email
+    user_directory.set_all(state.get('realm_users', []))
+    all_streams = state.get('streams') or state.get('subscriptions', [])
+    new_ids = {s['name']: s['stream_id'] for s in all_streams}
+    _set_streams([s['name'] for s in all_streams], new_ids)
+    subscribed = [s['name'] for s in state.get('subscriptions', [])]
+    subscribed_streams.clear()
+    subscribed_streams.update(subscribed)
+    presence_cache.set_all(state.get('presences', {}), state.get('server_timestamp'))
+    seed_unread(state.get('unread_msgs', {}))
+    realm_snapshot.update({
+        'email': client.email,
+        'stream_ids': new_ids,
+        'subscriptions': subscribed,
+        'unread_msgs': state.get('unread_msgs', {}),
+        'presences': state.get('presences', {}),
+        'max_message_id': state.get('max_message_id'),
+    })
+    message_store.save_users(user_directory.all())
+    message_store.save_streams(streams)
+    message_store.save_snapshot(realm_snapshot)
+    schedule_topic_discovery(subscribed)
+    request_redraw('sidebar', 'chat')
+
+def register_queue():
+    """
+    Registers our event queue and fetches the realm state in the same round trip. Message events
+    come with rendered HTML, like get_messages returns them (the server defaults to raw Markdown),
+    and without avatar URLs, which nothing here shows.
+    Returns (queue_id, last_event_id).
+    """
+    res = api_call('register', event_types=EVENT_TYPES, fetch_event_types=REALM_STATE_TYPES,
+                   apply_markdown=True, client_gravatar=True)
+    if res.get('result') != 'success':
+        raise RuntimeError(f"Event queue registration failed: {res.get('msg', 'Unknown error')}")
+    run_on_ui(apply_realm_state, res)
+    return res['queue_id'], res['last_event_id']
+
+# -- Section: Presence --
+# Who's around comes from the register() snapshot and then presence events, with a full refresh
+# every PRESENCE_RECONCILE seconds for servers that rate-limit those events. Status is worked out
+# from report times on lookup, so people drop to offline on time without anything being rescanned.
+PRESENCE_RECONCILE = read_setting('presence_reconcile', 300.0)  # Seconds between full presence refreshes
+PRESENCE_OFFLINE_AFTER = 140  # Seconds without a report before someone counts as offline (as Zulip's web app does)
+PRESENCE_MARKS = {'active': ('class:presence-active', "● "), 'idle': ('class:presence-idle', "◐ "),
+                  'offline': ('class:presence-offline', "○ ")}
+
+def _presence_times(data):
+    """
+    (last active, last reported) timestamps from one user's presence, in any of the shapes the
+    server uses: {active_timestamp, idle_timestamp}, or per-client (and 'aggregated') {status, timestamp}.
+    """
+    if 'active_timestamp' in data or 'idle_timestamp' in data:
+        active = data.get('active_timestamp') or 0
+        return active, max(active, data.get('idle_timestamp') or 0)
+    active = seen = 0
+    for report in data.values():
+        if isinstance(report, dict) and 'timestamp' in report:
+            seen = max(seen, report['timestamp'])
+            if report.get('status') == 'active':
+                active = max(active, report['timestamp'])
+    return active, seen
+
+class PresenceCache:
+    """Last active and last reported times per user email, so a status lookup is one dict access."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}   # email -> (last active, last reported), server time
+        self.skew = 0.0   # Server clock minus ours, from the server timestamps we've seen
+
+    def _email(self, key):
+        """Presences are keyed by email, or by user id on newer servers."""
+        if isinstance(key, int) or (isinstance(key, str) and key.isdigit()):
+            user = user_directory.get_by_id(int(key))
+            return user['email'] if user else None
+        return key
+
+    def _sync_clock(self, server_timestamp):
+        if server_timestamp:
+            self.skew = server_timestamp - time.time()
+
+    def set_all(self, presences, server_timestamp=None):
+        """Replaces everything with a full presence map (register() or realm/presence)."""
+        times = {}
+        for key, data in presences.items():
+            email = self._email(key)
+            if email:
+                times[email] = _presence_times(data)
+        with self.lock:
+            self.times = times
+            self._sync_clock(server_timestamp)
+
+    def update(self, key, data, server_timestamp=None):
+        """Merges one user's new presence report in (a presence event)."""
+        email = self._email(key)
+        if not email:
+            return
+        active, seen = _presence_times(data)
+        with self.lock:
+            old_active, old_seen = self.times.get(email, (0, 0))
+            self.times[email] = (max(active, old_active), max(seen, old_seen))
+            self._sync_clock(server_timestamp)
+
+    def status(self, email):
+        """'active', 'idle' or 'offline'."""
+        active, seen = self.times.get(email, (0, 0))
+        now = time.time() + self.skew
+        if now - active <= PRESENCE_OFFLINE_AFTER:
+            return 'active'
+        if now - seen <= PRESENCE_OFFLINE_AFTER:
+            return 'idle'
+        return 'offline'
+
+    def around(self):
+        """Emails of everyone active or idle, as two lists."""
+        with self.lock:
+            emails = list(self.times)
+        active, idle = [], []
+        for email in emails:
+            status = self.status(email)
+            if status == 'active':
+                active.append(email)
+            elif status == 'idle':
+                idle.append(email)
+        return active, idle
+
+presence_cache = PresenceCache()
+
+def dm_presence(dm_key):
+    """Status of the other person in a one-on-one DM key; None for group DMs, self-DMs and unknown users."""
+    if "," in dm_key or dm_key == client.email or not user_directory.get(dm_key):
+        return None
+    return presence_cache.status(dm_key)
+
+def presence_reconciler():
+    """Background thread: refetches everyone's presence every PRESENCE_RECONCILE seconds."""
+    while not stop_event.wait(PRESENCE_RECONCILE):
+        try:
+            res = api_call('call_endpoint', 'realm/presence', method='GET')
+        except Exception as e:
+            print(f"Error refreshing presence: {e}")
+            continue
+        if res.get('result') == 'success':
+            run_on_ui(presence_cache.set_all, res.get('presences', {}), res.get('server_timestamp'))
+            request_redraw('sidebar')
+
+# -- Section: Topic discovery --
+TOPIC_FETCH_CONCURRENCY = read_setting('topic_fetch_concurrency', 4)  # Max topic requests in flight
+TOPIC_PRIORITY_URGENT = 0      # Opened or tab-completed by the user
+TOPIC_PRIORITY_RECENT = 1      # Subscribed and recently active
+TOPIC_PRIORITY_SUBSCRIBED = 2  # Subscribed, no recent activity we know of
+
+class TopicLoader:
+    """
+    Fetches stream topics in the background, most important streams first,
+    with at most TOPIC_FETCH_CONCURRENCY requests in flight.
+    User-driven requests jump the queue; a stream's scrape fallback can be cancelled.
+    The worker threads start with the first request, so importing the module starts none
+    (see start_prerender_pool).
+    """
+    def __init__(self, workers):
+        self.cond = threading.Condition()
+        self.heap = []          # (priority, seq, stream)
+        self.queued = {}        # stream -> best priority queued
+        self.done = {}          # stream -> threading.Event, set once its topics are in topic_cache
+        self.cancels = {}       # stream -> threading.Event for its in-flight scrape
+        self.fetching = {}      # stream -> priority its in-flight fetch was queued at
+        self.seq = itertools.count()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, workers))]
+
+    def request(self, stream, priority=TOPIC_PRIORITY_URGENT, refresh=False):
+        """Queues a topic fetch for stream; a better priority for an already queued stream wins."""
+        with self.cond:
+            done = self.done.get(stream)
+            if done is not None and done.is_set() and not refresh and stream in topic_cache:
+                return
+            if done is None or done.is_set():
+                self.done[stream] = threading.Event()
+            if stream in self.cancels:
+                return  # Already being fetched
+            if stream in self.queued and self.queued[stream] <= priority:
+                return
+            self.queued[stream] = priority
+            heapq.heappush(self.heap, (priority, next(self.seq), stream))
+            self.cond.notify()
+            if self.workers[0].ident is None:  # First request
+                for t in self.workers:
+                    t.start()
+
+    def ensure(self, stream, timeout=15):
+        """Fetches stream's topics now (ahead of everything else) and waits for them."""
+        if stream in topic_cache and stream in self.done and self.done[stream].is_set():
+            return topic_cache[stream]
+        self.request(stream, TOPIC_PRIORITY_URGENT, refresh=stream not in topic_cache)
+        self.done[stream].wait(timeout)
+        return topic_cache.get(stream, [])
+
+    def cancel(self, stream, urgent_only=False):
+        """
+        Abandons a queued fetch, or stops a running scrape early. With urgent_only, only if it's a
+        fetch the user asked for (background discovery of a subscribed stream carries on).
+        """
+        with self.cond:
+            if urgent_only and TOPIC_PRIORITY_URGENT not in (self.queued.get(stream), self.fetching.get(stream)):
+                return
+            if self.queued.pop(stream, None) is not None:
+                self.done[stream].set()  # No worker will, and ensure() may be waiting on it
+            if stream in self.cancels:
+                self.cancels[stream].set()
+
+    def _work(self):
+        while not stop_event.is_set():
+            with self.cond:
+                while True:
+                    while self.heap and self.queued.get(self.heap[0][2]) != self.heap[0][0]:
+                        heapq.heappop(self.heap)  # Stale entry (re-prioritized or cancelled)
+                    if self.heap:
+                        break
+                    self.cond.wait()
+                priority, _, stream = heapq.heappop(self.heap)
+                del self.queued[stream]
+                cancel = self.cancels[stream] = threading.Event()
+                self.fetching[stream] = priority
+            topics = error = None
+            try:
+                topics = get_topics(stream, cancel)
+                if not cancel.is_set():
+                    message_store.save_topics(stream, topics)
+            except Exception as e:
+                error = e
+            run_on_ui(self._finish, stream, topics, error, cancel)
+
+    def _finish(self, stream, topics, error, cancel):
+        """UI thread half of a fetch: files the topics (unless it was cancelled) and marks stream done."""
+        try:
+            if error is not None:
+                print_system(f"(Error fetching topics for {stream}: {error})")
+            elif not cancel.is_set():
+                topic_cache[stream] = topics
+        finally:
+            with self.cond:
+                del self.cancels[stream], self.fetching[stream]
+                self.done[stream].set()
+
+topic_loader = TopicLoader(TOPIC_FETCH_CONCURRENCY)
+
+def note_topic(stream, topic):
+    """Adds a topic we just saw in a message to the cache, so it completes without a fetch."""
+    topics = topic_cache.get(stream)
+    if topics is not None and topic not in topics:
+        topics.insert(0, topic)
+        if stream in topic_completions and topic_completions[stream].source is topics:
+            topic_completions[stream].add(topic, topic)
+
+def forget_topic(stream, topic):
+    """Drops a topic that has no messages left (they were all moved away)."""
+    topics = topic_cache.get(stream)
+    if topics is not None and topic in topics:
+        topics.remove(topic)
+        if stream in topic_completions and topic_completions[stream].source is topics:
+            topic_completions[stream].remove(topic)
+
+def schedule_topic_discovery(subscribed):
+    """
+    Queues topic fetches for the subscribed streams, recently active ones first.
+    Everything else is fetched when the user opens or tab-completes it.
+    """
+    activity = message_store.stream_activity()
+    subscribed = sorted(subscribed, key=lambda s: -activity.get(s, 0))
+    for s in subscribed:
+        topic_loader.request(s, TOPIC_PRIORITY_RECENT if s in activity else TOPIC_PRIORITY_SUBSCRIBED, refresh=True)
 
 # -- Section: Notification bar rendering and blinking --
 notification_blink_flag = [False]  # Mutable flag for blinking notifications
+notification_cache = {'key': None, 'out': None}  # Bar fragments and what they were built from
+
 def get_notification_list():
     """
     Returns a list of (key, count) for DMs with unread messages.
     Used to populate the notification bar.
     """
-    notif_list = []
-    for key, count in unread_tracker.items():
-        if count > 0 and key.startswith('dm:'):
-            notif_list.append((key, count))
-    return notif_list
+    return unread_model.dm_counts()
 
+@timed('render.notify')
 def render_notification_bar():
     """
     Renders the top notification bar, showing unread DMs and blinking if needed.
+    Reuses the last result until the bar is marked dirty or the unread counts or user names change.
     """
-    notif_list = get_notification_list()
-    if notif_list:
-        display = " | ".join([f"{k[3:]} ({c})" for k, c in notif_list])
-        if notification_blink_flag[0]:
-            return [("bg:#ff0000 #fff bold", f"   {display} ")]
-        else:
-            return [("bg:#222222 #fff", f"   {display} ")]
+    key = (region_generations['notify'], unread_model.version, user_directory.version)
+    if notification_cache['key'] == key:
+        return notification_cache['out']
+    display = " | ".join([f"{dm_key_label(k)} ({c})" for k, c in get_notification_list()])
+    if not display:
+        out = [("class:notifybar", "  No notifications ")]
+    elif notification_blink_flag[0]:
+        out = [("bg:#ff0000 #fff bold", f"   {display} ")]
     else:
-        return [("class:notifybar", "  No notifications ")]
+        out = [("bg:#222222 #fff", f"   {display} ")]
+    notification_cache['key'] = key
+    notification_cache['out'] = out
+    return out
 
-def notification_blinker(app):
+def notification_blinker():
     """
     Background thread for blinking the notification bar when there are unread DMs.
+    With nothing unread it sleeps until the notification bar is next marked dirty.
     """
     while not stop_event.is_set():
-        notif_list = get_notification_list()
-        if notif_list:
+        if unread_model.by_dm:
             notification_blink_flag[0] = not notification_blink_flag[0]
+            request_redraw('notify')
+            stop_event.wait(BLINK_INTERVAL)
         else:
-            notification_blink_flag[0] = False
-        app.invalidate()
-        time.sleep(0.5)
+            if notification_blink_flag[0]:
+                notification_blink_flag[0] = False
+                request_redraw('notify')
+            blink_wakeup.wait()
+            blink_wakeup.clear()
 
 # -- Section: Sidebar rendering (streams and DMs) --
+sidebar_cache = {'key': None, 'out': None}  # Sidebar fragments and what they were built from
+
+@timed('render.sidebar')
 def render_stream_sidebar():
     """
     Renders the left sidebar showing recent DMs and all streams (with unread counts).
+    Reuses the last result until the sidebar is marked dirty (presence changes, see
+    request_redraw) or the unread counts, recent DMs, stream list or user names change.
     """
+    key = (region_generations['sidebar'], unread_model.version, tuple(recent_dm_keys), stream_list_version[0],
+           user_directory.version)
+    if sidebar_cache['key'] == key:
+        return sidebar_cache['out']
+    recent_dms = recent_dm_keys[:5]
+    presence = [dm_presence(k) for k in recent_dms]
     sidebar_lines = []
     # Add recent DMs
-    recent_dms = recent_dm_keys[:5]
     if recent_dms:
         sidebar_lines.append([('bold #00ff00', 'Recent DMs:\n')])  # Green header for DMs
-        for dm_key in recent_dms:
-            dm_name = dm_key[3:]  # Remove "dm:" prefix
-            unread_count = unread_tracker.get(dm_key, 0)
+        for dm_key, status in zip(recent_dms, presence):
+            dm_name = dm_key_label(dm_key)
+            mark = [PRESENCE_MARKS[status]] if status else []
+            unread_count = unread_model.dm_count(dm_key)
             if unread_count > 0:
-                sidebar_lines.append([("bold #fff", f"{dm_name} ("), ("bold #ff0000", f"{unread_count}"), ("bold #fff", ")")])
+                sidebar_lines.append(mark + [("bold #fff", f"{dm_name} ("), ("bold #ff0000", f"{unread_count}"), ("bold #fff", ")")])
             else:
-                sidebar_lines.append([("", f"{dm_name}")])
+                sidebar_lines.append(mark + [("", f"{dm_name}")])
             sidebar_lines.append([("", "\n")])
         sidebar_lines.append([("", "_________\n")])  # Separator line
 
     # Add streams
     for s in streams:
-        topics = topic_cache.get(s, [])
-        unread = sum(unread_tracker.get(_get_stream_topic_key(s, t), 0) for t in topics)
+        unread = unread_model.stream_count(s)
         if unread > 0:
             sidebar_lines.append([("bold #fff", f"{s} ("), ("bold #ff0000", f"{unread}"), ("bold #fff", ")")])
         else:
@@ -328,7 +2156,10 @@ def render_stream_sidebar():
     for line in sidebar_lines:
         for part in line:
             out.append(part)
-    return out if out else [("", "\n")]
+    out = out if out else [("", "\n")]
+    sidebar_cache['key'] = key
+    sidebar_cache['out'] = out
+    return out
 
 def render_stream_sidebar_window():
     """Just a wrapper for the sidebar rendering for the layout."""
@@ -348,13 +2179,30 @@ style = Style.from_dict({
     'user_5': 'bold cyan',
     'user_6': 'bold white',
     'user_7': 'bold #888888',
+    'code': '#d0d0d0 bg:#262626',
+    'quote': 'italic #8a8a8a',
+    'mention': 'bold #ffaf00',
+    'link': 'underline #5fafff',
+    'emoji': '',
+    'pending': 'nobold #767676',
+    'highlight': 'bold #000000 bg:#ffd700',
+    'reaction': '#8a8a8a',
+    'reaction-mine': 'bold #5fafff',
+    'presence-active': '#00d75f',
+    'presence-idle': '#ffaf00',
+    'presence-offline': '#585858',
 })
 
 # -- Section: Message rendering utilities --
+chat_view = {'width': None, 'height': None}  # Size of the chat pane as of the last frame (see ChatControl)
+
 def get_dynamic_visible_window():
     """
-    Returns the number of visible lines in the chat window, based on the terminal size.
+    Returns the number of visible lines in the chat window: its real height once it has been
+    drawn, before that an estimate from the terminal size.
     """
+    if chat_view['height']:
+        return chat_view['height']
     try:
         app = get_app()
         total_height = app.renderer.output.get_size().rows
@@ -364,34 +2212,306 @@ def get_dynamic_visible_window():
     except Exception:
         return VISIBLE_WINDOW_MIN
 
-def clean_message_html(content):
+# Zulip HTML -> terminal conversion. One pass over the tokens, no tree. The server sends
+# well-formed, sanitized HTML, so a single regex tokenizes it; html.parser's general-purpose
+# tokenizer spent most of the conversion time handling markup Zulip never produces.
+ZERO_WIDTH = '[ZeroWidthEscape]'  # prompt_toolkit writes these fragments raw, without taking up cells
+HTML_VOID_TAGS = {'br', 'img', 'hr', 'input', 'meta', 'link', 'wbr', 'source', 'col', 'area'}
+HTML_BLOCK_TAGS = {'p', 'div', 'pre', 'blockquote', 'ul', 'ol', 'li', 'table', 'tr', 'hr',
+                   'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+HTML_SKIP_CLASSES = {'message_inline_image', 'message_inline_ref', 'message_embed',
+                     'youtube-video', 'vimeo-video', 'embed-video', 'katex-html'}
+HTML_INLINE_STYLES = {'strong': 'bold', 'b': 'bold', 'em': 'italic', 'i': 'italic',
+                      'del': 'strike', 's': 'strike', 'code': 'class:code'}
+WHITESPACE_RE = re.compile(r'\s+')
+HTML_TOKEN_RE = re.compile(r"""
+    ([^<]+)                                              # Text
+  | <(/?)([a-zA-Z][^\s/>]*)((?:[^>"']|"[^"]*"|'[^']*')*)>  # Start, end or self-closing tag, with its attributes
+  | <!--.*?(?:-->|\Z)                                   # Comment
+  | <[!?][^>]*>                                          # Doctype, processing instruction
+  | (<)                                                  # A stray '<' is just text
+""", re.S | re.X)
+HTML_ATTR_RE = re.compile(r"""([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?""")
+
+def html_attrs(raw):
+    """The (name, value) pairs in a tag's attribute text, values unescaped ('' for bare names)."""
+    attrs = []
+    for name, dq, sq, bare in HTML_ATTR_RE.findall(raw):
+        value = dq or sq or bare
+        attrs.append((name.lower(), html.unescape(value) if '&' in value else value))
+    return attrs
+
+def osc8_link(url):
+    """Returns the zero-width (open, close) fragments that make a terminal hyperlink to url."""
+    return (ZERO_WIDTH, f"\x1b]8;;{url}\x1b\\"), (ZERO_WIDTH, "\x1b]8;;\x1b\\")
+
+class ZulipHTMLConverter:
+    """
+    Converts Zulip message HTML into lines of (style, text) fragments in a single pass.
+    Keeps line structure (paragraphs, code blocks, quotes, lists) and styles code, quotes,
+    mentions and links; emoji become their unicode characters and links are OSC 8 hyperlinks.
+    Fed like html.parser.HTMLParser (feed(), then close() for the lines), with the same handler names.
     """
-    Cleans up Zulip HTML message content for terminal display.
-    Strips tags, prettifies links, and tries to not break code blocks.
-    """
-    soup = BeautifulSoup(content, "html.parser")
-    for code_tag in soup.find_all(['code', 'pre']):
-        code_tag.insert_before('\n')
-        code_tag.insert_after('\n')
-    for a in soup.find_all('a'):
-        if a.name:
-            text = a.get_text()
-            href = a.get('href', '')
-            if href and href != text:
-                a.replace_with(NavigableString(f"{text} ({href})"))
+    def __init__(self):
+        self.rawdata = ''
+        self.lines = []
+        self.cur = []
+        self.stack = []       # (tag, undo) for every open non-void tag
+        self.styles = []      # Active inline styles, innermost last
+        self.style = ''       # ' '.join(self.styles), kept current by _push_style/_pop_style
+        self.quote_depth = 0
+        self.pre_depth = 0
+        self.skip_depth = 0   # >0 while inside something we don't display
+        self.math_depth = 0   # Inside KaTeX MathML; only the TeX annotation is shown
+        self.in_annotation = False
+        self.lists = []       # Counters for open lists; None for bullets
+        self.link_href = None
+        self.link_text = []
+        self.pending_space = False
+
+    # Style and line bookkeeping
+    def _push_style(self, style):
+        self.styles.append(style)
+        self.style = ' '.join(self.styles)
+
+    def _pop_style(self):
+        self.styles.pop()
+        self.style = ' '.join(self.styles)
+
+    def _prefix(self):
+        out = []
+        if self.quote_depth:
+            out.append(('class:quote', '> ' * self.quote_depth))
+        if len(self.lists) > 1:
+            out.append(('', '  ' * (len(self.lists) - 1)))
+        return out
+
+    def _newline(self):
+        self.lines.append(self.cur)
+        self.cur = []
+        self.pending_space = False
+
+    def _block_break(self):
+        """Makes sure the next text starts on a fresh line."""
+        if self.cur:
+            self._newline()
+        self.pending_space = False
+
+    def _emit(self, text, style=None):
+        if not text:
+            return
+        if not self.cur:
+            self.cur.extend(self._prefix())
+        elif self.pending_space:
+            self.cur.append(('', ' '))
+        self.pending_space = False
+        if style is None:
+            style = self.style
+        if self.quote_depth and 'class:quote' not in style:
+            style = f"class:quote {style}".strip()
+        self.cur.append((style, text))
+        if self.link_href is not None:
+            self.link_text.append(text)
+
+    # Tokenizer callbacks
+    def handle_starttag(self, tag, attrs):
+        if self.skip_depth:
+            if tag not in HTML_VOID_TAGS:
+                self.stack.append((tag, 'skip'))
+                self.skip_depth += 1
+            return
+        attrs = dict(attrs) if attrs else {}
+        classes = set(attrs['class'].split()) if attrs.get('class') else set()
+        if tag in HTML_VOID_TAGS:
+            if tag == 'br':
+                self._newline()
+            elif tag == 'hr':
+                self._block_break()
+                self._emit('─' * 20)
+                self._newline()
+            elif tag == 'img' and 'emoji' in classes:
+                self._emit(attrs.get('alt') or attrs.get('title') or '', 'class:emoji')
+            return
+        undo = []
+        if classes & HTML_SKIP_CLASSES or tag in ('script', 'style'):
+            self.skip_depth += 1
+            self.stack.append((tag, 'skip'))
+            return
+        if tag in HTML_BLOCK_TAGS:
+            self._block_break()
+        if tag == 'blockquote':
+            self.quote_depth += 1
+            undo.append('quote')
+        elif tag == 'pre':
+            self.pre_depth += 1
+            self._push_style('class:code')
+            undo.extend(['pre', 'style'])
+        elif tag in ('ul', 'ol'):
+            self.lists.append(0 if tag == 'ol' else None)
+            undo.append('list')
+        elif tag == 'li':
+            if self.lists and self.lists[-1] is not None:
+                self.lists[-1] += 1
+                self._emit(f"{self.lists[-1]}. ", '')
             else:
-                a.replace_with(NavigableString(text))
-        else:
-            a.replace_with(NavigableString(a.get_text()))
-    for tag in soup.find_all(['img', 'div', 'span']):
-        tag.decompose()
-    cleaned = soup.get_text(separator=" ", strip=True)
-    def url_repl(m):
-        url = m.group(0)
-        display = url if len(url) <= 60 else "link"
-        return f"\n\x1b]8;;{url}\x1b\\{display}\x1b]8;;\x1b\\\n"
-    cleaned = re.sub(r'(https?://[^\s)]+)', url_repl, cleaned)
-    return " ".join(cleaned.split())
+                self._emit('• ', '')
+        elif tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+            self._push_style('bold underline')
+            undo.append('style')
+        elif tag in ('td', 'th'):
+            if self.cur:
+                self._emit(' | ', '')
+        elif tag == 'a':
+            href = attrs.get('href') or ''
+            if href and self.link_href is None:
+                if not self.cur:
+                    self.cur.extend(self._prefix())
+                elif self.pending_space:
+                    self.cur.append(('', ' '))
+                    self.pending_space = False
+                self.cur.append(osc8_link(href)[0])
+                self.link_href = href
+                self.link_text = []
+                self._push_style('class:link')
+                undo.extend(['link', 'style'])
+        elif tag == 'span' and ('user-mention' in classes or 'user-group-mention' in classes or 'topic-mention' in classes):
+            self._push_style('class:mention')
+            undo.append('style')
+        elif tag == 'span' and 'emoji' in classes:
+            codes = [c[6:] for c in classes if c.startswith('emoji-') and c != 'emoji-unicode']
+            try:
+                char = ''.join(chr(int(h, 16)) for h in codes[0].split('-')) if codes else ''
+            except ValueError:
+                char = ''
+            if char:
+                self._emit(char, 'class:emoji')
+                self.skip_depth += 1
+                self.stack.append((tag, 'skip'))
+                return
+        elif tag == 'math':
+            self.math_depth += 1
+            undo.append('math')
+        elif tag == 'annotation' and self.math_depth:
+            self.in_annotation = True
+            undo.append('annotation')
+        elif tag in HTML_INLINE_STYLES and not (tag == 'code' and self.pre_depth):
+            self._push_style(HTML_INLINE_STYLES[tag])
+            undo.append('style')
+        self.stack.append((tag, undo))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in HTML_VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in HTML_VOID_TAGS or not any(t == tag for t, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, undo = self.stack.pop()
+            self._close(open_tag, undo)
+            if open_tag == tag:
+                break
+
+    def _close(self, tag, undo):
+        if undo == 'skip':
+            self.skip_depth -= 1
+            return
+        for action in undo:
+            if action == 'style':
+                self._pop_style()
+            elif action == 'math':
+                self.math_depth -= 1
+            elif action == 'annotation':
+                self.in_annotation = False
+            elif action == 'quote':
+                self._block_break()
+                self.quote_depth -= 1
+            elif action == 'pre':
+                self._block_break()
+                self.pre_depth -= 1
+            elif action == 'list':
+                self._block_break()
+                self.lists.pop()
+            elif action == 'link':
+                href = self.link_href
+                text = ''.join(self.link_text)
+                self.cur.append(osc8_link(href)[1])
+                self.link_href = None
+                if href.startswith(('http://', 'https://')) and href != text and len(href) <= 60:
+                    self._emit(f" ({href})", '')
+        if tag in HTML_BLOCK_TAGS:
+            self._block_break()
+
+    def handle_data(self, data):
+        if self.skip_depth or (self.math_depth and not self.in_annotation):
+            return
+        if self.pre_depth:
+            parts = data.split('\n')
+            for i, part in enumerate(parts):
+                if i:
+                    self._newline()
+                self._emit(part)
+            return
+        if data[:1].isspace() and self.cur:
+            self.pending_space = True
+        words = WHITESPACE_RE.sub(' ', data).strip()
+        if words:
+            self._emit(words)
+            if data[-1:].isspace():
+                self.pending_space = True
+
+    def feed(self, data):
+        self.rawdata += data
+
+    def _tokenize(self):
+        for text, slash, tag, attrs, stray in HTML_TOKEN_RE.findall(self.rawdata):
+            if text:
+                self.handle_data(html.unescape(text) if '&' in text else text)
+            elif stray:
+                self.handle_data(stray)
+            elif not tag:
+                continue  # Comment, doctype or processing instruction
+            elif slash:
+                self.handle_endtag(tag.lower())
+            elif attrs.endswith('/'):
+                self.handle_startendtag(tag.lower(), html_attrs(attrs[:-1]) if attrs.strip() != '/' else [])
+            else:
+                self.handle_starttag(tag.lower(), html_attrs(attrs) if attrs else [])
+        self.rawdata = ''
+
+    def close(self):
+        self._tokenize()
+        while self.stack:
+            self._close(*self.stack.pop())
+        if self.cur:
+            self._newline()
+        # Drop leading/trailing blank lines but keep the ones inside code blocks
+        while self.lines and not self.lines[-1]:
+            self.lines.pop()
+        while self.lines and not self.lines[0]:
+            self.lines.pop(0)
+        return self.lines
+
+@timed('render.html')
+def html_to_lines(content):
+    """
+    Converts Zulip message HTML into a list of lines, each a list of (style, text) fragments.
+    Lines carry no trailing newline.
+    """
+    parser = ZulipHTMLConverter()
+    parser.feed(content or '')
+    return parser.close()
+
+def clean_message_html(content):
+    """
+    Cleans up Zulip HTML message content for terminal display, as plain text.
+    Strips tags, prettifies links and keeps line structure (code blocks stay intact).
+    """
+    return "\n".join(
+        "".join(text for style, text in line if ZERO_WIDTH not in style)
+        for line in html_to_lines(content)
+    )
 
 def username_color_class(name):
     """Assigns a color class to a username for consistent coloring."""
@@ -401,12 +2521,12 @@ def msg_to_fmt(msg):
     """
     Converts a Zulip message dict to a list of (style, text) tuples for display.
     """
-    color_class = username_color_class(msg['sender_full_name'])
-    content = clean_message_html(msg['content'])
+    color_class = username_color_class(msg.sender_full_name)
+    content = clean_message_html(msg.content)
     url_regex = re.compile(r'(https?://[^\s]+)')
     urls = url_regex.findall(content)
     content_wo_urls = url_regex.sub('', content).strip()
-    lines = [(f"class:{color_class}", f"[{msg['sender_full_name']}]"), ("", f": {content_wo_urls}\n")]
+    lines = [(f"class:{color_class}", f"[{msg.sender_full_name}]"), ("", f": {content_wo_urls}\n")]
     for url in urls:
         label = url if len(url) <= 60 else "link"
         osc8 = f"\x1b]8;;{url}\x1b\\{label}\x1b]8;;\x1b\\"
@@ -414,6 +2534,116 @@ def msg_to_fmt(msg):
     lines.append(('', '\n'))
     return lines
 
+# -- Section: Bulk pre-rendering --
+# Big batches of messages (a narrow opening, history paging back, search results) have their HTML
+# converted in a process pool, a chunk at a time, rather than all at once on the UI thread. What's
+# on screen goes in right away and the rest is inserted as its chunks come back. The workers are
+# forked, so they inherit this module instead of re-running it; without fork, it's all serial.
+# They're forked by start_prerender_pool, first thing in main(), while this is still the only
+# thread: forking once the event, loader and UI threads are running could copy a lock one of
+# them holds into the children.
+PRERENDER_THRESHOLD = read_setting('prerender_threshold', 100)  # Fewest messages to convert worth using the pool for
+PRERENDER_WORKERS = read_setting('prerender_workers', max(1, min(4, (os.cpu_count() or 2) - 1)))  # 0 turns the pool off
+PRERENDER_CHUNK = 25  # Messages per pool task; small, so the first ones come back quickly
+prerendered_html = {}  # Message content -> html_to_lines() of it from the pool, until rendered
+prerender_stats = {'batches': 0, 'pooled': 0, 'serial': 0, 'failed_chunks': 0}
+_prerender_pool = None  # The pool once started; False if it can't be used
+
+def _html_to_lines_batch(contents):
+    """Pool task: html_to_lines() of each of contents."""
+    return [html_to_lines(c) for c in contents]
+
+def start_prerender_pool():
+    """
+    Starts the process pool and forks its workers. Call before any other thread is started;
+    if it never is, everything is converted serially.
+    """
+    global _prerender_pool
+    if _prerender_pool is not None:
+        return
+    _prerender_pool = False
+    if PRERENDER_WORKERS > 0 and 'fork' in multiprocessing.get_all_start_methods():
+        try:
+            pool = concurrent.futures.ProcessPoolExecutor(PRERENDER_WORKERS, mp_context=multiprocessing.get_context('fork'))
+            atexit.register(pool.shutdown, cancel_futures=True)
+            pool.submit(_html_to_lines_batch, []).result()  # A fork pool forks all its workers on the first task
+            _prerender_pool = pool
+        except (OSError, ValueError, concurrent.futures.BrokenExecutor) as e:
+            print(f"Rendering without a process pool: {e}")
+
+def prerender_pool():
+    """The process pool, or None where there isn't one."""
+    return _prerender_pool or None
+
+def render_in_background(messages, insert, context_tag, first=0):
+    """
+    Hands messages to insert (which adds them to a line model) once their HTML is converted. When
+    at least PRERENDER_THRESHOLD need converting, the newest first of them go in right away and
+    the rest go through the pool, newest chunks first, each inserted as it finishes. context_tag
+    gives a message's header tag in that model, to skip messages whose render is cached.
+    With no UI loop running (scripted use) this waits for the pool before returning.
+    """
+    ordered = sorted(messages, key=message_sort_key)
+    now = ordered[len(ordered) - first:] if first else []
+    later = [m for m in ordered[:len(ordered) - len(now)]
+             if isinstance(m, Message) and m.content not in prerendered_html and not is_render_cached(m, context_tag(m))]
+    pool = prerender_pool() if len(later) >= PRERENDER_THRESHOLD else None
+    if pool is None:
+        prerender_stats['serial'] += len(messages)
+        insert(messages)
+        return
+    prerender_stats['batches'] += 1
+    pending = set(map(id, later))
+    insert([m for m in ordered if id(m) not in pending])
+    futures = {}
+    for i in range(len(later), 0, -PRERENDER_CHUNK):
+        chunk = later[max(0, i - PRERENDER_CHUNK):i]
+        try:
+            future = pool.submit(_html_to_lines_batch, [m.content for m in chunk])
+        except Exception:  # Broken pool (a worker died): convert the rest here
+            _insert_prerendered(chunk, None, insert)
+            continue
+        futures[future] = chunk
+        if ui_loop() is not None:
+            future.add_done_callback(functools.partial(_prerendered, chunk, insert))
+    if ui_loop() is None:
+        for future in concurrent.futures.as_completed(futures):
+            _prerendered(futures[future], insert, future)
+
+def _prerendered(chunk, insert, future):
+    """A pool task finished (called on the pool's thread): inserts its messages on the UI thread."""
+    try:
+        results = future.result()
+    except Exception:
+        results = None
+    run_on_ui(_insert_prerendered, chunk, results, insert)
+
+def _insert_prerendered(chunk, results, insert):
+    if results is None:
+        prerender_stats['failed_chunks'] += 1  # Rendering converts them, then
+    else:
+        prerender_stats['pooled'] += len(chunk)
+        for msg, lines in zip(chunk, results):
+            prerendered_html[msg.content] = lines
+    insert(chunk)
+    for msg in chunk:
+        prerendered_html.pop(msg.content, None)  # Whatever insert dropped (stale) shouldn't linger
+    request_redraw('chat')
+
+def history_inserter():
+    """An insert for render_in_background into the open narrow's line model, until it's next reset."""
+    generation = line_model.generation
+
+    def insert(messages):
+        global chat_scroll_pos_lines
+        if line_model.generation != generation:
+            return
+        # Skip anything evicted, removed or already shown in the meantime
+        fresh = [m for m in messages if m.id in msg_id_set and line_model.block_index(message_token(m)) is None]
+        chat_scroll_pos_lines = line_model.insert_messages(fresh, chat_scroll_pos_lines)
+        enforce_history_window()
+    return insert
+
 # -- Section: Help screen rendering --
 def get_help_screen_lines():
     """
@@ -427,8 +2657,9 @@ def get_help_screen_lines():
         ('class:prompt', "  /dm <user>               "), ('', "Start or view a DM with a user\n"),
         ('class:prompt', "  /users                   "), ('', "List all users\n"),
         ('class:prompt', "  /online                  "), ('', "Show users who are online or away\n"),
-        ('class:prompt', "  /search <term>           "), ('', "Search messages (across all streams, topics, DMs)\n"),
+        ('class:prompt', "  /search <term>           "), ('', "Search messages as you type (from:, stream:, topic: filter; Esc closes)\n"),
         ('class:prompt', "  /window <lines>          "), ('', "Set min visible window size\n"),
+        ('class:prompt', "  /stats                   "), ('', "Show live performance stats (Esc closes)\n"),
         ('class:prompt', "  /help                    "), ('', "Show this help screen again\n"),
         ('class:prompt', "  /exit                    "), ('', "Quit\n"),
         ('', "\nScroll: Up/Down/PageUp/PageDown   |   Refresh: Ctrl+L\n"),
@@ -440,195 +2671,1032 @@ def is_at_bottom():
     """
     Checks if the chat view is scrolled to the bottom.
     """
-    real_msgs = [m for m in msg_history if isinstance(m, dict) and 'id' in m]
     window_lines = get_dynamic_visible_window()
-    return chat_scroll_pos_lines <= 0 or len(real_msgs) <= window_lines
+    if newest_evicted:
+        return False
+    return chat_scroll_pos_lines <= 0 or line_model.block_count <= window_lines
 
 def print_system(msg):
     """
     Appends a system message to the chat history (for errors, status, etc).
     """
-    msg_history.append({
-        "id": -1,
-        "sender_full_name": "",
-        "content": msg
-    })
+    notice = SystemNotice(msg)
+    msg_history.append(notice)
+    line_model.add_messages([notice])
+    request_redraw('chat')
+
+# -- Section: Narrow cache --
+# The last few narrows left keep their loaded history, rendered lines and scroll position in
+# memory, so switching back to one paints it as it was, with no store or network round trip.
+# Only narrows the event queue keeps current are parked, and while parked, new messages, edits,
+# moves and deletions are applied to them as they are to the open narrow. If the queue drops,
+# whatever it missed could be anywhere, so the parked views go.
+NARROW_CACHE_SIZE = read_setting('narrow_cache_size', 8)  # Narrows kept parked, least recently left dropped first
+
+class NarrowView:
+    """A narrow's loaded messages, line model and scroll position, parked while another narrow is open."""
+    def __init__(self, context, history, lines, scroll, newest_evicted):
+        self.context = context  # The chat context (see current_context_key)
+        self.history = history  # Its real messages, as in msg_history
+        self.ids = {m.id for m in history}
+        self.lines = lines      # Its ChatLineModel
+        self.scroll = scroll
+        self.newest_evicted = newest_evicted
+
+    def add(self, msg):
+        """Puts a live message for this narrow in at the bottom. Returns False if that made the view too big to keep."""
+        if msg.id in self.ids or self.newest_evicted:
+            return True
+        self.history.append(msg)
+        self.ids.add(msg.id)
+        added = self.lines.add_messages([msg])
+        if self.scroll:
+            self.scroll += added
+        return len(self.history) <= HISTORY_WINDOW_MAX
+
+    def apply(self, changes):
+        """
+        update_loaded_messages for this view. Returns False if it can't follow them: messages moved
+        in (their place among what's loaded is unknown), or none left.
+        """
+        if any(m is not None and i not in self.ids and message_in_context(m, self.context) for i, m in changes.items()):
+            return False
+        loaded = {i: m if m is not None and message_in_context(m, self.context) else None
+                  for i, m in changes.items() if i in self.ids}
+        if loaded:
+            self.history[:] = [loaded.get(m.id, m) for m in self.history if loaded.get(m.id, m) is not None]
+            self.ids.difference_update(i for i, m in loaded.items() if m is None)
+            self.scroll = self.lines.replace_messages(loaded, self.scroll)
+        return bool(self.history)
+
+parked_views = OrderedDict()  # Chat context -> NarrowView, least recently left first
+
+def park_open_view():
+    """Parks the narrow being left (the line model's context) in parked_views, if it's worth keeping."""
+    global line_model
+    context = line_model.context
+    narrow = context_narrow(context) if context else None
+    if narrow is None or context == current_context_key() or not is_fresh(narrow) or not event_queue_alive.is_set():
+        return
+    model = line_model
+    with model.lock:
+        # System notices and local echoes don't come along; the echoes' messages arrive as events
+        model.remove_blocks(0, bisect.bisect_right(model.keys, -1))
+        scroll = max(0, chat_scroll_pos_lines - model.remove_blocks(bisect.bisect_left(model.keys, PENDING_SORT_KEY),
+                                                                    model.block_count))
+        shown = set(model.tokens)
+    # Messages still being pre-rendered (the oldest ones) are left out; scrolling up re-pages them
+    history = sorted((m for m in msg_history if m.id in shown), key=lambda m: m.id)
+    line_model = ChatLineModel()
+    line_model.width = model.width
+    if not history:
+        return
+    model.render = functools.partial(render_msg_line, context=context)  # Live messages land while another narrow is open
+    parked_views[context] = NarrowView(context, history, model, scroll, newest_evicted)
+    parked_views.move_to_end(context)
+    while len(parked_views) > NARROW_CACHE_SIZE:
+        parked_views.popitem(last=False)
+
+def restore_view(context):
+    """Makes the parked view of context the open narrow again. Returns False if there isn't one."""
+    global line_model, chat_scroll_pos_lines, earliest_msg_id, newest_evicted
+    view = parked_views.pop(context, None)
+    if view is None:
+        return False
+    chat_scroll_pos_lines = view.lines.set_width(line_model.width, view.scroll)  # In case the pane was resized
+    line_model = view.lines
+    msg_history[:] = view.history
+    msg_id_set.clear()
+    msg_id_set.update(view.ids)
+    earliest_msg_id = view.history[0].id
+    newest_evicted = view.newest_evicted
+    read_shown_messages()
+    request_redraw('chat')
+    return True
+
+def park_live_message(msg):
+    """Adds a live message to the parked views it belongs in."""
+    for context, view in list(parked_views.items()):
+        if message_in_context(msg, context) and not view.add(msg):
+            del parked_views[context]
+
+def update_parked_views(changes):
+    """Applies changed messages (id -> new record, or None if deleted) to the parked views."""
+    for context, view in list(parked_views.items()):
+        if not view.apply(changes):
+            del parked_views[context]
 
 # -- Section: Message loading and updating --
-def load_all_messages():
-    """
-    Loads all messages for the current context (stream/topic or DM).
-    """
-    global msg_history, msg_id_set, earliest_msg_id, chat_scroll_pos_lines
-    current_stream = chat_state['current_stream']
-    current_topic = chat_state['current_topic']
-    current_dm = chat_state['current_dm']
+def current_narrow():
+    """Returns the Zulip narrow for the current context, or None if nothing is selected."""
+    return context_narrow(current_context_key())
+
+def context_narrow(context):
+    """The Zulip narrow for a chat context (see current_context_key), or None for no context."""
+    current_stream, current_topic, current_dm = context
     if current_dm:
-        narrow = [{"operator": "pm-with", "operand": current_dm}]
+        return [{"operator": "pm-with", "operand": current_dm}]
     elif current_stream and current_topic:
-        narrow = [
+        return [
             {"operator": "stream", "operand": current_stream},
             {"operator": "topic", "operand": current_topic},
         ]
     elif current_stream:
-        narrow = [{"operator": "stream", "operand": current_stream}]
-    else:
+        return [{"operator": "stream", "operand": current_stream}]
+    return None
+
+def _show_history(messages, keep_notices=False):
+    """
+    Replaces the chat history with messages (the newest of the narrow, sorted by id), optionally
+    keeping system notices and pending local echoes.
+    """
+    global earliest_msg_id, newest_evicted
+    notices = [m for m in msg_history if m.id in (-1, None)] if keep_notices else []
+    newest_evicted = False
+    msg_history.clear()
+    msg_id_set.clear()
+    msg_history.extend(messages)
+    msg_id_set.update(m.id for m in msg_history)
+    line_model.reset(current_context_key())
+    render_in_background(messages, history_inserter(), chat_context_tag, first=get_dynamic_visible_window())
+    earliest_msg_id = msg_history[0].id if msg_history else None
+    if notices:
+        msg_history.extend(notices)
+        line_model.add_messages(notices)
+    read_shown_messages()
+
+def load_all_messages():
+    """
+    Loads all messages for the current context (stream/topic or DM).
+    Paints from the local store when it has the narrow's latest range, then fetches only the gap
+    after it in the background; otherwise clears the view and fetches from the server in the background.
+    Anything still loading for the previous narrow is cancelled. A narrow visited recently comes
+    back from the narrow cache as it was left, scroll position included.
+    """
+    global chat_scroll_pos_lines
+    cancel_narrow_tasks()
+    left = line_model.context
+    if left and left[0] and left[0] != chat_state['current_stream']:
+        topic_loader.cancel(left[0], urgent_only=True)  # No point scraping on for a stream that was left
+    park_open_view()
+    narrow = current_narrow()
+    if narrow is None:
         print_system("Pick a DM or stream first.")
         return
+    if restore_view(current_context_key()):
+        return
+    chat_scroll_pos_lines = 0
     window_lines = get_dynamic_visible_window()
-    res = client.get_messages({
+    rng = message_store.latest_range(narrow)
+    if rng:
+        cached = message_store.load_messages(narrow, rng[0], rng[1], window_lines * 2)
+        if cached:
+            _show_history(cached)
+            print_system(f"(Loaded {len(msg_history)} messages from cache.)")
+            if not is_fresh(narrow) or not event_queue_alive.is_set():
+                spawn(fetch_gap_after(narrow, rng))
+            return
+    _show_history([])
+    spawn(fetch_newest(narrow))
+
+async def fetch_newest(narrow):
+    """Fetches the newest messages of narrow and shows them, if it's still the open narrow."""
+    global chat_scroll_pos_lines
+    window_lines = get_dynamic_visible_window()
+    res = await async_client.get_messages({
         "anchor": "newest",
         "num_before": window_lines * 2,  # Fetch more to ensure coverage
         "num_after": 0,
         "narrow": narrow,
     })
-    if res['result'] != 'success':
-        print_system(f"Failed to fetch: {res.get('msg', 'Unknown error')}")
+    if current_narrow() != narrow:
+        return
+    if res.get('result') != 'success':
+        print_system(f"Failed to fetch: {res.get('msg', 'Unknown error')}")
+        return
+    messages = sorted(to_messages(res['messages']), key=lambda m: m.id)
+    _remember_newest(narrow, messages, res.get('found_oldest', False))
+    _show_history(messages, keep_notices=True)
+    chat_scroll_pos_lines = 0
+    print_system(f"(Loaded {len(messages)} messages.)")
+
+def _remember_newest(narrow, messages, found_oldest):
+    """Stores a fetch of a narrow's newest messages and records them as a complete range."""
+    message_store.save_messages(messages)
+    if messages:
+        message_store.add_range(narrow, 0 if found_oldest else messages[0].id, messages[-1].id)
+        if event_queue_alive.is_set():
+            fresh_narrows.add(narrow_key(narrow))
+
+async def fetch_gap_after(narrow, rng):
+    """
+    Fetches whatever arrived in narrow after the cached range rng and appends it.
+    If the gap is too big to close in one request, reloads the newest messages instead.
+    """
+    res = await async_client.get_messages({
+        "anchor": rng[1],
+        "num_before": 0,
+        "num_after": GAP_FETCH_LIMIT,
+        "narrow": narrow,
+    })
+    if res.get('result') != 'success':
         return
-    messages = res['messages']
-    msg_history.clear()
-    msg_id_set.clear()
-    msg_history.extend(sorted(messages, key=lambda m: m['id']))
-    msg_id_set.update(m['id'] for m in msg_history)
-    if msg_history:
-        earliest_msg_id = msg_history[0]['id']
-    else:
-        earliest_msg_id = None
-    print_system(f"(Loaded {len(msg_history)} messages.)")
+    if not res.get('found_newest', False):
+        # Too far behind; the cached range is still valid history, but start a fresh one at the top
+        await fetch_newest(narrow)
+        return
+    new_msgs = [m for m in to_messages(res['messages']) if m.id > rng[1]]
+    message_store.save_messages(new_msgs)
+    message_store.add_range(narrow, rng[0], max([rng[1]] + [m.id for m in new_msgs]))
+    if event_queue_alive.is_set():
+        fresh_narrows.add(narrow_key(narrow))
+    if current_narrow() == narrow:
+        for msg in new_msgs:
+            append_live_message(msg)
+        request_redraw('chat')
 
-def lazy_load_older_messages():
+def lazy_load_older_messages(batch=None):
     """
-    Loads older messages (for scrolling up) if available.
-    Returns True if new messages were loaded.
+    Loads up to batch (default: two windows' worth) older messages for scrolling up: straight from
+    the local store when the range below the earliest loaded message is known, otherwise from the
+    server in the background, one request per narrow at a time.
+    Returns True if older messages were added right away.
     """
-    global msg_history, msg_id_set, earliest_msg_id, chat_scroll_pos_lines
     if earliest_msg_id is None:
         return False
-    current_stream = chat_state['current_stream']
-    current_topic = chat_state['current_topic']
-    current_dm = chat_state['current_dm']
-    if current_dm:
-        narrow = [{"operator": "pm-with", "operand": current_dm}]
-    elif current_stream and current_topic:
-        narrow = [
-            {"operator": "stream", "operand": current_stream},
-            {"operator": "topic", "operand": current_topic},
-        ]
-    elif current_stream:
-        narrow = [{"operator": "stream", "operand": current_stream}]
-    else:
+    narrow = current_narrow()
+    if narrow is None:
         return False
-    window_lines = get_dynamic_visible_window()
-    res = client.get_messages({
-        "anchor": earliest_msg_id,
-        "num_before": window_lines * 2,
+    batch = batch or get_dynamic_visible_window() * 2
+    messages = []
+    rng = message_store.range_containing(narrow, earliest_msg_id)
+    if rng and rng[0] < earliest_msg_id:
+        messages = message_store.load_messages(narrow, rng[0], earliest_msg_id - 1, batch)
+    at_oldest = rng is not None and rng[0] == 0  # Range reaches the start of the narrow
+    if messages:
+        _prepend_older(messages)
+        return True
+    if at_oldest:
+        if narrow_key(narrow) not in history_exhausted:
+            history_exhausted.add(narrow_key(narrow))
+            print_system("(No more history to load.)")
+    elif older_fetch_in_flight() is None:
+        task = spawn(fetch_older(narrow, earliest_msg_id, batch))
+        if task is not None:
+            task.older_anchor = earliest_msg_id
+        readahead_stats['requests'] += 1
+    return False
+
+def older_fetch_in_flight():
+    """The running older-history fetch for the open narrow, if any (they're cancelled on narrow change)."""
+    for task in narrow_tasks:
+        if hasattr(task, 'older_anchor'):
+            return task
+    return None
+
+async def fetch_older(narrow, anchor, batch):
+    """Fetches up to batch messages of narrow before anchor from the server and prepends them."""
+    res = await async_client.get_messages({
+        "anchor": anchor,
+        "num_before": batch,
         "num_after": 0,
         "narrow": narrow,
     })
+    if current_narrow() != narrow or earliest_msg_id != anchor:
+        return
     if res['result'] != 'success':
         print_system(f"Failed to fetch older messages: {res.get('msg', 'Unknown error')}")
-        return False
-    messages = res['messages'][:-1]
+        return
+    messages = [m for m in to_messages(res['messages']) if m.id < anchor]
+    message_store.save_messages(messages)
+    found_oldest = res.get('found_oldest', False)
+    if messages or found_oldest:
+        lo = 0 if found_oldest else min(m.id for m in messages)
+        message_store.add_range(narrow, lo, anchor)
     if not messages:
+        history_exhausted.add(narrow_key(narrow))
         print_system("(No more history to load.)")
+        return
+    readahead_stats['fetched'] += len(messages)
+    _prepend_older(messages)
+    read_ahead()  # Scrolling may have outrun this batch already
+
+def _prepend_older(messages):
+    """
+    Puts messages (all older than what's loaded) at the top of the history. Quietly: with read-ahead
+    this mostly happens before the user gets there, and the scroll position (from the bottom) holds.
+    """
+    global earliest_msg_id
+    msg_history[0:0] = sorted(messages, key=lambda m: m.id)
+    msg_id_set.update(m.id for m in messages)
+    render_in_background(messages, history_inserter(), chat_context_tag)
+    earliest_msg_id = msg_history[0].id
+    enforce_history_window()
+    request_redraw('chat')
+
+# -- Section: History read-ahead --
+# Older history is fetched before the view reaches it. The distance kept loaded above the view
+# follows how fast the user is scrolling, and batch sizes follow how many lines a message takes.
+READAHEAD_SECONDS = read_setting('readahead_seconds', 3.0)  # Scrolling time worth of history kept loaded ahead
+READAHEAD_MAX_BATCH = 1000  # Most messages asked for in one request
+SCROLL_SAMPLE_WINDOW = 1.0  # Seconds of recent scrolling used to estimate speed
+scroll_samples = deque()    # (monotonic time, lines scrolled, either way)
+history_exhausted = set()   # Narrow keys whose oldest message we've reached
+readahead_stats = {'scrolls': 0, 'stalls': 0, 'requests': 0, 'fetched': 0}
+
+def note_scroll(lines):
+    """Records a scroll by lines (either direction), for the speed estimate."""
+    now = time.monotonic()
+    scroll_samples.append((now, lines))
+    while scroll_samples and scroll_samples[0][0] < now - SCROLL_SAMPLE_WINDOW:
+        scroll_samples.popleft()
+    readahead_stats['scrolls'] += 1
+
+def scroll_speed():
+    """Recent scrolling speed, in lines per second."""
+    now = time.monotonic()
+    return sum(n for t, n in scroll_samples if t >= now - SCROLL_SAMPLE_WINDOW) / SCROLL_SAMPLE_WINDOW
+
+def lines_per_message():
+    """Average rendered lines per message in the open narrow."""
+    if not line_model.block_count:
+        return 3
+    return max(1, line_model.line_count / line_model.block_count)
+
+def read_ahead():
+    """
+    Starts loading older history if the top of what's loaded is less than READAHEAD_SECONDS of
+    scrolling (at the current speed, and never less than a window) above the view.
+    """
+    if earliest_msg_id is None or older_fetch_in_flight() is not None:
+        return
+    lines_left = chat_line_count() - get_dynamic_visible_window() - chat_scroll_pos_lines
+    horizon = readahead_horizon()
+    if lines_left > horizon:
+        return
+    lazy_load_older_messages(readahead_batch(horizon))
+
+def note_scroll_blocked():
+    """The user tried to scroll past the top of what's loaded. A stall unless history is complete."""
+    narrow = current_narrow()
+    if narrow is not None and earliest_msg_id is not None and narrow_key(narrow) not in history_exhausted:
+        readahead_stats['stalls'] += 1
+        read_ahead()
+
+def readahead_horizon():
+    """How many lines of history to keep loaded past the view's edge: a window plus the scroll lookahead."""
+    return get_dynamic_visible_window() + scroll_speed() * READAHEAD_SECONDS
+
+def readahead_batch(horizon):
+    """How many messages to fetch to cover horizon twice over, given the narrow's message density."""
+    window = get_dynamic_visible_window()
+    return int(min(READAHEAD_MAX_BATCH, max(window * 2, horizon * 2 / lines_per_message())))
+
+# -- Section: History window --
+# Only HISTORY_WINDOW_MAX messages of the open narrow stay in memory. Once the window overflows,
+# whole messages are evicted from the end furthest from the view (never within a window of it);
+# they're still in the local store, so scrolling back re-pages them from there, or from the
+# server. Evicting below the view moves chat_scroll_pos_lines with it, so the view stays put.
+HISTORY_WINDOW_MAX = read_setting('history_window_max', 3000)  # Messages kept in memory for the open narrow
+HISTORY_EVICT_TO = 0.8  # Evict down to this share of the maximum, so eviction runs in batches
+newest_evicted = False  # Newer messages than the loaded ones were evicted; the view isn't at the real bottom
+
+def enforce_history_window():
+    """Evicts messages far from the view while the open narrow holds more than HISTORY_WINDOW_MAX."""
+    global earliest_msg_id, newest_evicted, chat_scroll_pos_lines
+    with line_model.lock:
+        keys, starts = line_model.keys, line_model.starts
+        first = bisect.bisect_right(keys, -1)                  # System notices sort first; keep them
+        last = bisect.bisect_left(keys, PENDING_SORT_KEY)      # Pending echoes sort last; keep them
+        if last - first <= HISTORY_WINDOW_MAX:
+            return 0
+        excess = (last - first) - int(HISTORY_WINDOW_MAX * HISTORY_EVICT_TO)
+        window = get_dynamic_visible_window()
+        below = chat_scroll_pos_lines
+        top = line_model.line_count - window - below  # First visible line of the model
+        evicted = []
+        for side in ('head', 'tail') if top >= below else ('tail', 'head'):  # Furthest from the view first
+            if excess <= 0:
+                break
+            if side == 'head':
+                # Blocks that end at least a window above the view
+                hi = min(first + excess, max(first, bisect.bisect_right(starts, top - window) - 1))
+                evicted += line_model.tokens[first:hi]
+                line_model.remove_blocks(first, hi)
+                excess -= hi - first
+                last -= hi - first
+            else:
+                # Blocks that start at least a window below the view
+                lo = max(last - excess, bisect.bisect_left(starts, line_model.line_count - below + window), first)
+                evicted += line_model.tokens[lo:last]
+                chat_scroll_pos_lines -= line_model.remove_blocks(lo, last)
+                if last > lo:
+                    newest_evicted = True
+                excess -= last - lo
+    if not evicted:
+        return 0
+    gone = set(evicted)
+    msg_history[:] = [m for m in msg_history if m.id not in gone]
+    msg_id_set.difference_update(gone)
+    real = [m.id for m in msg_history if isinstance(m, Message) and m.id is not None]
+    earliest_msg_id = min(real) if real else None
+    return len(gone)
+
+def read_behind():
+    """Re-pages evicted newer history before the view scrolls back down to it."""
+    if not newest_evicted or newer_fetch_in_flight() is not None:
+        return
+    horizon = readahead_horizon()
+    if chat_scroll_pos_lines > horizon:
+        return
+    load_newer_messages(readahead_batch(horizon))
+
+def newer_fetch_in_flight():
+    for task in narrow_tasks:
+        if hasattr(task, 'newer_anchor'):
+            return task
+    return None
+
+def load_newer_messages(batch):
+    """
+    Re-pages up to batch messages after the newest loaded one: from the local store when it has
+    them, otherwise from the server in the background. Returns True if messages were added right away.
+    """
+    narrow = current_narrow()
+    last = line_model.last_message_id()
+    if narrow is None or last < 0:
         return False
-    msg_history[0:0] = sorted(messages, key=lambda m: m['id'])
-    msg_id_set.update(m['id'] for m in messages)
-    earliest_msg_id = msg_history[0]['id']
-    print_system(f"(Loaded {len(messages)} older messages.)")
-    return True
+    rng = message_store.range_containing(narrow, last)
+    if rng and rng[1] > last:
+        messages = message_store.load_messages(narrow, last + 1, rng[1], batch, newest=False)
+        if messages:
+            complete = (messages[-1].id >= rng[1] and rng == message_store.latest_range(narrow)
+                        and is_fresh(narrow) and event_queue_alive.is_set())
+            _append_newer(messages, complete)
+            return True
+    task = spawn(fetch_newer(narrow, last, batch))
+    if task is not None:
+        task.newer_anchor = last
+    return False
+
+async def fetch_newer(narrow, anchor, batch):
+    """Fetches up to batch messages of narrow after anchor from the server and appends them."""
+    res = await async_client.get_messages({
+        "anchor": anchor,
+        "num_before": 0,
+        "num_after": batch,
+        "narrow": narrow,
+    })
+    if current_narrow() != narrow or line_model.last_message_id() != anchor:
+        return
+    if res.get('result') != 'success':
+        print_system(f"Failed to fetch newer messages: {res.get('msg', 'Unknown error')}")
+        return
+    messages = [m for m in to_messages(res['messages']) if m.id > anchor]
+    message_store.save_messages(messages)
+    rng = message_store.range_containing(narrow, anchor)
+    if rng and messages:
+        message_store.add_range(narrow, rng[0], messages[-1].id)
+    _append_newer(messages, res.get('found_newest', False))
+
+def _append_newer(messages, complete):
+    """Appends re-paged newer messages below the view, which stays where it is."""
+    global newest_evicted, chat_scroll_pos_lines
+    msg_history.extend(messages)
+    msg_id_set.update(m.id for m in messages)
+    chat_scroll_pos_lines += line_model.add_messages(messages)
+    if complete:
+        newest_evicted = False
+    enforce_history_window()
+    request_redraw('chat')
+    if messages and line_model.last_message_id() >= messages[-1].id:
+        read_behind()  # Not if the window couldn't keep them: they'd be evicted again every time
 
-def append_new_messages():
+def jump_to_newest():
+    """Reloads the narrow at its newest messages if they were evicted (e.g. before sending)."""
+    global chat_scroll_pos_lines
+    if newest_evicted:
+        load_all_messages()
+        chat_scroll_pos_lines = 0
+
+async def poll_new_messages():
     """
-    Loads new messages (for polling/updating), and updates unread counts.
-    Returns True if new messages were appended.
+    Fallback poll: fetches new messages in the open narrow, appends them, and updates unread counts.
+    Follows the newest message if the view was at the bottom. Returns True if messages were appended.
     """
-    global msg_history, msg_id_set, chat_scroll_pos_lines
-    if not msg_history:
+    global chat_scroll_pos_lines
+    if not msg_history or newest_evicted:
         return False
-    last_id = max(m['id'] for m in msg_history if isinstance(m, dict) and 'id' in m)
-    current_stream = chat_state['current_stream']
-    current_topic = chat_state['current_topic']
-    current_dm = chat_state['current_dm']
-    if current_dm:
-        narrow = [{"operator": "pm-with", "operand": current_dm}]
-    elif current_stream and current_topic:
-        narrow = [
-            {"operator": "stream", "operand": current_stream},
-            {"operator": "topic", "operand": current_topic},
-        ]
-    else:
+    last_id = line_model.last_message_id()
+    narrow = current_narrow()
+    if narrow is None or not (chat_state['current_dm'] or chat_state['current_topic']):
         return False
-    res = client.get_messages({
+    was_at_bottom = is_at_bottom()
+    res = await async_client.get_messages({
         "anchor": last_id,
         "num_before": 0,
         "num_after": 100,
         "narrow": narrow,
     })
-    if res['result'] == 'success':
-        new_msgs = [msg for msg in res['messages'] if msg['id'] > last_id and msg['id'] not in msg_id_set]
-        if new_msgs:
-            print(f"Appending {len(new_msgs)} new messages, last ID: {last_id}, new IDs: {[m['id'] for m in new_msgs]}")  # Debug new messages
-            for msg in new_msgs:
-                msg_history.append(msg)
-                msg_id_set.add(msg['id'])
-                if msg.get('sender_email') and msg['sender_email'] != client.email:
-                    if msg['type'] == 'stream':
-                        key = _get_stream_topic_key(msg['display_recipient'], msg['subject'])
-                        unread_tracker[key] = unread_tracker.get(key, 0) + 1
-                    elif msg['type'] == 'private':
-                        if isinstance(msg['display_recipient'], list):
-                            emails = [u['email'] for u in msg['display_recipient'] if u['email'] != client.email]
-                        else:
-                            emails = [msg['display_recipient']] if msg['display_recipient'] != client.email else []
-                        key = _get_dm_key(emails)
-                        unread_tracker[key] = unread_tracker.get(key, 0) + 1
-                        update_recent_dms(key)
-            return True
-    else:
-        print(f"Failed to append new messages: {res.get('msg', 'Unknown error')}")  # Debug failure
-    return False
+    if current_narrow() != narrow:
+        return False
+    if res['result'] != 'success':
+        return False  # Tried again in 2 seconds
+    messages = to_messages(res['messages'])
+    for msg in messages:
+        if msg.id in msg_id_set:
+            replace_local_echo(msg)
+    new_msgs = [msg for msg in messages if msg.id > last_id and msg.id not in msg_id_set]
+    message_store.save_messages(new_msgs)
+    rng = message_store.range_containing(narrow, last_id)
+    if rng and res.get('found_newest', False) and new_msgs:
+        message_store.add_range(narrow, rng[0], new_msgs[-1].id)
+    if new_msgs:
+        line_model.add_messages(new_msgs)
+        for msg in new_msgs:
+            msg_history.append(msg)
+            msg_id_set.add(msg.id)
+            dm_key = unread_model.add_message(msg)
+            if dm_key:
+                update_recent_dms(dm_key)
+    max_scroll = max(0, line_model.block_count - get_dynamic_visible_window())
+    if was_at_bottom and new_msgs:
+        force_scroll_to_bottom()  # Only scroll to bottom if user was already there
+    elif chat_scroll_pos_lines > max_scroll:
+        chat_scroll_pos_lines = max_scroll
+    if new_msgs:
+        read_shown_messages()
+        request_redraw()
+    return bool(new_msgs)
 
 def force_scroll_to_bottom():
     """Scrolls the chat view to the bottom (latest messages)."""
     global chat_scroll_pos_lines
     chat_scroll_pos_lines = 0
 
+# -- Section: Sending and local echo --
+pending_sends = {}  # local_id -> locally echoed message dict, until the server confirms it
+local_id_counter = itertools.count(1)
+event_queue = {'queue_id': None}  # Our event queue, so sends can ask for their local_id back
+
+def echo_recipient(email):
+    """A DM recipient dict for a local echo, filled in from the user directory like the server's."""
+    user = user_directory.get(email) or {}
+    return {'email': email, 'full_name': user.get('full_name', email), 'id': user.get('user_id')}
+
+def make_local_echo(request):
+    """Builds the placeholder message shown while a send request is in flight."""
+    local_id = f"{next(local_id_counter)}.01"
+    me = user_directory.get(client.email) or {}
+    text = html.escape(request['content']).replace("\n", "<br>")
+    return Message(
+        id=None,
+        local_id=local_id,
+        local_status="sending",
+        sender_full_name=me.get('full_name', client.email),
+        sender_email=client.email,
+        timestamp=time.time(),
+        content=f"<p>{text}</p>",
+        type=request['type'],
+        subject=request.get('topic', ''),
+        display_recipient=request['to'] if request['type'] == 'stream' else [echo_recipient(e) for e in request['to'] + [client.email]],
+    )
+
+def send_with_local_echo(request):
+    """
+    Shows the message in the chat right away and sends it in the background.
+    The echo is swapped for the real message when the send response or the message event arrives.
+    """
+    global chat_scroll_pos_lines
+    jump_to_newest()
+    echo = make_local_echo(request)
+    pending_sends[echo.local_id] = echo
+    msg_history.append(echo)
+    line_model.add_messages([echo])
+    chat_scroll_pos_lines = 0
+    request = dict(request, local_id=echo.local_id)
+    if event_queue['queue_id']:
+        request['queue_id'] = event_queue['queue_id']
+    spawn(_send_pending(echo, request), narrow_bound=False)
+
+async def _send_pending(echo, request):
+    """Sending side of send_with_local_echo."""
+    res = await async_client.send_message(request)
+    if res.get('result') == 'success':
+        confirm_local_echo(echo.local_id, res['id'])
+    else:
+        fail_local_echo(echo.local_id, res.get('msg', 'Unknown error'))
+    request_redraw()
+
+def _swap_history_entry(old, new):
+    """Replaces old with new in msg_history (searching from the end, where echoes live)."""
+    for i in range(len(msg_history) - 1, -1, -1):
+        if msg_history[i] is old:
+            if new is None:
+                del msg_history[i]
+            else:
+                msg_history[i] = new
+            return
+
+def drop_local_echo(local_id):
+    """Removes a pending echo because the real message has arrived."""
+    echo = pending_sends.pop(local_id, None)
+    if echo is None:
+        return
+    _swap_history_entry(echo, None)
+    line_model.remove_message(message_token(echo))
+
+def confirm_local_echo(local_id, msg_id):
+    """
+    The server accepted the message as msg_id. If its event beat us here the echo is just dropped;
+    otherwise the echo stays on screen as msg_id until the event (or a poll) brings the rendered version.
+    """
+    echo = pending_sends.get(local_id)
+    if echo is None:
+        return
+    if msg_id in msg_id_set or line_model.block_index(message_token(echo)) is None:
+        drop_local_echo(local_id)  # Also when the narrow was left meanwhile: the event brings the message
+        return
+    pending_sends.pop(local_id)
+    line_model.remove_message(message_token(echo))
+    confirmed = echo.replace(id=msg_id, local_status=None)
+    _swap_history_entry(echo, confirmed)
+    msg_id_set.add(msg_id)
+    line_model.add_messages([confirmed])
+
+def fail_local_echo(local_id, reason):
+    """Leaves the echo on screen, marked as failed (if its narrow is still open)."""
+    echo = pending_sends.pop(local_id, None)
+    if echo is None:
+        return
+    if line_model.block_index(message_token(echo)) is None:
+        print_system(f"(Failed to send: {reason})")  # The narrow was left meanwhile
+        return
+    failed = echo.replace(local_status='failed')
+    line_model.remove_message(message_token(echo))
+    _swap_history_entry(echo, failed)
+    line_model.add_messages([failed])
+    print_system(f"(Failed to send: {reason})")
+
+def replace_local_echo(msg):
+    """
+    If msg is already on screen as a confirmed local echo, swaps in the server's version.
+    Returns True if it did.
+    """
+    for i in range(len(msg_history) - 1, -1, -1):
+        old = msg_history[i]
+        if old.id == msg.id:
+            if old.local_id is None:
+                return False
+            msg_history[i] = msg
+            line_model.remove_message(msg.id)
+            line_model.add_messages([msg])
+            return True
+    return False
+
+# -- Section: Message changes --
+# Edits, moves, deletions and reactions arrive as events and are applied in place: to the loaded
+# history, the parked narrows and the search results (re-rendering only the messages that changed)
+# and to the local store, so no narrow ever has to be reloaded to catch up with them.
+
+def known_messages(ids):
+    """The latest version we have of each message in ids, loaded or stored, as id -> record."""
+    ids = set(ids)
+    known = {m.id: m for m in msg_history if isinstance(m, Message) and m.id in ids}
+    known.update((m.id, m) for m in message_store.messages_by_id(ids - known.keys()))
+    return known
+
+def update_loaded_messages(changes):
+    """
+    Shows changed messages (id -> new record, or None if deleted) wherever they're shown. Messages
+    that left the open narrow are dropped from it, and ones moved into it are added when they fall
+    within its loaded stretch. The view holds its place.
+    """
+    global chat_scroll_pos_lines, earliest_msg_id
+    loaded = {i: m if m is not None and message_in_current_narrow(m) else None
+              for i, m in changes.items() if i in msg_id_set}
+    if loaded:
+        msg_history[:] = [loaded[m.id] if m.id in loaded else m for m in msg_history
+                          if m.id not in loaded or loaded[m.id] is not None]
+        gone = {i for i, m in loaded.items() if m is None}
+        msg_id_set.difference_update(gone)
+        chat_scroll_pos_lines = line_model.replace_messages(loaded, chat_scroll_pos_lines)
+        if earliest_msg_id in gone:
+            real = [m.id for m in msg_history if isinstance(m, Message) and m.id is not None]
+            earliest_msg_id = min(real) if real else None
+    adopt_messages([m for i, m in changes.items() if m is not None and i not in msg_id_set])
+    shown = {i: m for i, m in changes.items() if i in search_view.ids}
+    if shown:
+        search_view.ids.difference_update(i for i, m in shown.items() if m is None)
+        search_view.scroll = search_view.lines.replace_messages(shown, search_view.scroll)
+    update_parked_views(changes)
+    if loaded or shown:
+        request_redraw('chat')
+
+def adopt_messages(messages):
+    """Adds messages that now belong in the open narrow (moved there) if they're within its loaded stretch."""
+    global chat_scroll_pos_lines
+    if earliest_msg_id is None:
+        return
+    last = line_model.last_message_id()
+    new = [m for m in messages if message_in_current_narrow(m) and m.id >= earliest_msg_id
+           and not (newest_evicted and m.id > last)]
+    if new:
+        chat_scroll_pos_lines = line_model.insert_messages(new, chat_scroll_pos_lines)
+        msg_history.extend(new)
+        msg_id_set.update(m.id for m in new)
+        request_redraw('chat')
+
+async def fetch_moved(narrow, ids):
+    """Fetches messages moved into the open narrow that we had never seen, and shows them."""
+    res = await async_client.get_messages({
+        "anchor": min(ids),
+        "num_before": 0,
+        "num_after": GAP_FETCH_LIMIT,
+        "narrow": narrow,
+    })
+    if current_narrow() != narrow or res.get('result') != 'success':
+        return
+    messages = [m for m in to_messages(res['messages']) if m.id in ids]
+    message_store.save_messages(messages)
+    adopt_messages(messages)
+
+# -- Section: Search --
+# Search has its own view over the chat pane; the open narrow keeps its history and scroll
+# position underneath. Matches come from the local store's full-text index as the query is typed,
+# and the server's matches are merged in (and stored, so indexed) as they arrive. Terms are
+# highlighted when results are rendered; message content is never touched.
+SEARCH_PAGE = read_setting('search_page', 50)  # Results paged in at a time, locally and from the server
+SEARCH_DEBOUNCE = 0.3  # Seconds of typing pause before the server is asked
+SEARCH_BACKFILL_BATCH = 2000  # Messages indexed per step when indexing an older store
+SEARCH_FILTERS = {'from': 'sender', 'sender': 'sender', 'stream': 'place', 'topic': 'topic'}
+SEARCH_FILTER_RE = re.compile(r'(\w+):(\S+)')
+SEARCH_WORD_RE = re.compile(r'[^\W_]+')
+
+def parse_search_query(q):
+    """
+    Splits a query into index terms [(column or None, word)], the narrow to search the server with
+    (None when a filter can't be expressed as one), and a regex matching the words to highlight.
+    Understands from:/sender:, stream: and topic: filters (from:Jane_Doe for names with spaces).
+    """
+    terms, words, narrow = [], [], []
+    for token in q.split():
+        m = SEARCH_FILTER_RE.fullmatch(token)
+        column = SEARCH_FILTERS.get(m.group(1).lower()) if m else None
+        if column is None:
+            found = SEARCH_WORD_RE.findall(token)
+            terms += [(None, w) for w in found]
+            words += found
+            continue
+        value = m.group(2)
+        terms += [(column, w) for w in SEARCH_WORD_RE.findall(value)]
+        if narrow is None:
+            continue
+        if column == 'place':
+            narrow = narrow + [{"operator": "stream", "operand": value}] if value in streams else None
+        elif column == 'topic':
+            narrow.append({"operator": "topic", "operand": value})
+        else:
+            email = get_email_from_name(value.replace('_', ' '))
+            narrow = narrow + [{"operator": "sender", "operand": email}] if email else None
+    if narrow is not None and words:
+        narrow.append({"operator": "search", "operand": " ".join(words)})
+    highlight = re.compile(r'\b(?:' + '|'.join(map(re.escape, words)) + r')\w*', re.IGNORECASE) if words else None
+    return terms, narrow or None, highlight
+
+def highlight_fragments(fragments, regex):
+    """fragments with every match of regex restyled as a highlight (hyperlink escapes are left alone)."""
+    if regex is None:
+        return fragments
+    out = []
+    for style, text in fragments:
+        if ZERO_WIDTH in style or not regex.search(text):
+            out.append((style, text))
+            continue
+        pos = 0
+        for m in regex.finditer(text):
+            if m.start() > pos:
+                out.append((style, text[pos:m.start()]))
+            out.append((f"{style} class:highlight".strip(), m.group()))
+            pos = m.end()
+        if pos < len(text):
+            out.append((style, text[pos:]))
+    return out
+
+def search_context_tag(msg):
+    """Where a search result was sent: [stream-topic], or [DM: people]."""
+    if msg.type == 'stream':
+        return f"[{msg.display_recipient}-{msg.subject}]"
+    return f"[DM: {', '.join(user_directory.display_name(e) for e in _message_dm_emails(msg)) or 'me'}]"
+
+def render_search_result(msg):
+    """A search result: like a chat message, tagged with where it was sent and with the terms highlighted."""
+    return highlight_fragments(render_cached(msg, search_context_tag(msg)), search_view.highlight)
+
+class SearchView:
+    """
+    The results of one search, shown in place of the chat. Results page in (from the local index
+    and from the server) as the view scrolls up towards the oldest loaded one.
+    """
+    def __init__(self):
+        self.lines = ChatLineModel(render=render_search_result)
+        self.task = None
+        self.reset()
+
+    def close(self):
+        """Leaves the search view for the open narrow."""
+        self.reset()
+        request_redraw('chat')
+
+    def reset(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+        self.active = False
+        self.query = ''
+        self.terms, self.narrow, self.highlight = [], None, None
+        self.ids = set()
+        self.scroll = 0             # Lines scrolled up from the bottom, like chat_scroll_pos_lines
+        self.local_before = None    # The next local page is below this id (None: start at the newest)
+        self.local_done = False
+        self.server_anchor = "newest"
+        self.server_done = False
+        self.waiting = False        # The server request is still waiting out SEARCH_DEBOUNCE
+        self.error = None
+        self.lines.reset()
+
+    def set_query(self, q, delay=SEARCH_DEBOUNCE):
+        """Shows the local matches for q right away and asks the server once delay seconds have passed."""
+        global show_help_screen
+        show_help_screen = False
+        if self.active and q == self.query:
+            if not delay and self.waiting:
+                self.task.cancel()
+                self.task = spawn(self.page_server(), narrow_bound=False)
+            return
+        self.reset()
+        self.active = True
+        self.query = q
+        self.terms, self.narrow, self.highlight = parse_search_query(q)
+        self.server_done = self.narrow is None
+        self.page_local()
+        if not self.server_done:
+            self.waiting = bool(delay)
+            self.task = spawn(self.page_server(delay), narrow_bound=False)
+
+    def add(self, messages):
+        """Adds the results not shown yet. The view holds its place (from the bottom) when older ones go in on top."""
+        new = [m for m in messages if m.id not in self.ids]
+        self.ids.update(m.id for m in new)
+        first = 0 if self.lines.line_count else get_dynamic_visible_window()  # The first page is on screen
+        render_in_background(new, functools.partial(self._insert, self.lines.generation), search_context_tag, first)
+        request_redraw('chat')
+
+    def _insert(self, generation, messages):
+        if self.lines.generation == generation:  # Otherwise the results are for an older query
+            self.scroll = self.lines.insert_messages(messages, self.scroll)
+
+    def page_local(self):
+        """Adds the next page of matches from the local index."""
+        if self.local_done:
+            return
+        ids = message_store.search(self.terms, self.local_before, SEARCH_PAGE)
+        if len(ids) < SEARCH_PAGE:
+            self.local_done = True
+        if ids:
+            self.local_before = ids[-1]
+        self.add(message_store.messages_by_id(ids))
+
+    async def page_server(self, delay=0):
+        """Adds the next page of the server's matches (which also go into the local store and index)."""
+        if delay:
+            await asyncio.sleep(delay)
+        self.waiting = False
+        query, anchor = self.query, self.server_anchor
+        res = await async_client.get_messages({
+            "anchor": anchor,
+            "num_before": SEARCH_PAGE,
+            "num_after": 0,
+            "narrow": self.narrow,
+        })
+        if not self.active or self.query != query:
+            return
+        if res.get('result') != 'success':
+            self.error = res.get('msg', 'Unknown error')
+            request_redraw('chat')
+            return
+        messages = [m for m in to_messages(res['messages']) if anchor == "newest" or m.id < anchor]
+        message_store.save_messages(messages)
+        if messages and not res.get('found_oldest', False):
+            self.server_anchor = min(m.id for m in messages)
+        else:
+            self.server_done = True
+        self.add(messages)
+
+    def page_older(self):
+        """Asks both sources for their next page, unless they're done (or the server's is already coming)."""
+        self.page_local()
+        if not self.server_done and (self.task is None or self.task.done()):
+            self.task = spawn(self.page_server(), narrow_bound=False)
+
+    def scroll_by(self, n):
+        """Scrolls n lines up (down if negative), paging in older results when the top gets close."""
+        window = get_dynamic_visible_window()
+        max_scroll = max(0, len(self.head_lines()) + self.lines.line_count - window)
+        self.scroll = min(max(0, self.scroll + n), max_scroll)
+        if max_scroll - self.scroll < window:
+            self.page_older()
+        request_redraw('chat')
+
+    def head_lines(self):
+        status = [('', f"Search: {self.query}  ({len(self.ids)} found)")]
+        if self.task is not None and not self.task.done():
+            status.append(('class:pending', "  (searching server…)"))
+        elif self.error:
+            status.append(('class:pending', f"  (server search failed: {self.error})"))
+        status.append(('class:pending', "  Esc to close\n"))
+        return wrap_lines(split_lines(status), self.lines.width)
+
+    def visible(self, width):
+        """The lines of the view that are on screen, wrapped to width cells."""
+        self.scroll = self.lines.set_width(width, self.scroll)
+        return visible_lines(self.lines, self.scroll, self.head_lines())
+
+search_view = SearchView()
+
+def on_input_changed(buffer):
+    """Search as you type: while the input reads "/search <query>", the search view follows it."""
+    text = buffer.text
+    if text.startswith('/search ') and text[8:].strip():
+        search_view.set_query(text[8:].strip())
+
+def index_stored_messages():
+    """Background thread: puts messages stored before the search index existed into it, a batch at a time."""
+    while not stop_event.is_set() and message_store.index_backlog(SEARCH_BACKFILL_BATCH):
+        pass
+
 # -- Section: Input and autocompletion --
 class ZulipCompleter(Completer):
     """
-    Custom completer for commands, streams, DMs, and usernames.
-    Handles slash commands, stream and user autocompletion, and @-mentions.
+    Custom completer for commands, streams, topics, DMs, and usernames.
+    Handles slash commands, stream/topic and user autocompletion, and @-mentions.
+    Everything comes from the completion indexes, capped at COMPLETION_LIMIT results.
     """
     def get_completions(self, doc, complete_event):
         text = doc.text_before_cursor.strip()
-        for cmdName in ['/stream', '/dm', '/users', '/online', '/search', '/exit', '/window', '/help']:
-            if cmdName.startswith(text):
-                yield Completion(cmdName, start_position=-len(text))
+        if ' ' not in text:
+            for cmdName in command_completions.search(text):
+                if cmdName.startswith(text):
+                    yield Completion(cmdName, start_position=-len(text))
         if text.startswith('/stream'):
-            prefix = text[7:].strip().lower()
-            for s in streams:
-                if s.lower().startswith(prefix):
-                    yield Completion(s, start_position=-len(prefix))
+            arg = doc.text_before_cursor[7:].lstrip()
+            parts = arg.split(None, 1)
+            if parts and parts[0] in stream_ids and (len(parts) > 1 or arg.endswith(' ')):
+                # "/stream <name> <topic prefix>"
+                stream_name = parts[0]
+                prefix = parts[1] if len(parts) > 1 else ''
+                topic_loader.request(stream_name, TOPIC_PRIORITY_URGENT)
+                for t in topic_completion_index(stream_name).search(prefix):
+                    yield Completion(t, start_position=-len(prefix))
+                return
+            prefix = arg.strip()
+            matches = stream_completions.search(prefix)
+            if prefix and len(matches) == 1:
+                topic_loader.request(matches[0], TOPIC_PRIORITY_URGENT)  # About to be opened
+            for s in matches:
+                yield Completion(s, start_position=-len(prefix))
         elif text.startswith('/dm'):
-            prefix = text[3:].strip().lower()
-            for n in user_names:
-                if n.lower().startswith(prefix):
-                    yield Completion(n, start_position=-len(prefix))
+            prefix = text[3:].strip()
+            for email in user_completions.search(prefix):
+                n = user_completions.labels[email]
+                status = presence_cache.status(email)
+                meta = status if status != 'offline' else ''
+                if len(user_directory.find_by_name(n)) > 1:
+                    # Same display name as someone else: complete to the unambiguous email
+                    yield Completion(email, start_position=-len(prefix), display=f"{n} ({email})", display_meta=meta)
+                else:
+                    yield Completion(n, start_position=-len(prefix), display_meta=meta)
         elif "@" in text:
             last_at = text.rfind("@")
             if last_at != -1 and (last_at == 0 or text[last_at-1].isspace()):
-                prefix = text[last_at + 1:].lower()
-                for name in user_names:
-                    if name.lower().startswith(prefix):
-                        yield Completion(
-                            f"@**{name}**",
-                            start_position=-(len(prefix)),
-                            display=f"@{name}",
-                            style="fg:green"
-                        )
+                prefix = text[last_at + 1:]
+                for email in user_completions.search(prefix):
+                    user = user_directory.get(email) or {}
+                    name = user_completions.labels[email]
+                    mention = f"@**{name}**"
+                    if 'user_id' in user and len(user_directory.find_by_name(name)) > 1:
+                        mention = f"@**{name}|{user['user_id']}**"  # Zulip's syntax for shared names
+                    status = presence_cache.status(email)
+                    yield Completion(
+                        mention,
+                        start_position=-(len(prefix) + 1),
+                        display=f"@{name}",
+                        display_meta=status if status != 'offline' else '',
+                        style="fg:green"
+                    )
 
 input_buffer = Buffer(completer=ZulipCompleter(), complete_while_typing=True)
+input_buffer.on_text_changed += on_input_changed
 input_control = BufferControl(buffer=input_buffer, focus_on_click=True)
 input_window = Window(content=input_control, height=1, style='class:input')
 
@@ -637,8 +3705,7 @@ def input_context_title():
     Returns the title for the input box, indicating the current chat context.
     """
     if chat_state['current_dm']:
-        target = [u['full_name'] for u in users if u['email'] == chat_state['current_dm']]
-        name = target[0] if target else chat_state['current_dm']
+        name = dm_key_label(chat_state['current_dm'])
         return f"[Direct Message: {name}] - :"
     elif chat_state['current_stream'] and chat_state['current_topic']:
         return f"[{chat_state['current_stream']} > {chat_state['current_topic']}] - :"
@@ -654,6 +3721,38 @@ input_frame = Frame(
 )
 
 # -- Section: Layout definition --
+class ChatControl(UIControl):
+    """
+    The chat pane. The line models hand over lines already wrapped to its width (re-wrapping
+    on the first frame after a resize), so a frame only touches the rows that are on screen,
+    however long the history is. Frames where the pane isn't dirty, its size is the same and
+    neither line model changed get the last content back.
+    """
+    def __init__(self):
+        self.key = None
+        self.content = None
+
+    def frame_key(self, width, height):
+        return (width, height, region_generations['chat'], line_model.generation, line_model.version,
+                search_view.lines.version, search_view.active, stats_panel['open'],
+                chat_scroll_pos_lines, search_view.scroll, current_context_key(), bool(narrow_tasks))
+
+    def create_content(self, width, height):
+        if self.frame_key(width, height) == self.key:
+            return self.content
+        chat_view['width'], chat_view['height'] = width, height
+        lines = render_visible_lines(width)
+
+        def get_line(i):
+            line = lines[i]
+            style, text = line[-1]
+            if text.endswith('\n'):
+                line = line[:-1] + [(style, text[:-1])]
+            return line
+        self.content = UIContent(get_line=get_line, line_count=len(lines), show_cursor=False)
+        self.key = self.frame_key(width, height)  # After rendering, which may re-wrap and re-anchor
+        return self.content
+
 body = VSplit([
     Window(
         width=20,
@@ -672,8 +3771,7 @@ body = VSplit([
         ConditionalContainer(
             Frame(
                 Window(
-                    content=FormattedTextControl(text=render_visible_messages),
-                    wrap_lines=True,
+                    content=ChatControl(),
                     height=Dimension(weight=1),
                     dont_extend_height=False
                 ),
@@ -699,14 +3797,10 @@ layout = Layout(container=body, focused_element=input_frame)
 # -- Section: Key bindings and event handlers --
 def get_all_physical_lines():
     """
-    Returns all the lines (context bar + messages) as a flat list, for scrolling.
+    Returns all the physical lines (context bar + messages), each a list of fragments.
+    Prefer chat_line_count() when only the count is needed.
     """
-    lines = get_context_bar_lines() + threaded_message_lines()
-    flat_lines = []
-    for style, text in lines:
-        for part in text.splitlines(True):
-            flat_lines.append((style, part))
-    return flat_lines
+    return context_bar_lines() + line_model.slice(0, None)
 
 kb = KeyBindings()
 
@@ -716,12 +3810,18 @@ def scroll_up(event):
     Scrolls the chat view up by one line. Loads older messages if needed.
     """
     global chat_scroll_pos_lines
-    max_scroll = max(0, len(get_all_physical_lines()) - get_dynamic_visible_window())
+    if search_view.active:
+        search_view.scroll_by(1)
+        return
+    max_scroll = max(0, chat_line_count() - get_dynamic_visible_window())
     if chat_scroll_pos_lines < max_scroll:
         chat_scroll_pos_lines += 1
-        if chat_scroll_pos_lines >= max_scroll - 5 and earliest_msg_id is not None:
-            lazy_load_older_messages()
-        event.app.invalidate()
+        note_scroll(1)
+        read_ahead()
+        read_shown_messages()
+        request_redraw('chat')
+    else:
+        note_scroll_blocked()
 
 @kb.add('down')
 def scroll_down(event):
@@ -729,9 +3829,17 @@ def scroll_down(event):
     Scrolls the chat view down by one line.
     """
     global chat_scroll_pos_lines
+    if search_view.active:
+        search_view.scroll_by(-1)
+        return
     if chat_scroll_pos_lines > 0:
         chat_scroll_pos_lines -= 1
-        event.app.invalidate()
+        note_scroll(1)
+        read_shown_messages()
+        request_redraw('chat')
+    elif newest_evicted:
+        readahead_stats['stalls'] += 1
+    read_behind()
 
 @kb.add('pageup')
 def page_up(event):
@@ -740,11 +3848,18 @@ def page_up(event):
     """
     global chat_scroll_pos_lines
     page = get_dynamic_visible_window()
-    max_scroll = max(0, len(get_all_physical_lines()) - page)
+    if search_view.active:
+        search_view.scroll_by(page)
+        return
+    max_scroll = max(0, chat_line_count() - page)
+    if chat_scroll_pos_lines >= max_scroll:
+        note_scroll_blocked()
+        return
+    note_scroll(min(page, max_scroll - chat_scroll_pos_lines))
     chat_scroll_pos_lines = min(chat_scroll_pos_lines + page, max_scroll)
-    if chat_scroll_pos_lines >= max_scroll - 5 and earliest_msg_id is not None:
-        lazy_load_older_messages()
-    event.app.invalidate()
+    read_ahead()
+    read_shown_messages()
+    request_redraw('chat')
 
 @kb.add('pagedown')
 def page_down(event):
@@ -753,13 +3868,29 @@ def page_down(event):
     """
     global chat_scroll_pos_lines
     page = get_dynamic_visible_window()
+    if search_view.active:
+        search_view.scroll_by(-page)
+        return
+    if chat_scroll_pos_lines == 0 and newest_evicted:
+        readahead_stats['stalls'] += 1
+    note_scroll(min(page, chat_scroll_pos_lines))
     chat_scroll_pos_lines = max(chat_scroll_pos_lines - page, 0)
-    event.app.invalidate()
+    read_behind()
+    read_shown_messages()
+    request_redraw('chat')
+
+@kb.add('escape')
+def close_overlay(event):
+    """Closes the search view or the stats panel, back to the open narrow (Esc)."""
+    if stats_panel['open']:
+        close_stats_panel()
+    elif search_view.active:
+        search_view.close()
 
 @kb.add('c-l')
 def refresh_screen(event):
     """Forces a redraw of the screen (Ctrl+L)."""
-    event.app.invalidate()
+    request_redraw()
 
 @kb.add('enter')
 def accept_input(event):
@@ -772,19 +3903,56 @@ def accept_input(event):
         return
     input_buffer.text = ''
     ret = process_command(text)
-    append_new_messages()  # Ensure new messages are loaded after sending
-    load_all_messages()   # Force a full reload to catch any missed messages
-    event.app.invalidate()
+    request_redraw()
     if ret == "exit":
         event.app.exit()
 
 # -- Section: Command processing and input helpers --
 def get_email_from_name(name):
-    """Looks up an email address from a user's full name."""
-    for u in users:
-        if u['full_name'].lower() == name.lower():
-            return u['email']
-    return None
+    """
+    Looks up an email address from a user's full name (or an email, passed through).
+    Returns None if nobody, or more than one person, has that name.
+    """
+    if user_directory.get(name):
+        return name
+    matches = user_directory.find_by_name(name)
+    return matches[0]['email'] if len(matches) == 1 else None
+
+def show_online_users():
+    """Lists who's online or away, from the presence cache."""
+    active, idle = presence_cache.around()
+    online = sorted(user_directory.display_name(e) for e in active)
+    away = sorted(user_directory.display_name(e) for e in idle)
+    txt = ""
+    if online:
+        txt += "Online:\n" + "".join(f"  ● {n}\n" for n in online)
+    if away:
+        txt += "Away:\n" + "".join(f"  ● {n}\n" for n in away)
+    if not txt:
+        txt = "(No online/away users.)"
+    print_system(txt)
+
+async def open_topic_when_known(stream_name, topic_name):
+    """/stream <stream> <topic> for a topic we haven't seen yet: fetches the stream's topics first."""
+    loop = asyncio.get_running_loop()
+    topics = await loop.run_in_executor(async_client.executor, topic_loader.ensure, stream_name)
+    open_topic(stream_name, topic_name, topics)
+
+def open_topic(stream_name, topic_name, topics):
+    """Switches to stream_name > topic_name, if topics (the stream's known topics) has it."""
+    if not topics:
+        print_system(f"No topics found in {stream_name}.")
+        return
+    if topic_name in topics:
+        stream_completions.touch(stream_name)
+        topic_completion_index(stream_name).touch(topic_name)
+        chat_state['current_stream'] = stream_name
+        chat_state['current_topic'] = topic_name
+        chat_state['current_dm'] = None
+        load_all_messages()
+        print_system(f"(Selected stream: {stream_name}, topic: {topic_name})")
+    else:
+        print_system(f"(Topic '{topic_name}' not found in stream '{stream_name}'. Available topics: {', '.join(topics)})")
 
 def process_command(cmd):
     """
@@ -793,7 +3961,12 @@ def process_command(cmd):
     """
     global chat_scroll_pos_lines, earliest_msg_id, VISIBLE_WINDOW_MIN, topic_cache, show_help_screen
     cmd = cmd.strip()
+    if not cmd.startswith("/search") and search_view.active:
+        search_view.close()  # Anything else goes back to the narrow
+    if stats_panel['open']:
+        close_stats_panel()
     if cmd == "/help":
+        cancel_narrow_tasks()
         show_help_screen = True
         chat_state['current_stream'] = None
         chat_state['current_dm'] = None
@@ -802,54 +3975,21 @@ def process_command(cmd):
         return
     show_help_screen = False
     if cmd == "/users":
-        userlist = sorted(user_names)
+        userlist = sorted(user_directory.names())
         print_system("All users:\n" + "\n".join(f"  {name}" for name in userlist))
         return
     if cmd == "/online":
-        presence = client.call_endpoint('realm/presence', method='GET').get("presences", {})
-        online, away = [], []
-        for email, data in presence.items():
-            status = data.get("aggregated", {}).get("status", "offline")
-            user = user_map.get(email, {"full_name": email})
-            if status == "active":
-                online.append(user['full_name'])
-            elif status == "idle":
-                away.append(user['full_name'])
-        txt = ""
-        if online:
-            txt += "Online:\n" + "".join(f"  ● {n}\n" for n in sorted(online))
-        if away:
-            txt += "Away:\n" + "".join(f"  ● {n}\n" for n in sorted(away))
-        if not txt:
-            txt = "(No online/away users.)"
-        print_system(txt)
+        show_online_users()
+        return
+    if cmd == "/stats":
+        open_stats_panel()
         return
     if cmd.startswith("/search"):
         q = cmd[len("/search"):].strip()
         if not q:
             print_system("(Usage: /search <term>)")
         else:
-            print_system(f"(🔍 Searching for “{q}”…)\n")
-            res = client.get_messages({
-                "anchor": "newest",
-                "num_before": 30,
-                "num_after": 0,
-                "narrow": [{"operator": "search", "operand": q}],
-            })
-            msgs = res.get("messages", [])
-            msg_history.clear()
-            msg_id_set.clear()
-            q_lc = q.lower()
-            for m in msgs:
-                if m['id'] not in msg_id_set:
-                    content = m['content']
-                    regex = re.compile(re.escape(q), re.IGNORECASE)
-                    m['content'] = regex.sub(lambda m: f"<span style='color:#ff0;background:#f00'>{m.group(0)}</span>", content)
-                    msg_history.append(m)
-                    msg_id_set.add(m['id'])
-            chat_scroll_pos_lines = 0
-            if not msgs:
-                print_system("(No matches found.)")
+            search_view.set_query(q, delay=0)
         return
     if cmd.startswith("/stream"):
         arg = cmd[7:].strip()
@@ -866,42 +4006,33 @@ def process_command(cmd):
             chat_state['current_stream'] = stream_name
             chat_state['current_topic'] = None
             chat_state['current_dm'] = None
-            if stream_name not in topic_cache:
-                topic_cache[stream_name] = get_topics(stream_name)
+            topic_loader.request(stream_name, TOPIC_PRIORITY_URGENT)
+            stream_completions.touch(stream_name)
             load_all_messages()
-            chat_scroll_pos_lines = 0
             print_system(f"(Viewing all topics in stream: {stream_name})")
             return
         else:
-            if stream_name not in topic_cache:
-                topic_cache[stream_name] = get_topics(stream_name)
-            topics = topic_cache[stream_name]
-            if not topics:
-                print_system(f"No topics found in {stream_name}.")
-                return
+            topics = topic_cache.get(stream_name, [])
             if topic_name in topics:
-                chat_state['current_stream'] = stream_name
-                chat_state['current_topic'] = topic_name
-                chat_state['current_dm'] = None
-                load_all_messages()
-                chat_scroll_pos_lines = 0
-                print_system(f"(Selected stream: {stream_name}, topic: {topic_name})")
+                open_topic(stream_name, topic_name, topics)
             else:
-                print_system(f"(Topic '{topic_name}' not found in stream '{stream_name}'. Available topics: {', '.join(topics)})")
+                # Not in what we know yet: fetch now, ahead of the background discovery
+                spawn(open_topic_when_known(stream_name, topic_name))
             return
     elif cmd.startswith("/dm"):
         arg = cmd[3:].strip()
         email = get_email_from_name(arg)
         if email:
+            user_completions.touch(email)
             chat_state['current_dm'] = email
             chat_state['current_stream'] = None
             chat_state['current_topic'] = None
             load_all_messages()
-            chat_scroll_pos_lines = 0
             print_system(f"(Switched to DM with: {arg})")
-            key = _get_dm_key([email])
-            mark_convo_as_read(key)
-            update_recent_dms(key)
+            update_recent_dms(_get_dm_key([email]))
+        elif len(user_directory.find_by_name(arg)) > 1:
+            options = ", ".join(u['email'] for u in user_directory.find_by_name(arg))
+            print_system(f"(Several users are named {arg}; use /dm <email> with one of: {options})")
         else:
             print_system("(User not found. Use Tab for completion.)")
     elif cmd.startswith("/exit"):
@@ -915,118 +4046,540 @@ def process_command(cmd):
         else:
             VISIBLE_WINDOW_MIN = max(4, int(arg))
             print_system(f"(Set minimum visible window size to {VISIBLE_WINDOW_MIN}.)")
-            load_all_messages()
             chat_scroll_pos_lines = 0
     elif cmd.startswith("/"):
-        print_system("(Unknown command. Try /stream, /dm, /users, /online, /search, /window, /help, /exit)")
+        print_system("(Unknown command. Try /stream, /dm, /users, /online, /search, /window, /stats, /help, /exit)")
     else:
         if chat_state['current_dm']:
-            res = client.send_message({
+            send_with_local_echo({
                 "type": "private",
                 "to": [chat_state['current_dm']],
                 "content": cmd,
             })
-            if res['result'] == 'success':
-                load_all_messages()
-                chat_scroll_pos_lines = 0
-                print_system("(sent)")
-                key = _get_dm_key([chat_state['current_dm']])
-                mark_convo_as_read(key)
-                update_recent_dms(key)
+            read_shown_messages()
+            update_recent_dms(_get_dm_key([chat_state['current_dm']]))
         elif chat_state['current_stream'] and chat_state['current_topic']:
-            res = client.send_message({
+            send_with_local_echo({
                 "type": "stream",
                 "to": chat_state['current_stream'],
                 "topic": chat_state['current_topic'],
                 "content": cmd,
             })
-            if res['result'] == 'success':
-                load_all_messages()
-                chat_scroll_pos_lines = 0
-                print_system("(sent)")
-                key = _get_stream_topic_key(chat_state['current_stream'], chat_state['current_topic'])
-                mark_convo_as_read(key)
+            read_shown_messages()
         elif chat_state['current_stream'] and not chat_state['current_topic']:
             print_system("(Pick a topic before sending a message to a stream!)")
         else:
             print_system("(Pick a stream/topic or DM first!)")
 
+# -- Section: Redraw scheduling --
+# Nothing redraws on a timer. State changes mark the regions they touch dirty and ask for a
+# frame; prompt_toolkit keeps at most one redraw pending and, with min_redraw_interval, draws
+# no more than one frame per REDRAW_FRAME, so bursts of events collapse into a single redraw.
+# Marking a region bumps its generation. The chat, sidebar and notification bar renderers keep
+# their last output keyed on it, so a frame drawn for one region (or for a keypress in the
+# input) hands the others back as they were without rebuilding them.
+REDRAW_FRAME = read_setting('redraw_frame_ms', 33) / 1000  # Frame budget, in seconds
+BLINK_INTERVAL = 0.5  # Seconds between notification bar blinks
+REDRAW_REGIONS = ('chat', 'sidebar', 'notify', 'input')
+ui_app = None  # The running Application, so background threads can ask for a redraw
+region_generations = dict.fromkeys(REDRAW_REGIONS, 0)  # Region -> times marked dirty
+redraw_stats = {'requests': 0, 'frames': 0}
+blink_wakeup = threading.Event()  # Wakes the blinker when the notification bar may need to blink
+
+def request_redraw(*regions):
+    """
+    Marks regions (all of them by default) dirty and asks for a redraw. Safe to call from any thread.
+    """
+    regions = regions or REDRAW_REGIONS
+    for region in regions:
+        region_generations[region] += 1
+    redraw_stats['requests'] += 1
+    if 'notify' in regions:
+        blink_wakeup.set()
+    if ui_app is not None:
+        ui_app.invalidate()
+
+def on_before_render(app):
+    """Application hook: a frame is being drawn."""
+    redraw_stats['frames'] += 1
+    now = time.perf_counter()
+    frame_times.append(now)
+    while frame_times[0] < now - FPS_WINDOW:
+        frame_times.popleft()
+
+def on_after_render(app):
+    """Application hook: the frame is out; records how long it took."""
+    if frame_times:
+        timing('render.frame').add(time.perf_counter() - frame_times[-1])
+
+# -- Section: Stats --
+# /stats shows what the instrumentation has gathered in the chat pane, refreshed every
+# STATS_REFRESH seconds while it's open. With stats_file set in ~/.zuliprc, the same snapshot
+# is also appended there as a JSON line every stats_interval seconds, for collecting elsewhere.
+STATS_FILE = os.path.expanduser(read_setting('stats_file', ''))  # JSON lines file for periodic dumps ('' = off)
+STATS_INTERVAL = read_setting('stats_interval', 60.0)  # Seconds between dumps
+STATS_REFRESH = 1.0  # Seconds between /stats panel refreshes
+FPS_WINDOW = 5.0     # Seconds of frames averaged for redraws per second
+START_TIME = time.monotonic()
+event_counts = {}    # Event type -> events handled
+frame_times = deque()  # perf_counter() at the start of recent frames
+stats_panel = {'open': False, 'lines': None, 'at': 0.0, 'task': None}
+
+def note_event(event, received=None):
+    """
+    Counts an event and records how long it waited: since the event thread received it, and for
+    messages since they were sent (in whole seconds, and only as good as the two clocks agree).
+    """
+    kind = event.get('type')
+    event_counts[kind] = event_counts.get(kind, 0) + 1
+    if received is not None:
+        timing('event.dispatch_lag').add(time.monotonic() - received)
+    if kind == 'message' and 'timestamp' in event.get('message', {}):
+        timing('event.server_lag').add(max(0.0, time.time() - event['message']['timestamp']))
+
+def frames_per_second():
+    cutoff = time.perf_counter() - FPS_WINDOW
+    while frame_times and frame_times[0] < cutoff:
+        frame_times.popleft()
+    return round(len(frame_times) / FPS_WINDOW, 1)
+
+def process_rss():
+    """Resident set size of this process in bytes (the peak, where the current one isn't available), or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def stats_snapshot():
+    """Everything /stats shows, as a JSON-ready dict. Safe to call from any thread."""
+    hits, misses = render_cache_stats['hits'], render_cache_stats['misses']
+    return {
+        'time': round(time.time(), 3),
+        'pid': os.getpid(),
+        'uptime_s': round(time.monotonic() - START_TIME, 1),
+        'rss_bytes': process_rss(),
+        'redraws': {'requests': redraw_stats['requests'], 'frames': redraw_stats['frames'], 'per_second': frames_per_second()},
+        'render_cache': {'hits': hits, 'misses': misses, 'size': len(render_cache),
+                         'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None},
+        'messages': {'loaded': len(msg_history), 'stored': message_store.message_count(), 'sending': len(pending_sends),
+                     'parked': sum(len(view.history) for view in list(parked_views.values())), 'parked_narrows': len(parked_views)},
+        'events': dict(event_counts),
+        'api_errors': dict(api_errors),
+        'readahead': dict(readahead_stats),
+        'prerender': dict(prerender_stats),
+        'read_sync': {'requests': read_sync['requests'], 'synced': read_sync['synced'], 'pending': len(read_sync['pending']),
+                      'unread': unread_model.total},
+        'timings': {name: hist.summary() for name, hist in sorted(timings.items()) if hist.count},
+    }
+
+def format_stats(snap):
+    """The /stats panel for a stats_snapshot(), as (style, text) fragments."""
+    rss = snap['rss_bytes']
+    cache = snap['render_cache']
+    msgs = snap['messages']
+    uptime = int(snap['uptime_s'])
+    out = [
+        ('class:notifybar', "Stats (live, Esc to close)\n"),
+        ('', f"Memory: {rss / 2**20:.1f} MiB RSS" if rss else "Memory: unknown"),
+        ('', f"    Uptime: {uptime // 3600}h {uptime // 60 % 60:02d}m {uptime % 60:02d}s\n"),
+        ('', f"Redraws: {snap['redraws']['per_second']}/s ({snap['redraws']['frames']} frames for {snap['redraws']['requests']} requests)\n"),
+        ('', f"Render cache: {cache['hit_rate'] * 100:.1f}% hits" if cache['hit_rate'] is not None else "Render cache: unused"),
+        ('', f" ({cache['hits']} hits, {cache['misses']} misses, {cache['size']} entries)\n"),
+        ('', f"Messages: {msgs['loaded']} loaded, {msgs['stored']} stored, {msgs['sending']} sending,"
+             f" {msgs['parked']} parked in {msgs['parked_narrows']} narrows\n"),
+        ('', "Events: " + (", ".join(f"{k} {n}" for k, n in sorted(snap['events'].items())) or "none") + "\n"),
+        ('', "API errors: " + (", ".join(f"{k} {n}" for k, n in sorted(snap['api_errors'].items())) or "none") + "\n"),
+        ('', "Read-ahead: " + ", ".join(f"{k} {n}" for k, n in snap['readahead'].items()) + "\n"),
+        ('', "Pre-render: " + ", ".join(f"{k} {n}" for k, n in snap['prerender'].items()) + "\n"),
+        ('', "Read sync: " + ", ".join(f"{k} {n}" for k, n in snap['read_sync'].items()) + "\n\n"),
+        ('class:prompt', f"{'Timings (ms)':<26}{'count':>8}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>10}\n"),
+    ]
+    for name, t in snap['timings'].items():
+        out.append(('', f"{name:<26}{t['count']:>8}{t['mean_ms']:>9.2f}{t['p50_ms']:>9.2f}{t['p90_ms']:>9.2f}{t['p99_ms']:>9.2f}{t['max_ms']:>10.2f}\n"))
+    return out
+
+def render_stats_panel():
+    """The /stats panel, rebuilt at most every STATS_REFRESH seconds."""
+    now = time.monotonic()
+    if stats_panel['lines'] is None or now - stats_panel['at'] >= STATS_REFRESH:
+        stats_panel['lines'] = format_stats(stats_snapshot())
+        stats_panel['at'] = now
+    return stats_panel['lines']
+
+async def _tick_stats_panel():
+    while stats_panel['open']:
+        request_redraw('chat')
+        await asyncio.sleep(STATS_REFRESH)
+
+def open_stats_panel():
+    stats_panel['open'] = True
+    stats_panel['lines'] = None
+    if ui_loop() is not None and (stats_panel['task'] is None or stats_panel['task'].done()):
+        stats_panel['task'] = spawn(_tick_stats_panel(), narrow_bound=False)
+    request_redraw('chat')
+
+def close_stats_panel():
+    stats_panel['open'] = False
+    stats_panel['lines'] = None
+    request_redraw('chat')
+
+def dump_stats():
+    """Appends a stats_snapshot() to STATS_FILE as one JSON line."""
+    try:
+        with open(STATS_FILE, 'a') as f:
+            f.write(json.dumps(stats_snapshot()) + "\n")
+    except OSError as e:
+        print(f"Couldn't write stats to {STATS_FILE}: {e}")
+
+def stats_dumper():
+    """Background thread: dumps stats every STATS_INTERVAL seconds until we quit."""
+    while not stop_event.wait(STATS_INTERVAL):
+        dump_stats()
+
 # -- Section: Background threads for polling and events --
+event_queue_alive = threading.Event()  # Set while the event queue is delivering; polling stands down
+EVENT_TYPES = ["message", "update_message", "delete_message", "reaction", "subscription", "realm_user", "presence",
+               "update_message_flags"]
+
+poll_state = {'task': None}  # The fallback poll in flight, if any (UI thread only)
+
+def start_poll():
+    """Spawns a fallback poll, unless the last one is still waiting on a slow server."""
+    task = poll_state['task']
+    if task is None or task.done():
+        poll_state['task'] = spawn(poll_new_messages(), narrow_bound=False)
+
 def fetch_new_messages_loop():
     """
-    Background thread: polls for new messages every 2 seconds and updates the chat view.
+    Background thread: fallback poller for the open narrow.
+    Only polls (every 2 seconds) while the event queue is down; otherwise events keep the view live.
     """
-    global chat_scroll_pos_lines
     while not stop_event.is_set():
-        try:
-            was_at_bottom = is_at_bottom()
-            new_msgs = append_new_messages()
-            if new_msgs or not was_at_bottom:
-                load_all_messages()  # Reload messages if new ones arrive or scroll wasn't at bottom
-            total_msgs = len([m for m in msg_history if isinstance(m, dict) and 'id' in m])
-            window_lines = get_dynamic_visible_window()
-            max_scroll = max(0, total_msgs - window_lines)
-            if was_at_bottom and new_msgs:
-                force_scroll_to_bottom()  # Only scroll to bottom if user was already there
-            elif chat_scroll_pos_lines > max_scroll:
-                chat_scroll_pos_lines = max_scroll
-            elif chat_scroll_pos_lines < 0:
-                chat_scroll_pos_lines = 0
-        except Exception as e:
-            print(e)
+        if not event_queue_alive.is_set():
+            run_on_ui(start_poll)
         time.sleep(2)
 
-def global_event_handler(event):
+def message_in_current_narrow(msg):
+    """Returns True if msg belongs to the open narrow (DM, stream, or stream+topic)."""
+    return message_in_context(msg, current_context_key())
+
+def message_in_context(msg, context):
+    """Returns True if msg belongs to the narrow of a chat context (see current_context_key)."""
+    current_stream, current_topic, current_dm = context
+    if current_dm:
+        if msg.type != 'private' or not isinstance(msg.display_recipient, tuple):
+            return False
+        others = {u['email'] for u in msg.display_recipient if u['email'] != client.email}
+        if current_dm == client.email:
+            return not others
+        return others == {current_dm}
+    if current_stream:
+        if msg.type != 'stream' or msg.display_recipient != current_stream:
+            return False
+        return current_topic is None or msg.subject.lower() == current_topic.lower()
+    return False
+
+def append_live_message(msg):
     """
-    Handles Zulip events from the global event queue (for notifications/unread).
+    Appends a message from the event queue to the open narrow, without refetching anything.
+    Keeps the view still if the user is scrolled up.
     """
-    if event['type'] == 'message':
-        msg = event['message']
-        if msg.get('sender_email') and msg['sender_email'] != client.email:
-            if msg['type'] == 'stream':
-                key = _get_stream_topic_key(msg['display_recipient'], msg['subject'])
-                unread_tracker[key] = unread_tracker.get(key, 0) + 1
-            elif msg['type'] == 'private':
-                if isinstance(msg['display_recipient'], list):
-                    emails = [u['email'] for u in msg['display_recipient'] if u['email'] != client.email]
-                else:
-                    emails = [msg['display_recipient']] if msg['display_recipient'] != client.email else []
-                key = _get_dm_key(emails)
-                unread_tracker[key] = unread_tracker.get(key, 0) + 1
-                update_recent_dms(key)
+    global chat_scroll_pos_lines
+    if msg.id in msg_id_set:
+        return replace_local_echo(msg)
+    if not message_in_current_narrow(msg) or newest_evicted:
+        return False  # When newer history is evicted, this comes back with it (it's in the store)
+    msg_history.append(msg)
+    msg_id_set.add(msg.id)
+    added = line_model.add_messages([msg])
+    if chat_scroll_pos_lines > 0:
+        chat_scroll_pos_lines += added
+    enforce_history_window()
+    read_shown_messages()  # Read if it landed on screen
+    return True
+
+def handle_message_event(event):
+    """Counts the message as unread (if it's not ours) and shows it if it's in the open narrow."""
+    msg = Message.from_api(event['message'])
+    store_live_message(msg)
+    if msg.type == 'stream':
+        note_topic(msg.display_recipient, msg.subject)
+    dm_key = unread_model.add_message(msg, event.get('flags', ()))
+    if dm_key:
+        update_recent_dms(dm_key)
+    if event.get('local_message_id') in pending_sends:
+        drop_local_echo(event['local_message_id'])
+    append_live_message(msg)
+    park_live_message(msg)
+    request_redraw()
 
-def run_global_event_loop():
+def handle_update_message_event(event):
     """
-    Starts the Zulip event queue listener in a background thread.
+    Applies an edit and/or a move (to another topic or stream) to every copy of the affected
+    messages: loaded history, search results, the local store, topic lists and unread counts.
+    A whole topic moving takes the open narrow along with it.
     """
-    client.call_on_each_event(global_event_handler, event_types=["message"])
+    ids = event.get('message_ids') or [event['message_id']]
+    known = known_messages(ids)
+    new_stream = stream_name(event['new_stream_id']) if 'new_stream_id' in event else None
+    new_topic = event.get('subject') if 'orig_subject' in event else None
+    changes = {}
+    for msg_id, msg in known.items():
+        fields = {}
+        if 'rendered_content' in event and msg_id == event.get('message_id'):
+            fields['content'] = event['rendered_content']
+        if msg.type == 'stream' and new_stream is not None:
+            fields['display_recipient'] = sys.intern(new_stream)
+        if msg.type == 'stream' and new_topic is not None:
+            fields['subject'] = sys.intern(new_topic)
+        if fields:
+            if not event.get('rendering_only'):
+                fields['last_edit_timestamp'] = event.get('edit_timestamp', msg.last_edit_timestamp)
+            changes[msg_id] = msg.replace(**fields)
+    if new_stream is not None or new_topic is not None:
+        unread_model.move(ids, new_stream, new_topic)
+        first = known.get(event.get('message_id'))
+        old_stream = event.get('stream_name') or stream_name(event.get('stream_id'))
+        old_topic = event.get('orig_subject') or (first.subject if first else None)
+        if old_stream and old_topic is not None:
+            move_topic(old_stream, old_topic, new_stream or old_stream, new_topic or old_topic,
+                       event.get('propagate_mode') == 'change_all', set(ids) - known.keys())
+    message_store.save_messages(list(changes.values()))
+    update_loaded_messages(changes)
+
+def move_topic(stream, topic, new_stream, new_topic, whole, unseen):
+    """
+    Bookkeeping for messages moved from stream/topic to new_stream/new_topic: topic lists and the
+    open narrow, which follows a whole topic. unseen are moved message ids we don't have, so the
+    destination's stored ranges can't be trusted.
+    """
+    note_topic(new_stream, new_topic)
+    if whole:
+        forget_topic(stream, topic)
+        if chat_state['current_stream'] == stream and (chat_state['current_topic'] or '').lower() == topic.lower():
+            chat_state['current_stream'], chat_state['current_topic'] = new_stream, new_topic
+            line_model.context = current_context_key()  # Same messages; update_loaded_messages re-renders them
+    if unseen:
+        dest = [{"operator": "stream", "operand": new_stream}]
+        for narrow in (dest, dest + [{"operator": "topic", "operand": new_topic}]):
+            message_store.forget_ranges(narrow)
+            fresh_narrows.discard(narrow_key(narrow))
+        for context in list(parked_views):
+            if context[0] == new_stream and (context[1] is None or context[1].lower() == new_topic.lower()):
+                del parked_views[context]
+        narrow = current_narrow()
+        if narrow is not None and not chat_state['current_dm'] and chat_state['current_stream'] == new_stream:
+            spawn(fetch_moved(narrow, unseen))
+    request_redraw('sidebar', 'notify')
+
+def handle_delete_message_event(event):
+    """Removes deleted messages from the view, search results, unread counts and the local store."""
+    ids = event.get('message_ids') or [event['message_id']]
+    unread_model.read(ids)
+    message_store.delete_messages(ids)
+    update_loaded_messages(dict.fromkeys(ids))
+
+def handle_reaction_event(event):
+    """Adds or removes one reaction, re-rendering just the message it's on."""
+    msg = known_messages([event['message_id']]).get(event['message_id'])
+    if msg is None:
+        return
+    user_id = event['user_id'] if 'user_id' in event else event.get('user', {}).get('user_id')
+    reaction = (sys.intern(event['emoji_name']), user_id)
+    if event['op'] == 'add':
+        if reaction in msg.reactions:
+            return
+        reactions = msg.reactions + (reaction,)
+    else:
+        reactions = tuple(r for r in msg.reactions if r != reaction)
+    changed = msg.replace(reactions=reactions)
+    message_store.save_messages([changed])
+    update_loaded_messages({msg.id: changed})
+
+def handle_subscription_event(event):
+    """Keeps the subscribed streams (and the stream list) current as we join and leave streams."""
+    names = [sub['name'] for sub in event.get('subscriptions', []) if 'name' in sub]
+    if event['op'] == 'add':
+        new_ids = dict(stream_ids, **{sub['name']: sub['stream_id'] for sub in event['subscriptions']})
+        _set_streams(streams + [n for n in names if n not in streams], new_ids)
+        subscribed_streams.update(names)
+        schedule_topic_discovery(names)
+        message_store.save_streams(streams)
+    elif event['op'] == 'remove':
+        subscribed_streams.difference_update(names)
+    else:
+        return  # Property changes and other people (un)subscribing don't show anywhere
+    realm_snapshot.update(subscriptions=sorted(subscribed_streams), stream_ids=dict(stream_ids))
+    message_store.save_snapshot(realm_snapshot)
+    request_redraw('sidebar')
+
+def handle_realm_user_event(event):
+    """
+    Keeps the user directory current as people join, leave, or change their name or email.
+    A new name also re-renders that user's loaded messages, parked narrows included.
+    """
+    person = dict(event['person'])
+    user = user_directory.get_by_id(person.get('user_id')) or user_directory.get(person.get('email'))
+    if event['op'] == 'add':
+        user_directory.add(person)
+    elif event['op'] == 'remove':
+        if user:
+            user_directory.remove(user)
+    elif event['op'] == 'update' and user:
+        if 'new_email' in person:
+            person['email'] = person.pop('new_email')
+        old_email, old_name = user['email'], user['full_name']
+        user_directory.update(user, person)
+        if (user['email'], user['full_name']) != (old_email, old_name):
+            email, name = sys.intern(user['email']), _intern(user['full_name'])
+            loaded = itertools.chain(msg_history, *(view.history for view in parked_views.values()))
+            update_loaded_messages({m.id: m.replace(sender_email=email, sender_full_name=name) for m in loaded
+                                    if isinstance(m, Message) and m.id is not None and m.sender_email == old_email})
+    request_redraw()
+
+def handle_presence_event(event):
+    """Merges one user's presence report into the cache. Only the sidebar shows presence without being asked."""
+    if 'presences' in event:  # Newer servers: a batch keyed by user id
+        for user_id, data in event['presences'].items():
+            presence_cache.update(user_id, data, event.get('server_timestamp'))
+    else:
+        presence_cache.update(event.get('email') or event.get('user_id'), event.get('presence', {}),
+                              event.get('server_timestamp'))
+    request_redraw('sidebar')
+
+def handle_update_message_flags_event(event):
+    """Messages flagged read or unread, here or on another device: the unread counts follow."""
+    if event.get('flag') != 'read':
+        return
+    ids = event.get('messages', [])
+    if (event.get('op') or event.get('operation')) == 'add':
+        if event.get('all'):
+            unread_model.reset([])
+        else:
+            unread_model.read(ids)
+    else:
+        details = event.get('message_details', {})
+        for msg_id in ids:
+            place = unread_place(details.get(str(msg_id)) or details.get(msg_id) or {})
+            if place:
+                unread_model.add(msg_id, place)
+    request_redraw('sidebar', 'notify')
+
+EVENT_HANDLERS = {
+    'message': handle_message_event,
+    'update_message': handle_update_message_event,
+    'delete_message': handle_delete_message_event,
+    'reaction': handle_reaction_event,
+    'subscription': handle_subscription_event,
+    'realm_user': handle_realm_user_event,
+    'presence': handle_presence_event,
+    'update_message_flags': handle_update_message_flags_event,
+}
+
+def global_event_handler(event, received=None):
+    """
+    Dispatches Zulip events from the global event queue to their handlers. received is when the
+    event thread got it (time.monotonic()), for the dispatch lag.
+    """
+    note_event(event, received)
+    handler = EVENT_HANDLERS.get(event['type'])
+    if handler:
+        try:
+            handler(event)
+        except Exception as e:
+            print(f"Error handling {event.get('type')} event: {e}")
+
+def run_global_event_loop(queue=None):
+    """
+    Background thread: long-polls the event queue, dispatching every event.
+    queue is the (queue_id, last_event_id) from a bootstrap that already registered; otherwise
+    (and whenever the server drops the queue) it registers, which also refreshes the realm state.
+    Backs off on network errors; while the queue is down, fetch_new_messages_loop takes over.
+    Events are handled on the UI event loop, in order.
+    """
+    queue_id, last_event_id = queue if queue else (None, -1)
+    event_queue['queue_id'] = queue_id
+    backoff = 1
+    while not stop_event.is_set():
+        try:
+            if queue_id is None:
+                queue_id, last_event_id = register_queue()
+                event_queue['queue_id'] = queue_id
+                spawn(poll_new_messages(), narrow_bound=False)  # Catch up on whatever arrived while we had no queue
+            res = api_call('get_events', queue_id=queue_id, last_event_id=last_event_id)
+            if res.get('result') != 'success':
+                if res.get('code') == 'BAD_EVENT_QUEUE_ID':
+                    queue_id = None  # Queue expired server-side; register a fresh one
+                    event_queue['queue_id'] = None
+                    event_queue_alive.clear()
+                    fresh_narrows.clear()
+                    run_on_ui(parked_views.clear)  # Parked views belong to the UI thread
+                    continue
+                raise RuntimeError(f"Event queue error: {res.get('msg', 'Unknown error')}")
+            event_queue_alive.set()
+            backoff = 1
+            received = time.monotonic()
+            for event in res['events']:
+                last_event_id = max(last_event_id, event['id'])
+                run_on_ui(global_event_handler, event, received)
+        except Exception as e:
+            event_queue_alive.clear()
+            fresh_narrows.clear()
+            run_on_ui(parked_views.clear)  # Parked views belong to the UI thread
+            print(e)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
 
 # -- Section: Main entry point --
 def main():
     """
     Main entry point. Sets up the UI, starts threads, and runs the event loop.
     """
-    global show_help_screen
+    global show_help_screen, ui_app
+    start_prerender_pool()
+    hold_ui_calls()  # Until app.run, background threads' UI work waits for the loop
     print("MINIMALIST MODE ACTIVATED. No sidebars. Only notifications, chat, and input remain.\n")
     print("Commands: /stream, /topic, /dm [name], /users, /online, /list, /search <query>, /window <lines>, /help, /exit")
     print("Tab autocompletes streams, topics, users, and commands!")
     show_help_screen = True
-    t_event = threading.Thread(target=run_global_event_loop, daemon=True)
+    queue = None
+    if not load_realm_snapshot():
+        print("First launch: fetching realm state...")
+        queue = register_queue()
+    t_event = threading.Thread(target=run_global_event_loop, args=(queue,), daemon=True)
     t_event.start()
+    threading.Thread(target=index_stored_messages, daemon=True).start()
+    threading.Thread(target=presence_reconciler, daemon=True).start()
+    if STATS_FILE:
+        threading.Thread(target=stats_dumper, daemon=True).start()
     app = Application(
         layout=layout,
         key_bindings=kb,
         style=style,
         full_screen=True,
-        refresh_interval=0.5
+        min_redraw_interval=REDRAW_FRAME,
+        before_render=on_before_render,
+        after_render=on_after_render
     )
+    ui_app = app
     t1 = threading.Thread(target=fetch_new_messages_loop, daemon=True)
-    t2 = threading.Thread(target=notification_blinker, args=(app,), daemon=True)
+    t2 = threading.Thread(target=notification_blinker, daemon=True)
     t1.start()
     t2.start()
     with patch_stdout():
-        app.run()
+        app.run(pre_run=release_ui_calls)
     stop_event.set()
+    blink_wakeup.set()
+    flush_reads()
+    if STATS_FILE:
+        dump_stats()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file